@@ -0,0 +1,164 @@
+from __future__ import annotations
+import typing as t
+
+# Rounds covered by the first level of the timer wheel. Effects that expire
+# later wait in a second level, one bucket per revolution of the wheel.
+WHEEL_SIZE = 64
+
+
+class Kind(t.NamedTuple):
+    # Rounds an effect lasts by default, or None until removed
+    duration: t.Optional[int] = None
+    # Share of the health pool lost at the end of each turn, or recovered
+    # when negative
+    tick: float = 0.0
+    # Whether gaining an effect again adds to its duration, rather than
+    # refreshing it
+    extend: bool = False
+    # Added to the holder's stats while active
+    bonuses: t.Dict[str, int] = {}
+
+
+KINDS = {
+    # Conditions
+    "prone": Kind(1),
+    "stunned": Kind(1),
+    "bleeding": Kind(3, tick=0.01),
+    "burning": Kind(3, tick=0.02),
+    # Effects
+    "initiated": Kind(1, extend=True),
+    "bloodlust": Kind(3),
+    "stealth": Kind(),
+    "channeled": Kind(1, bonuses={"might": 10}),
+    "protection": Kind(3),
+    "fire": Kind(3),
+    "water": Kind(3, tick=-0.01),
+    "brilliance": Kind(1),
+}
+
+# Times per encounter that passives may trigger
+LIMITS = {"true grit": 3}
+
+
+class Active:
+    __slots__ = ("holder", "name", "expires", "strength")
+
+    def __init__(
+        self, holder: t.Any, name: str, expires: t.Optional[int], strength: float
+    ):
+        self.holder = holder
+        self.name = name
+        self.expires = expires
+        self.strength = strength
+
+    def __repr__(self) -> str:
+        return f"<Active {self.name!r} expires={self.expires}>"
+
+
+class Schedule:
+    # Effects of everyone in an encounter, kept in the effects mapping of
+    # their holders, such as Actor.effects, and filed by the round they
+    # expire in. Ending a round only visits the effects that expire in it,
+    # and ending a turn only those of the holder that tick. Holders are told
+    # to invalidate_stats when they gain or lose an effect with bonuses.
+    def __init__(self, wheel_size: int = WHEEL_SIZE):
+        self.round = 0
+        self.wheel = [set() for _ in range(wheel_size)]
+        self.overflow = {}
+        self.ticking = {}
+        self.acted = set()
+        self.uses = {}
+
+    def add(
+        self,
+        holder: t.Any,
+        name: str,
+        rounds: t.Optional[int] = None,
+        strength: float = 1.0,
+    ) -> Active:
+        # Give holder an effect for rounds of its own turns, from its next
+        # turn if it has already had one this round
+        kind = KINDS.get(name, Kind())
+        if rounds is None:
+            rounds = kind.duration
+        expires = None
+        if rounds is not None:
+            expires = max(self.round + rounds - (holder not in self.acted), self.round)
+        active = holder.effects.get(name)
+        if active is None:
+            active = holder.effects[name] = Active(holder, name, None, strength)
+            if kind.tick:
+                self.ticking.setdefault(holder, set()).add(active)
+            if kind.bonuses:
+                holder.invalidate_stats()
+        else:
+            self.unfile(active)
+            active.strength = max(active.strength, strength)
+            if kind.extend and active.expires is not None and expires is not None:
+                expires = active.expires + rounds
+            elif active.expires is None or expires is None:
+                expires = None
+            else:
+                expires = max(active.expires, expires)
+        active.expires = expires
+        self.file(active)
+        return active
+
+    def remove(self, holder: t.Any, name: str) -> t.Optional[Active]:
+        active = holder.effects.pop(name, None)
+        if active is not None:
+            self.unfile(active)
+            ticking = self.ticking.get(holder)
+            if ticking is not None:
+                ticking.discard(active)
+            if KINDS.get(name, Kind()).bonuses:
+                holder.invalidate_stats()
+        return active
+
+    def trigger(self, holder: t.Any, name: str) -> bool:
+        # Count a use of a limited passive, returning whether any were left
+        uses = self.uses.get((holder, name), 0)
+        if uses >= LIMITS.get(name, uses + 1):
+            return False
+        self.uses[(holder, name)] = uses + 1
+        return True
+
+    def begin_turn(self, holder: t.Any):
+        self.acted.add(holder)
+
+    def end_turn(self, holder: t.Any) -> t.List[Active]:
+        # The effects of holder that tick at the end of its turn
+        return list(self.ticking.get(holder, ()))
+
+    def end_round(self) -> t.List[Active]:
+        # Remove and return the effects that expire with this round
+        bucket = self.wheel[self.round % len(self.wheel)]
+        expired = list(bucket)
+        bucket.clear()
+        for active in expired:
+            self.remove(active.holder, active.name)
+        self.acted.clear()
+        self.round += 1
+        if self.round % len(self.wheel) == 0:
+            # Move the effects expiring in the next revolution onto the wheel
+            for active in self.overflow.pop(self.round // len(self.wheel), ()):
+                self.wheel[active.expires % len(self.wheel)].add(active)
+        return expired
+
+    def file(self, active: Active):
+        if active.expires is None:
+            return
+        size = len(self.wheel)
+        if active.expires - self.round < size:
+            self.wheel[active.expires % size].add(active)
+        else:
+            self.overflow.setdefault(active.expires // size, set()).add(active)
+
+    def unfile(self, active: Active):
+        if active.expires is None:
+            return
+        size = len(self.wheel)
+        self.wheel[active.expires % size].discard(active)
+        later = self.overflow.get(active.expires // size)
+        if later is not None:
+            later.discard(active)
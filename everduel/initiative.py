@@ -0,0 +1,94 @@
+from __future__ import annotations
+import fractions
+import itertools
+import random
+import typing as t
+
+# Initiative is the lowest of DICE six-sided dice
+DICE = 3
+SIDES = 6
+FACES = tuple(range(1, SIDES + 1))
+
+table_cache = {}
+
+
+class Table:
+    # Exact probabilities of each initiative 1 to SIDES, with Vose alias
+    # tables to sample from them with a single random number
+    __slots__ = ("probabilities", "accept", "alias")
+
+    def __init__(self, probabilities: t.Sequence[fractions.Fraction]):
+        self.probabilities = tuple(probabilities)
+        size = len(self.probabilities)
+        scaled = [float(p) * size for p in self.probabilities]
+        self.accept = [1.0] * size
+        self.alias = list(range(size))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self.accept[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            (small if scaled[more] < 1.0 else large).append(more)
+
+    def probability(self, initiative: int) -> fractions.Fraction:
+        return self.probabilities[initiative - 1]
+
+    def sample(self, rng: random.Random) -> int:
+        roll = rng.random() * len(self.accept)
+        i = int(roll)
+        return (i if roll - i < self.accept[i] else self.alias[i]) + 1
+
+    def __repr__(self) -> str:
+        return f"<Table {[str(p) for p in self.probabilities]}>"
+
+
+def table(dice: int = DICE, channeled: bool = False, brilliance: bool = False) -> Table:
+    # The initiative table for rolling dice dice, re-rolling 1s under
+    # Channeled Power and then all dice but the highest under Arcane
+    # Brilliance. Tables are computed once per combination.
+    key = (dice, channeled, brilliance)
+    if key not in table_cache:
+        table_cache[key] = Table(distribution(dice, channeled, brilliance))
+    return table_cache[key]
+
+
+def die_distribution(channeled: bool = False) -> t.Dict[int, fractions.Fraction]:
+    p = fractions.Fraction(1, SIDES)
+    if not channeled:
+        return {face: p for face in FACES}
+    # A 1 is re-rolled once, and only stays a 1 if rolled again
+    return {face: p * p if face == 1 else p + p * p for face in FACES}
+
+
+def survival(die: t.Dict[int, fractions.Fraction], face: int) -> fractions.Fraction:
+    # Probability of a die rolling face or higher
+    return sum((p for f, p in die.items() if f >= face), fractions.Fraction(0))
+
+
+def distribution(
+    dice: int, channeled: bool = False, brilliance: bool = False
+) -> t.Tuple[fractions.Fraction, ...]:
+    dice = max(dice, 1)
+    die = die_distribution(channeled)
+    plain = die_distribution()
+    # Probability of the initiative being face or higher, per face
+    lowest = [fractions.Fraction(0)] * (SIDES + 2)
+    if not brilliance:
+        # The lowest of independent dice is face or higher when all are
+        for face in FACES:
+            lowest[face] = survival(die, face) ** dice
+    else:
+        # Which dice are re-rolled depends on the whole roll, so enumerate
+        # rolls and combine each with the lowest of its re-rolled dice
+        for roll in itertools.product(FACES, repeat=dice):
+            weight = fractions.Fraction(1)
+            for face in roll:
+                weight *= die[face]
+            highest = max(roll)
+            rerolled = sum(1 for face in roll if face != highest)
+            for face in range(1, highest + 1):
+                lowest[face] += weight * survival(plain, face) ** rerolled
+    return tuple(lowest[face] - lowest[face + 1] for face in FACES)
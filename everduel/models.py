@@ -1,7 +1,14 @@
 from __future__ import annotations
+import typing as t
+import weakref
 
 import persisthing as pt
 
+import everduel.effects as e
+
+STATS = ("might", "skill", "cunning", "empathy", "armor", "health")
+SLOTS = ("hand1", "hand2", "head", "armor", "ring1", "ring2")
+
 
 @pt.thing("C")
 class Container(pt.BaseThing):
@@ -19,7 +26,7 @@ class Container(pt.BaseThing):
 @pt.thing("T")
 class Thing(pt.BaseThing):
     name = pt.prop(str)
-    container = pt.prop(Container, default=None)
+    container = pt.prop(Container, default=None, indexed=True)
 
     def move(self, container: Container) -> bool:
         if isinstance(container, Container):
@@ -43,10 +50,10 @@ class ContainerThing(Container, Thing):
 
 @pt.thing("W")
 class Weapon(Thing):
-    damage = pt.prop(int)
+    damage = pt.prop(int, indexed=True)
 
 
-@pt.thing("stats")
+@pt.thing("stats", compact=True)
 class Stats(pt.BaseThing):
     might = pt.prop(int)
     skill = pt.prop(int)
@@ -56,15 +63,25 @@ class Stats(pt.BaseThing):
     health = pt.prop(int)
 
 
+class StatsSource(pt.BaseThing):
+    # Actors whose effective stats include this thing's stats
+    owners = pt.prop(weakref.WeakSet, volatile=True)
+
+    def mark_changed(self, name: str):
+        super().mark_changed(name)
+        for owner in self.owners:
+            owner.invalidate_stats()
+
+
 @pt.thing("race")
-class Race(pt.BaseThing):
+class Race(StatsSource):
     name = pt.prop(str)
     stats = pt.prop(Stats)
 
 
 @pt.thing("eq")
-class Equipment(Thing):
-    pass
+class Equipment(StatsSource, Thing):
+    stats = pt.prop(Stats, default=None)
 
 
 @pt.thing("held")
@@ -88,13 +105,46 @@ class Ring(Equipment):
 
 
 @pt.thing("slots")
-class Slots(pt.BaseThing):
-    hand1 = pt.prop(Held)
-    hand2 = pt.prop(Held)
-    head = pt.prop(Headwear)
-    armor = pt.prop(Armor)
-    ring1 = pt.prop(Ring)
-    ring2 = pt.prop(Ring)
+class Slots(StatsSource):
+    hand1 = pt.prop(Held, default=None)
+    hand2 = pt.prop(Held, default=None)
+    head = pt.prop(Headwear, default=None)
+    armor = pt.prop(Armor, default=None)
+    ring1 = pt.prop(Ring, default=None)
+    ring2 = pt.prop(Ring, default=None)
+
+
+class EffectiveStats(t.NamedTuple):
+    might: int
+    skill: int
+    cunning: int
+    empathy: int
+    armor: int
+    health: int
+    # Chance to score a critical hit, before crit_reduction of the
+    # defender's is subtracted
+    crit_chance: float
+    # Subtracted from the attacker's crit_chance
+    crit_reduction: float
+    # Scales damage dealt on a critical hit
+    crit_multiplier: float
+    # Scales all damage dealt
+    damage_multiplier: float
+    # Divides all direct damage taken
+    armor_divisor: float
+
+    @classmethod
+    def from_totals(cls, totals: t.Sequence[int]) -> EffectiveStats:
+        might, skill, _, _, armor, _ = totals
+        armor = max(armor, 0)
+        return cls(
+            *totals,
+            crit_chance=skill / 100,
+            crit_reduction=armor / 200,
+            crit_multiplier=1.5 + 0.01 * skill,
+            damage_multiplier=1 + 0.02 * might,
+            armor_divisor=1 + armor / 100,
+        )
 
 
 @pt.thing("A")
@@ -104,3 +154,53 @@ class Actor(ContainerThing):
     slots = pt.prop(Slots)
     weapon = pt.prop(Weapon)
     target = pt.prop("A")
+    # Name -> effects.Active, kept by the effects.Schedule of an encounter
+    effects = pt.prop(dict, volatile=True)
+    effective_cache = pt.prop(default=None, volatile=True)
+
+    @property
+    def effective_stats(self) -> EffectiveStats:
+        # Race, own, equipment and effect stats combined, kept until one of
+        # them changes. Call invalidate_stats after changing any of their
+        # Stats in place. Actors loaded lazily, or to a limited depth, need
+        # their race, stats, slots and the items in them loaded first.
+        if self.effective_cache is None:
+            self.effective_cache = self.compute_stats()
+        return self.effective_cache
+
+    def compute_stats(self) -> EffectiveStats:
+        race, stats, slots = self.race, self.stats, self.slots
+        if any(isinstance(v, pt.Reference) for v in (race, stats, slots)):
+            raise ValueError(
+                "effective stats need race, stats and slots loaded, await "
+                'fetch("race", "stats", "slots") first'
+            )
+        items = [getattr(slots, name) for name in SLOTS]
+        if any(isinstance(item, pt.Reference) for item in items):
+            raise ValueError(
+                "effective stats need the items in slots loaded, await "
+                "slots.fetch() first"
+            )
+        sources = [race.stats, stats]
+        for source in [race, slots] + items:
+            if source is not None:
+                source.owners.add(self)
+        for item in items:
+            if item is not None and item.stats is not None:
+                sources.append(item.stats)
+        totals = [0] * len(STATS)
+        for source in sources:
+            for i, name in enumerate(STATS):
+                totals[i] += getattr(source, name)
+        for name in self.effects:
+            for stat, bonus in e.KINDS.get(name, e.Kind()).bonuses.items():
+                totals[STATS.index(stat)] += bonus
+        return EffectiveStats.from_totals(totals)
+
+    def invalidate_stats(self):
+        self.effective_cache = None
+
+    def mark_changed(self, name: str):
+        super().mark_changed(name)
+        if name in ("race", "stats", "slots"):
+            self.invalidate_stats()
@@ -0,0 +1,490 @@
+from __future__ import annotations
+import concurrent.futures
+import math
+import random
+import typing as t
+
+import numpy as np
+
+import everduel.combat as c
+import everduel.effects as e
+import everduel.initiative as i
+import everduel.models as m
+
+SLOTS = 6
+# Health pool before Health, of which each point adds 10
+BASE_HEALTH = 1000
+HEALTH_PER_POINT = 10
+# Duels still undecided after this many rounds are draws
+MAX_ROUNDS = 200
+# Extra turns from Bloodlust or Hungerstrike in a row
+MAX_EXTRA_TURNS = 10
+# No duel effect lasts more than a few rounds, so a small wheel will do
+WHEEL_SIZE = 4
+
+ROLES = {
+    "bruiser": {"might": 100, "armor": 100, "health": 50, "skill": 50},
+    "hitter": {"might": 100, "skill": 100, "health": 50, "cunning": 50},
+    # Stats has no Wisdom, so empathy stands in for it
+    "healer": {"empathy": 100, "health": 100, "might": 50, "skill": 50},
+    "poisoner": {"cunning": 100, "health": 50},
+}
+
+ORBS = ("protection", "fire", "water")
+
+
+class Profile(t.NamedTuple):
+    # What a duel needs of a build, in a form that can be sent to workers
+    stats: t.Tuple[int, ...]
+    weapon: int
+    moves: t.Tuple[t.Optional[str], ...]
+
+
+def profile(
+    actor: m.Actor,
+    loadout: t.Dict[int, str],
+    role: t.Optional[str] = None,
+) -> Profile:
+    # Combine the actor's effective stats with its role's. The loadout maps
+    # move slots 1 to 6 to skills allowed in them. Fighters derive the rest
+    # of their effective stats from these totals once, as roles change them.
+    if role is not None and role not in ROLES:
+        raise ValueError(f"unknown role: {role}")
+    stats = list(actor.effective_stats[: len(c.STATS)])
+    for name, bonus in ROLES.get(role, {}).items():
+        stats[c.STATS.index(name)] += bonus
+    moves = [None] * SLOTS
+    for slot, skill in loadout.items():
+        if skill not in SKILLS:
+            raise ValueError(f"unknown skill: {skill}")
+        if slot not in SKILLS[skill][1]:
+            raise ValueError(f"{skill} does not fit slot {slot}")
+        moves[slot - 1] = skill
+    weapon = actor.weapon.damage if actor.weapon else 0
+    return Profile(tuple(stats), weapon, tuple(moves))
+
+
+class Fighter:
+    __slots__ = (
+        "stats",
+        "current",
+        "weapon",
+        "moves",
+        "passives",
+        "health",
+        "max_health",
+        "effects",
+        "uses",
+    )
+
+    def __init__(self, profile: Profile):
+        self.stats = list(profile.stats)
+        self.current = None
+        self.weapon = profile.weapon
+        self.moves = list(profile.moves)
+        self.passives = set(profile.moves)
+        self.max_health = BASE_HEALTH + HEALTH_PER_POINT * profile.stats[c.HEALTH]
+        self.health = self.max_health
+        # Effects and conditions, kept by the duel's schedule
+        self.effects = {}
+        self.uses = {}
+
+    @property
+    def alive(self) -> bool:
+        return self.health > 0
+
+    @property
+    def effective_stats(self) -> m.EffectiveStats:
+        # Stats with effect bonuses, kept until effects with bonuses change
+        if self.current is None:
+            totals = list(self.stats)
+            for name in self.effects:
+                for stat, bonus in e.KINDS[name].bonuses.items():
+                    totals[c.STATS.index(stat)] += bonus
+            self.current = m.EffectiveStats.from_totals(totals)
+        return self.current
+
+    def invalidate_stats(self):
+        self.current = None
+
+
+class Duel:
+    def __init__(self, one: Profile, two: Profile, rng: random.Random):
+        self.fighters = (Fighter(one), Fighter(two))
+        self.rng = rng
+        self.schedule = e.Schedule(WHEEL_SIZE)
+
+    def play(self) -> int:
+        # Returns 0 or 1 for the winner, or -1 for a draw
+        one, two = self.fighters
+        for _ in range(MAX_ROUNDS):
+            first = self.initiative(one)
+            second = self.initiative(two)
+            # Higher initiative acts first, so that the effects raising it,
+            # Initiated, Channeled Power and Arcane Brilliance, also speed
+            # their holder up
+            order = [(first, one, two), (second, two, one)]
+            if second > first or (second == first and self.rng.random() < 0.5):
+                order.reverse()
+            for initiative, fighter, target in order:
+                self.turn(fighter, target, initiative)
+                if not one.alive or not two.alive:
+                    return 0 if one.alive else 1 if two.alive else -1
+            self.schedule.end_round()
+        return -1
+
+    def initiative(self, fighter: Fighter) -> int:
+        # The initiative decides who moves first and which move slot is played
+        effects = fighter.effects
+        table = i.table(
+            i.DICE - ("initiated" in effects),
+            "channeled" in effects,
+            "brilliance" in effects,
+        )
+        return table.sample(self.rng)
+
+    def turn(self, fighter: Fighter, target: Fighter, initiative: int):
+        self.schedule.begin_turn(fighter)
+        for _ in range(MAX_EXTRA_TURNS):
+            if "stunned" in fighter.effects:
+                self.end_turn(fighter)
+                return
+            again = self.move(fighter, target, initiative)
+            if "bloodlust" in fighter.effects and initiative == 1:
+                again = True
+            self.end_turn(fighter)
+            if not again or not fighter.alive or not target.alive:
+                return
+            initiative = self.initiative(fighter)
+
+    def move(self, fighter: Fighter, target: Fighter, initiative: int) -> bool:
+        # Play the move in the slot matching initiative, returning whether
+        # the fighter takes another turn
+        skill = fighter.moves[initiative - 1]
+        action = SKILLS[skill][0] if skill else basic_attack
+        return bool(action(self, fighter, target))
+
+    def end_turn(self, fighter: Fighter):
+        if "water" in fighter.effects:
+            self.schedule.remove(fighter, "bleeding")
+            self.schedule.remove(fighter, "burning")
+        for active in self.schedule.end_turn(fighter):
+            if fighter.effects.get(active.name) is not active:
+                continue
+            tick = e.KINDS[active.name].tick
+            if tick < 0:
+                self.heal(fighter, -tick)
+            else:
+                fighter.health -= round(fighter.max_health * tick * active.strength)
+
+    def attack(
+        self,
+        fighter: Fighter,
+        target: Fighter,
+        level: int,
+        weapon: bool = False,
+        melee: bool = True,
+        multiplier: float = 1.0,
+        crit_bonus: float = 0.0,
+        split: bool = False,
+    ) -> int:
+        if "stealth" in target.effects and not self.contest(fighter, target):
+            return 0
+        if weapon:
+            multiplier *= 1 + fighter.weapon / 100
+        damage, _ = c.resolve_attack(
+            fighter.effective_stats,
+            target.effective_stats,
+            level,
+            self.rng,
+            multiplier,
+            crit_bonus,
+            split,
+        )
+        if "protection" in target.effects:
+            damage = round(damage * 0.75)
+        target.health -= damage
+        if melee and "fire" in target.effects and can_react(target):
+            self.attack(target, fighter, c.MODERATE, melee=False)
+        if "vampiric lineage" in fighter.passives and not split:
+            self.heal(fighter, 0, damage * 0.01)
+        return damage
+
+    def contest(self, fighter: Fighter, target: Fighter) -> bool:
+        # Cunning vs. Cunning test
+        mine = max(fighter.effective_stats.cunning, 0)
+        theirs = max(target.effective_stats.cunning, 0)
+        if mine + theirs == 0:
+            return self.rng.random() < 0.5
+        return self.rng.random() < mine / (mine + theirs)
+
+    def heal(self, fighter: Fighter, share: float, amount: float = 0.0):
+        amount += fighter.max_health * share
+        amount *= 1 + 0.02 * fighter.effective_stats.empathy
+        fighter.health = min(fighter.max_health, fighter.health + round(amount))
+
+    def gain(self, fighter: Fighter, effect: str, rounds: t.Optional[int] = None):
+        self.schedule.add(fighter, effect, rounds)
+        if effect in ORBS and "orb of many colors" in fighter.passives:
+            self.heal(fighter, 0.01)
+
+    def inflict(
+        self,
+        fighter: Fighter,
+        target: Fighter,
+        condition: str,
+        rounds: t.Optional[int] = None,
+    ):
+        if condition == "stunned" and "true grit" in target.passives:
+            if self.schedule.trigger(target, "true grit"):
+                return
+        strength = 1 + 0.02 * fighter.effective_stats.cunning
+        strength *= max(0.0, 1 - 0.01 * target.effective_stats.empathy)
+        self.schedule.add(target, condition, rounds, strength)
+
+
+def can_react(fighter: Fighter) -> bool:
+    return "stunned" not in fighter.effects and "prone" not in fighter.effects
+
+
+def replace(fighter: Fighter, old: str, new: str):
+    fighter.moves = [new if move == old else move for move in fighter.moves]
+
+
+def basic_attack(duel: Duel, fighter: Fighter, target: Fighter):
+    # Played from empty slots
+    duel.attack(fighter, target, c.MINOR, weapon=True)
+
+
+def chop_non_stop(duel: Duel, fighter: Fighter, target: Fighter):
+    uses = fighter.uses.get("chop", 0)
+    duel.attack(fighter, target, c.MODERATE, weapon=True, multiplier=1 + 0.1 * uses)
+    fighter.uses["chop"] = uses + 1
+
+
+def lacerating_cut(duel: Duel, fighter: Fighter, target: Fighter):
+    if duel.attack(fighter, target, c.MINOR):
+        duel.inflict(fighter, target, "bleeding", 3)
+
+
+def slice_n_dice(duel: Duel, fighter: Fighter, target: Fighter):
+    duel.attack(fighter, target, c.MODERATE, weapon=True, crit_bonus=1.0)
+
+
+def hammer_smash(duel: Duel, fighter: Fighter, target: Fighter):
+    prone = "prone" in target.effects
+    duel.attack(fighter, target, c.MODERATE, weapon=True)
+    if prone:
+        duel.attack(fighter, target, c.MODERATE)
+
+
+def pause_for_effect(duel: Duel, fighter: Fighter, target: Fighter):
+    duel.heal(fighter, 0.01)
+    duel.gain(fighter, "initiated", 1)
+
+
+def body_slam(duel: Duel, fighter: Fighter, target: Fighter):
+    if duel.attack(fighter, target, c.MODERATE):
+        duel.inflict(fighter, target, "stunned", 1)
+
+
+def true_grit(duel: Duel, fighter: Fighter, target: Fighter):
+    duel.heal(fighter, 0.1)
+
+
+def shadowstep(duel: Duel, fighter: Fighter, target: Fighter):
+    duel.gain(fighter, "stealth", None)
+    replace(fighter, "shadowstep", "shadowstrike")
+
+
+def shadowstrike(duel: Duel, fighter: Fighter, target: Fighter):
+    duel.schedule.remove(fighter, "stealth")
+    replace(fighter, "shadowstrike", "shadowstep")
+    duel.attack(fighter, target, c.SIGNIFICANT, weapon=True)
+
+
+def hungerstrike(duel: Duel, fighter: Fighter, target: Fighter) -> bool:
+    damage = duel.attack(fighter, target, c.MINOR, weapon=True)
+    duel.heal(fighter, 0, damage)
+    return fighter.health >= fighter.max_health
+
+
+def haste(duel: Duel, fighter: Fighter, target: Fighter) -> bool:
+    again = False
+    for _ in range(2):
+        initiative = duel.initiative(fighter)
+        if fighter.moves[initiative - 1] == "haste":
+            basic_attack(duel, fighter, target)
+        else:
+            again = duel.move(fighter, target, initiative) or again
+        if not target.alive:
+            break
+    return again
+
+
+def leeching_bite(duel: Duel, fighter: Fighter, target: Fighter):
+    damage = duel.attack(fighter, target, c.MODERATE)
+    duel.heal(fighter, 0, damage * 0.1)
+
+
+def vampiric_lineage(duel: Duel, fighter: Fighter, target: Fighter):
+    duel.gain(fighter, "bloodlust", 3)
+
+
+def zap(duel: Duel, fighter: Fighter, target: Fighter):
+    duel.attack(fighter, target, c.MINOR, melee=False)
+    replace(fighter, "zap", "zap-zap")
+
+
+def zap_zap(duel: Duel, fighter: Fighter, target: Fighter):
+    # A duel has a single target
+    duel.attack(fighter, target, c.MAJOR, melee=False)
+    replace(fighter, "zap-zap", "zap")
+
+
+def power_channel(duel: Duel, fighter: Fighter, target: Fighter):
+    duel.gain(fighter, "channeled", 1)
+
+
+def silver_orb(duel: Duel, fighter: Fighter, target: Fighter):
+    duel.gain(fighter, "protection", 3)
+
+
+def red_orb(duel: Duel, fighter: Fighter, target: Fighter):
+    duel.gain(fighter, "fire", 3)
+
+
+def blue_orb(duel: Duel, fighter: Fighter, target: Fighter):
+    duel.gain(fighter, "water", 3)
+
+
+def arcane_blast(duel: Duel, fighter: Fighter, target: Fighter):
+    duel.attack(fighter, target, c.MODERATE, melee=False, split=True)
+    duel.gain(fighter, "brilliance", 1)
+
+
+def orb_of_many_colors(duel: Duel, fighter: Fighter, target: Fighter):
+    for skill, action in (
+        ("silver orb", silver_orb),
+        ("red orb", red_orb),
+        ("blue orb", blue_orb),
+    ):
+        if skill in fighter.passives:
+            action(duel, fighter, target)
+
+
+# Skill -> (action, slots it fits). Replacement moves fit no slot.
+SKILLS = {
+    "chop non-stop": (chop_non_stop, (1,)),
+    "lacerating cut": (lacerating_cut, tuple(range(1, SLOTS + 1))),
+    "slice'n'dice": (slice_n_dice, (1,)),
+    "hammer smash": (hammer_smash, tuple(range(1, SLOTS + 1))),
+    "pause for effect": (pause_for_effect, (2,)),
+    "body slam": (body_slam, (3,)),
+    "true grit": (true_grit, (5,)),
+    "shadowstep": (shadowstep, (1,)),
+    "shadowstrike": (shadowstrike, ()),
+    "hungerstrike": (hungerstrike, (3,)),
+    "haste": (haste, (5, 6)),
+    "leeching bite": (leeching_bite, (2, 3)),
+    "vampiric lineage": (vampiric_lineage, (3, 4)),
+    "zap": (zap, (1,)),
+    "zap-zap": (zap_zap, ()),
+    "power channel": (power_channel, (1,)),
+    "silver orb": (silver_orb, (2, 3)),
+    "red orb": (red_orb, (3, 4)),
+    "blue orb": (blue_orb, (3, 4)),
+    "arcane blast": (arcane_blast, (4, 5)),
+    "orb of many colors": (orb_of_many_colors, (5, 6)),
+}
+
+
+class Result:
+    def __init__(self, wins: t.Tuple[int, int] = (0, 0), draws: int = 0):
+        self.wins = wins
+        self.draws = draws
+
+    @property
+    def duels(self) -> int:
+        return sum(self.wins) + self.draws
+
+    def __add__(self, other: Result) -> Result:
+        wins = (self.wins[0] + other.wins[0], self.wins[1] + other.wins[1])
+        return Result(wins, self.draws + other.draws)
+
+    def win_rate(self, side: int = 0) -> float:
+        return self.wins[side] / self.duels if self.duels else 0.0
+
+    def confidence_interval(
+        self, side: int = 0, z: float = 1.96
+    ) -> t.Tuple[float, float]:
+        # Wilson score interval of the win rate, 95% by default
+        n = self.duels
+        if not n:
+            return 0.0, 1.0
+        p = self.win_rate(side)
+        center = (p + z * z / (2 * n)) / (1 + z * z / n)
+        margin = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+        return max(0.0, center - margin), min(1.0, center + margin)
+
+    def __repr__(self) -> str:
+        return f"<Result wins={self.wins} draws={self.draws}>"
+
+
+def run_duels(one: Profile, two: Profile, seed: np.random.SeedSequence, count: int):
+    rng = random.Random(int(seed.generate_state(1, np.uint64)[0]))
+    wins = [0, 0]
+    draws = 0
+    for _ in range(count):
+        winner = Duel(one, two, rng).play()
+        if winner < 0:
+            draws += 1
+        else:
+            wins[winner] += 1
+    return Result(tuple(wins), draws)
+
+
+def iter_simulate(
+    one: Profile,
+    two: Profile,
+    duels: int,
+    seed: t.Optional[int] = None,
+    chunk_size: int = 1000,
+    executor: t.Optional[concurrent.futures.Executor] = None,
+) -> t.Iterator[Result]:
+    # Play duels between two profiles in chunks across a process pool,
+    # yielding the results so far as each chunk completes. Every chunk has
+    # its own seed from seed, so results do not depend on the scheduling.
+    chunks = [chunk_size] * (duels // chunk_size)
+    if duels % chunk_size:
+        chunks.append(duels % chunk_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ProcessPoolExecutor()
+    try:
+        futures = [
+            executor.submit(run_duels, one, two, chunk_seed, count)
+            for chunk_seed, count in zip(seeds, chunks)
+        ]
+        result = Result()
+        for future in concurrent.futures.as_completed(futures):
+            result = result + future.result()
+            yield result
+    finally:
+        if own_executor:
+            executor.shutdown(cancel_futures=True)
+
+
+def simulate(
+    one: Profile,
+    two: Profile,
+    duels: int,
+    seed: t.Optional[int] = None,
+    chunk_size: int = 1000,
+    executor: t.Optional[concurrent.futures.Executor] = None,
+) -> Result:
+    result = Result()
+    for result in iter_simulate(one, two, duels, seed, chunk_size, executor):
+        pass
+    return result
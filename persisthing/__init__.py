@@ -1,12 +1,24 @@
 from __future__ import annotations
 
-from .backends import FileBackend, SqliteBackend
+from .codecs import BinaryCodec, Codec, JsonCodec
+from .backends import (
+    FileBackend,
+    LogBackend,
+    MemoryBackend,
+    SqliteBackend,
+    TieredBackend,
+)
+from .cache import LRUCache
 from .constants import ID_KEY, TYPE_KEY, VERSION_KEY
 from .db import ThingsDB
 from .exceptions import ThingDoesNotExistException
+from .migration import migrate_all
+from .session import Session
 from .things import (
     BaseThing,
     Property as prop,
+    Reference,
     get_thing_type,
+    set_typechecks,
     thing,
 )
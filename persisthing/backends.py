@@ -1,33 +1,42 @@
 from __future__ import annotations
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import itertools
 import json
+import marshal
+import mmap
+import operator
+import os
 import pathlib
+import struct
+import tempfile
 import typing as t
 import uuid
+import zlib
 
 import aiosqlite
 import sqlite3
 
 import persisthing as pt
 
-
-class ThingJsonEncoder(json.JSONEncoder):
-    def default(self, thing):
-        if isinstance(thing, pt.BaseThing):
-            if thing._id:
-                return {pt.ID_KEY: thing._id}
-            thing._data[pt.TYPE_KEY] = thing._type
-            thing._data[pt.VERSION_KEY] = thing._version
-            return thing._data
-        return thing
+# Backends with an open transaction in the current task
+_transactions = contextvars.ContextVar("transactions", default=())
 
 
 class ThingsBackend:
-    encoder_cls = ThingJsonEncoder
-    decoder_cls = json.JSONDecoder
+    # Type of the ids things are stored under
+    id_type = int
+    # Where run runs blocking I/O, None for the event loop's default executor
+    executor = None
+    # Task doing the periodic work, between start and stop
+    _task = None
 
-    def __init__(self):
-        self.encoder = self.encoder_cls()
-        self.decoder = self.decoder_cls()
+    def __init__(self, codec: t.Optional[pt.Codec] = None):
+        self.codec = codec or pt.JsonCodec()
 
     @classmethod
     async def connect(cls, *args, **kwargs) -> ThingsBackend:
@@ -39,6 +48,26 @@ class ThingsBackend:
     async def update(self, thing_id: int, data: dict):
         raise NotImplementedError
 
+    async def save_many(self, items: t.Iterable[t.Tuple[t.Any, dict]]) -> t.List:
+        # Create things without an id and update the rest, returning all ids
+        thing_ids = []
+        async with self.transaction():
+            for thing_id, data in items:
+                if thing_id is None:
+                    thing_id = await self.create(data)
+                else:
+                    await self.update(thing_id, data)
+                thing_ids.append(thing_id)
+        return thing_ids
+
+    async def restore_many(self, items: t.Iterable[t.Tuple[t.Any, dict]]):
+        # Store things under the given ids, whether they exist or not
+        await self.save_many(items)
+
+    async def flush(self):
+        # Write out anything held back from durable storage
+        pass
+
     async def delete(self, thing_id: int):
         raise NotImplementedError
 
@@ -48,72 +77,490 @@ class ThingsBackend:
     async def load(self, thing_id: int) -> t.Optional[dict]:
         raise NotImplementedError
 
+    async def iterate(
+        self,
+        thing_types: t.Optional[t.Collection[str]] = None,
+        batch_size: int = 1000,
+        after: t.Any = None,
+    ) -> t.AsyncIterator[t.Tuple[t.Any, dict]]:
+        # Stream (id, data) of all things, or those of the given types. With
+        # after, backends that store things in id order resume after that id;
+        # others start over.
+        raise NotImplementedError
+        yield
+
+    async def query(
+        self,
+        thing_types: t.Optional[t.Collection[str]],
+        conditions: t.Iterable[t.Tuple[str, str, t.Any]],
+        batch_size: int = 1000,
+    ) -> t.AsyncIterator[t.Tuple[t.Any, dict]]:
+        # Stream (id, data) of things of the given types whose indexed
+        # properties match all (name, operator, value) conditions. Backends
+        # without indexes scan everything.
+        conditions = list(conditions)
+        async for thing_id, data in self.iterate(thing_types, batch_size):
+            if all(
+                matches(data.get(name), op, value) for name, op, value in conditions
+            ):
+                yield thing_id, data
+
+    async def load_many(self, thing_ids: t.Sequence) -> t.Dict[t.Any, dict]:
+        # Missing things are left out of the result
+        result = {}
+        for thing_id in thing_ids:
+            data = await self.load(thing_id)
+            if data is not None:
+                result[thing_id] = data
+        return result
+
     async def close(self):
         raise NotImplementedError
 
+    @contextlib.asynccontextmanager
+    async def transaction(self) -> t.AsyncIterator[None]:
+        yield
+
+    async def run(self, func: t.Callable, *args) -> t.Any:
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, func, *args
+        )
+
+    def periodic(self) -> t.Optional[t.Tuple[float, t.Callable[[], t.Awaitable]]]:
+        # The interval in seconds and the function of work to do in the
+        # background, if any
+        return None
+
+    def start(self):
+        periodic = self.periodic()
+        if periodic is not None and self._task is None:
+            self._task = repeat(*periodic)
+
+    async def stop(self):
+        await cancel(self._task)
+        self._task = None
+
 
 class SqliteBackend(ThingsBackend):
-    def __init__(self, conn: aiosqlite.Connection, tablename: str):
+    # Stay well below SQLITE_MAX_VARIABLE_NUMBER
+    chunk_size = 512
+
+    # Pragmas for throughput over durability of the very last transactions
+    # on power loss. Pass as pragmas to connect.
+    PERFORMANCE = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -64000,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+    }
+    # Pragmas that are per connection, and so also apply to readers
+    CONNECTION_PRAGMAS = {"cache_size", "mmap_size", "temp_store"}
+
+    def __init__(
+        self,
+        conn: aiosqlite.Connection,
+        tablename: str,
+        codec: t.Optional[pt.Codec] = None,
+    ):
         self._conn = conn
+        self._tablename = tablename
+        self._indextable = f"{tablename}_index"
         self._loadsql = f"SELECT data FROM {tablename} WHERE id = :id"
+        self._maxidsql = f"SELECT max(id) FROM {tablename}"
         self._deletesql = f"DELETE FROM {tablename} WHERE id = :id"
         self._clearsql = f"DELETE FROM {tablename}"
-        self._createsql = f"INSERT INTO {tablename} (data) VALUES (:data)"
-        self._updatesql = f"UPDATE {tablename} SET data = :data WHERE id = :id"
-        super().__init__()
+        self._createsql = f"INSERT INTO {tablename} (type, data) VALUES (:type, :data)"
+        self._insertsql = (
+            f"INSERT INTO {tablename} (id, type, data) VALUES (:id, :type, :data)"
+        )
+        self._updatesql = (
+            f"UPDATE {tablename} SET type = :type, data = :data WHERE id = :id"
+        )
+        self._restoresql = (
+            f"INSERT OR REPLACE INTO {tablename} (id, type, data) "
+            "VALUES (:id, :type, :data)"
+        )
+        self._indexsql = (
+            f"INSERT OR IGNORE INTO {self._indextable} (key, value, id) "
+            "VALUES (?, ?, ?)"
+        )
+        self._unindexsql = f"DELETE FROM {self._indextable} WHERE id = :id"
+        self._clearindexsql = f"DELETE FROM {self._indextable}"
+        self._lock = asyncio.Lock()
+        self._loadmanysql = {}
+        # Pool of read-only connections for loads, if any
+        self._readers = None
+        super().__init__(codec)
 
     @classmethod
     async def connect(
-        cls, dbpath: t.Union[str, pathlib.Path], tablename: str
+        cls,
+        dbpath: t.Union[str, pathlib.Path],
+        tablename: str,
+        codec: t.Optional[pt.Codec] = None,
+        pragmas: t.Optional[t.Dict[str, t.Any]] = None,
+        readers: int = 0,
     ) -> ThingsBackend:
         conn = await aiosqlite.connect(dbpath)
-        backend = cls(conn, tablename)
+        backend = cls(conn, tablename, codec)
+        if pragmas:
+            await backend.set_pragmas(conn, pragmas)
         await backend.initdb(tablename)
+        if readers:
+            # Readers only run concurrently with the writer in WAL mode
+            uri = pathlib.Path(dbpath).resolve().as_uri() + "?mode=ro"
+            reader_pragmas = {
+                name: value
+                for name, value in (pragmas or {}).items()
+                if name in cls.CONNECTION_PRAGMAS
+            }
+            backend._readers = asyncio.Queue()
+            for _ in range(readers):
+                reader = await aiosqlite.connect(uri, uri=True)
+                await backend.set_pragmas(reader, reader_pragmas)
+                backend._readers.put_nowait(reader)
         return backend
 
+    async def set_pragmas(self, conn: aiosqlite.Connection, pragmas: t.Dict):
+        for name, value in pragmas.items():
+            cursor = await conn.execute(f"PRAGMA {name} = {value}")
+            await cursor.close()
+
+    @contextlib.asynccontextmanager
+    async def reading(self) -> t.AsyncIterator[aiosqlite.Connection]:
+        # Inside a transaction we must read through the writer to see our own
+        # uncommitted writes
+        if self._readers is None or self in _transactions.get():
+            yield self._conn
+            return
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
     async def create(self, data: dict) -> int:
-        cursor = await self.execute(self._createsql, data=self.encoder.encode(data))
-        await self.commit()
-        await cursor.close()
+        async with self.transaction():
+            cursor = await self.execute(
+                self._createsql,
+                type=data.get(pt.TYPE_KEY),
+                data=self.codec.encode(data),
+            )
+            await cursor.close()
+            await self.write_index([(cursor.lastrowid, data)])
         return cursor.lastrowid
 
     async def update(self, thing_id: int, data: dict):
-        cursor = await self.execute(
-            self._updatesql, id=thing_id, data=self.encoder.encode(data)
+        async with self.transaction():
+            cursor = await self.execute(
+                self._updatesql,
+                id=thing_id,
+                type=data.get(pt.TYPE_KEY),
+                data=self.codec.encode(data),
+            )
+            await cursor.close()
+            await self.write_index([(thing_id, data)])
+
+    async def save_many(self, items: t.Iterable[t.Tuple[int, dict]]) -> t.List[int]:
+        created = []
+        updated = []
+        thing_ids = []
+        indexed = []
+        for thing_id, data in items:
+            params = {
+                "id": thing_id,
+                "type": data.get(pt.TYPE_KEY),
+                "data": self.codec.encode(data),
+            }
+            (created if thing_id is None else updated).append(params)
+            thing_ids.append(params)
+            indexed.append(data)
+        async with self.transaction():
+            if created:
+                # We hold the only write lock, so we can hand out the ids
+                # ourselves and insert everything with one executemany
+                row = await self.fetchone(self._maxidsql)
+                next_id = (row[0] or 0) + 1
+                for params in created:
+                    params["id"] = next_id
+                    next_id += 1
+                await self.executemany(self._insertsql, created)
+            if updated:
+                await self.executemany(self._updatesql, updated)
+            thing_ids = [params["id"] for params in thing_ids]
+            await self.write_index(zip(thing_ids, indexed))
+        return thing_ids
+
+    async def restore_many(self, items: t.Iterable[t.Tuple[int, dict]]):
+        items = list(items)
+        async with self.transaction():
+            await self.executemany(
+                self._restoresql,
+                [
+                    {
+                        "id": thing_id,
+                        "type": data.get(pt.TYPE_KEY),
+                        "data": self.codec.encode(data),
+                    }
+                    for thing_id, data in items
+                ],
+            )
+            await self.write_index(items)
+
+    async def write_index(self, items: t.Iterable[t.Tuple[int, dict]]):
+        # Replace the index rows of things whose type has indexed properties.
+        # Things of other types never get any, so we skip those entirely.
+        unindexed = []
+        rows = []
+        for thing_id, data in items:
+            names = pt.things.indexed_props(data.get(pt.TYPE_KEY))
+            if names:
+                unindexed.append({"id": thing_id})
+                for name in names:
+                    for value in index_values(data.get(name)):
+                        rows.append((name, value, thing_id))
+        if unindexed:
+            await self.executemany(self._unindexsql, unindexed)
+        if rows:
+            await self.executemany(self._indexsql, rows)
+
+    async def reindex(self, batch_size: int = 1000):
+        # Rebuild type columns and index rows, for rows written before their
+        # properties were indexed
+        rows = []
+        async for row in self.iterate(batch_size=batch_size):
+            rows.append(row)
+            if len(rows) >= batch_size:
+                await self._reindex(rows)
+                rows = []
+        if rows:
+            await self._reindex(rows)
+
+    async def _reindex(self, rows: t.List[t.Tuple[int, dict]]):
+        async with self.transaction():
+            await self.executemany(
+                f"UPDATE {self._tablename} SET type = :type WHERE id = :id",
+                [
+                    {"id": thing_id, "type": data.get(pt.TYPE_KEY)}
+                    for thing_id, data in rows
+                ],
+            )
+            await self.write_index(rows)
+
+    async def iterate(
+        self,
+        thing_types: t.Optional[t.Collection[str]] = None,
+        batch_size: int = 1000,
+        after: t.Optional[int] = None,
+    ) -> t.AsyncIterator[t.Tuple[int, dict]]:
+        # Page through the table by id rather than keep a cursor open, so no
+        # connection or read transaction is held between batches
+        sql = f"SELECT id, data FROM {self._tablename} WHERE id > :after"
+        params = {"after": 0 if after is None else after, "limit": batch_size}
+        if thing_types is not None:
+            names = [f"type{n}" for n in range(len(thing_types))]
+            sql += f" AND type IN ({', '.join(':' + name for name in names)})"
+            params.update(zip(names, thing_types))
+        sql += " ORDER BY id LIMIT :limit"
+        while True:
+            async with self.reading() as conn:
+                async with conn.execute(sql, params) as cursor:
+                    rows = await cursor.fetchall()
+            for thing_id, data in rows:
+                yield thing_id, self.codec.decode(data)
+            if len(rows) < batch_size:
+                break
+            params["after"] = rows[-1][0]
+
+    async def query(
+        self,
+        thing_types: t.Optional[t.Collection[str]],
+        conditions: t.Iterable[t.Tuple[str, str, t.Any]],
+        batch_size: int = 1000,
+    ) -> t.AsyncIterator[t.Tuple[int, dict]]:
+        conditions = list(conditions)
+        if not conditions:
+            async for row in self.iterate(thing_types, batch_size):
+                yield row
+            return
+        # Walk the index rows of one condition along their primary key, a
+        # range of values at a time, and page through each range by (value,
+        # id) so that every batch seeks to where the last one ended. The type
+        # and the other conditions are checked per row, through the index on
+        # id. Things come out in the order of the walked condition's values.
+        name, op, value = first = min(
+            conditions, key=lambda c: c[1] not in ("eq", "in")
         )
-        await self.commit()
-        await cursor.close()
+        where = []
+        params = []
+        if thing_types is not None:
+            where.append(f"t.type IN ({', '.join('?' * len(thing_types))})")
+            params.extend(thing_types)
+        for condition in conditions:
+            if condition is not first:
+                match, values = query_match("value", *condition[1:])
+                where.append(
+                    f"EXISTS (SELECT 1 FROM {self._indextable} "
+                    f"INDEXED BY {self._indextable}_id "
+                    f"WHERE id = i.id AND key = ? AND {match})"
+                )
+                params.extend([condition[0]] + values)
+        # A thing with several matching values of a list property is only
+        # returned for the lowest of them
+        match, values = query_match("d.value", op, value)
+        where.append(
+            f"NOT EXISTS (SELECT 1 FROM {self._indextable} AS d "
+            f"INDEXED BY {self._indextable}_id "
+            f"WHERE d.id = i.id AND d.key = i.key AND d.value < i.value AND {match})"
+        )
+        params.extend(values)
+        select = (
+            f"SELECT i.value, i.id, t.data FROM {self._indextable} AS i "
+            f"CROSS JOIN {self._tablename} AS t ON t.id = i.id WHERE "
+        )
+        order = " ORDER BY i.value, i.id LIMIT ?"
+        for low, high in query_ranges(op, value):
+            after = None
+            while True:
+                clauses = ["i.key = ?"]
+                page = [name]
+                if after is not None:
+                    clauses.append("(i.value, i.id) > (?, ?)")
+                    page.extend(after)
+                elif low is not None:
+                    clauses.append(f"i.value {low[0]} ?")
+                    page.append(low[1])
+                if high is not None:
+                    clauses.append(f"i.value {high[0]} ?")
+                    page.append(high[1])
+                sql = select + " AND ".join(clauses + where) + order
+                # No reader is held between batches, while the caller loads
+                # what the rows refer to
+                async with self.reading() as conn:
+                    async with conn.execute(
+                        sql, page + params + [batch_size]
+                    ) as cursor:
+                        rows = await cursor.fetchall()
+                for _, thing_id, data in rows:
+                    yield thing_id, self.codec.decode(data)
+                if len(rows) < batch_size:
+                    break
+                after = rows[-1][:2]
 
     async def delete(self, thing_id: int):
-        cursor = await self.execute(self._deletesql, id=thing_id)
-        await self.commit()
-        await cursor.close()
+        async with self.transaction():
+            cursor = await self.execute(self._deletesql, id=thing_id)
+            await cursor.close()
+            await self.executemany(self._unindexsql, [{"id": thing_id}])
 
     async def load(self, thing_id: int) -> t.Optional[dict]:
-        result = await self.fetchone(self._loadsql, id=thing_id)
-        return result and self.decoder.decode(result[0])
+        async with self.reading() as conn:
+            async with conn.execute(self._loadsql, {"id": thing_id}) as cursor:
+                result = await cursor.fetchone()
+        return result and self.codec.decode(result[0])
+
+    async def load_many(self, thing_ids: t.Sequence[int]) -> t.Dict[int, dict]:
+        result = {}
+        async with self.reading() as conn:
+            for start, stop in chunk_bounds(len(thing_ids), self.chunk_size):
+                chunk = list(thing_ids[start:stop])
+                # Pad to a power of two so that a few statements, which
+                # sqlite3 keeps prepared, cover all sizes
+                size = 1 << (len(chunk) - 1).bit_length()
+                chunk.extend(chunk[-1:] * (size - len(chunk)))
+                async with conn.execute(self.loadmanysql(size), chunk) as cursor:
+                    async for thing_id, data in cursor:
+                        result[thing_id] = self.codec.decode(data)
+        return result
+
+    def loadmanysql(self, size: int) -> str:
+        if size not in self._loadmanysql:
+            self._loadmanysql[size] = (
+                f"SELECT id, data FROM {self._tablename} "
+                f"WHERE id IN ({', '.join('?' * size)})"
+            )
+        return self._loadmanysql[size]
 
     async def clear(self):
-        cursor = await self.execute(self._clearsql)
-        await self.commit()
-        await cursor.close()
+        async with self.transaction():
+            cursor = await self.execute(self._clearsql)
+            await cursor.close()
+            cursor = await self.execute(self._clearindexsql)
+            await cursor.close()
 
     async def close(self):
+        if self._readers is not None:
+            while not self._readers.empty():
+                await self._readers.get_nowait().close()
         return await self._conn.close()
 
+    @contextlib.asynccontextmanager
+    async def transaction(self) -> t.AsyncIterator[None]:
+        # Writes inside a transaction are committed once when it exits. Other
+        # tasks wait for the lock, so they never end up in someone else's
+        # transaction.
+        active = _transactions.get()
+        if self in active:
+            yield
+            return
+        async with self._lock:
+            token = _transactions.set(active + (self,))
+            try:
+                yield
+            except BaseException:
+                await self._conn.rollback()
+                raise
+            else:
+                await self.commit()
+            finally:
+                _transactions.reset(token)
+
     async def initdb(self, tablename: str):
         await self.execute(
             f"""
             CREATE TABLE IF NOT EXISTS {tablename} (
                 id INTEGER PRIMARY KEY,
+                type TEXT,
                 data BLOB NOT NULL
             );
             """
         )
+        columns = [
+            row[1] async for row in self.fetchall(f"PRAGMA table_info({tablename})")
+        ]
+        if "type" not in columns:
+            # Tables from before types were stored
+            await self.execute(f"ALTER TABLE {tablename} ADD COLUMN type TEXT")
+        await self.execute(
+            f"CREATE INDEX IF NOT EXISTS {tablename}_type ON {tablename} (type)"
+        )
+        await self.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {self._indextable} (
+                key TEXT NOT NULL,
+                value,
+                id INTEGER NOT NULL,
+                PRIMARY KEY (key, value, id)
+            ) WITHOUT ROWID;
+            """
+        )
+        await self.execute(
+            f"CREATE INDEX IF NOT EXISTS {self._indextable}_id "
+            f"ON {self._indextable} (id)"
+        )
+        if "type" not in columns:
+            # Fill in the new type column and the index, or nothing filtered
+            # by type would find the existing rows
+            await self.reindex()
 
     async def execute(self, sql: str, **params) -> aiosqlite.cursor.Cursor:
         return await self._conn.execute(sql, params)
 
+    async def executemany(self, sql: str, params: t.Iterable[dict]):
+        cursor = await self._conn.executemany(sql, params)
+        await cursor.close()
+
     async def fetchall(self, sql: str, **params) -> t.AsyncIterator[sqlite3.Row]:
         cursor = await self.execute(sql, **params)
         async for row in cursor:
@@ -131,18 +578,82 @@ class SqliteBackend(ThingsBackend):
 
 
 class FileBackend(ThingsBackend):
-    def __init__(self, directory: t.Union[str, pathlib.Path]):
-        self.encoder = self.encoder_cls(indent=4)
-        self.decoder = self.decoder_cls()
+    id_type = str
+    # Files unlinked per executor job when clearing
+    chunk_size = 256
+
+    def __init__(
+        self,
+        directory: t.Union[str, pathlib.Path],
+        executor: t.Optional[concurrent.futures.Executor] = None,
+        shard_depth: int = 0,
+        shard_width: int = 2,
+        compact: bool = False,
+        codec: t.Optional[pt.Codec] = None,
+        sync: bool = True,
+    ):
+        if codec is not None:
+            self.codec = codec
+        elif compact:
+            self.codec = pt.JsonCodec(separators=(",", ":"))
+        else:
+            self.codec = pt.JsonCodec(indent=4)
         if isinstance(directory, str):
             self.directory = pathlib.Path(directory)
         else:
             self.directory = directory
         self.directory.mkdir(exist_ok=True)
+        self.executor = executor
+        # Things are stored shard_depth directories down, named by the first
+        # shard_width characters of the id per level
+        self.shard_depth = shard_depth
+        self.shard_width = shard_width
+        # Whether writes are fsynced before they replace the old file. Without
+        # it, a power loss may leave an empty or partial file in its place.
+        self.sync = sync
+        self._shards = set()
 
     @classmethod
-    async def connect(cls, directory: t.Union[str, pathlib.Path]) -> ThingsBackend:
-        return cls(directory)
+    async def connect(
+        cls,
+        directory: t.Union[str, pathlib.Path],
+        executor: t.Optional[concurrent.futures.Executor] = None,
+        shard_depth: int = 0,
+        shard_width: int = 2,
+        compact: bool = False,
+        codec: t.Optional[pt.Codec] = None,
+        sync: bool = True,
+    ) -> ThingsBackend:
+        return cls(
+            directory,
+            executor=executor,
+            shard_depth=shard_depth,
+            shard_width=shard_width,
+            compact=compact,
+            codec=codec,
+            sync=sync,
+        )
+
+    def path(self, thing_id: str) -> pathlib.Path:
+        directory = self.directory
+        for level in range(self.shard_depth):
+            start = level * self.shard_width
+            stop = start + self.shard_width
+            directory = directory / thing_id[start:stop]
+        return directory / thing_id
+
+    def iter_files(
+        self, directory: t.Optional[pathlib.Path] = None
+    ) -> t.Iterator[os.DirEntry]:
+        # Thing files in any layout, skipping temporary files
+        with os.scandir(directory or self.directory) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir():
+                    yield from self.iter_files(entry.path)
+                else:
+                    yield entry
 
     async def create(self, data: dict) -> str:
         thing_id = str(uuid.uuid4())
@@ -150,28 +661,994 @@ class FileBackend(ThingsBackend):
         return thing_id
 
     async def update(self, thing_id: str, data: dict):
-        file_path = self.directory / thing_id
+        # Encode on the loop, where the things being encoded live
+        await self.run(self.write, thing_id, self.codec.encode(data))
+
+    async def save_many(self, items: t.Iterable[t.Tuple[str, dict]]) -> t.List[str]:
+        thing_ids = []
+        encoded = []
+        for thing_id, data in items:
+            if thing_id is None:
+                thing_id = str(uuid.uuid4())
+            thing_ids.append(thing_id)
+            encoded.append(self.codec.encode(data))
+        await asyncio.gather(
+            *(self.run(self.write, i, e) for i, e in zip(thing_ids, encoded))
+        )
+        return thing_ids
+
+    def write(self, thing_id: str, encoded: t.Union[str, bytes]):
+        file_path = self.path(thing_id)
+        if self.shard_depth and file_path.parent not in self._shards:
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            self._shards.add(file_path.parent)
+        # Temporary files go in the top directory, where iteration skips them
+        replace_file(
+            file_path,
+            encoded.encode() if isinstance(encoded, str) else encoded,
+            self.directory,
+            self.sync,
+        )
+
+    def read(self, thing_id: str) -> t.Optional[dict]:
         try:
-            with open(file_path, "w") as fd:
-                for chunk in self.encoder.iterencode(data):
-                    fd.write(chunk)
-        except ValueError:
-            if file_path.is_file():
-                file_path.unlink()
-            raise
+            with open(self.path(thing_id), "rb") as fd:
+                return self.codec.decode(fd.read())
+        except FileNotFoundError:
+            return None
 
     async def delete(self, thing_id: str):
-        file_path = self.directory / thing_id
-        if file_path.is_file():
-            file_path.unlink()
+        await self.run(unlink, [self.path(thing_id)])
 
-    async def load(self, thing_id: int) -> t.Optional[str]:
-        with open(self.directory / thing_id, "r") as fd:
-            return self.decoder.decode(fd.read())
+    async def load(self, thing_id: str) -> t.Optional[dict]:
+        return await self.run(self.read, thing_id)
+
+    async def load_many(self, thing_ids: t.Sequence[str]) -> t.Dict[str, dict]:
+        loaded = await asyncio.gather(*(self.run(self.read, i) for i in thing_ids))
+        return {
+            thing_id: data
+            for thing_id, data in zip(thing_ids, loaded)
+            if data is not None
+        }
 
     async def clear(self):
-        for file_path in self.directory.glob("*"):
-            file_path.unlink()
+        file_paths = await self.run(lambda: [entry.path for entry in self.iter_files()])
+        await asyncio.gather(
+            *(
+                self.run(unlink, map(pathlib.Path, file_paths[start:stop]))
+                for start, stop in chunk_bounds(len(file_paths), self.chunk_size)
+            )
+        )
+        await self.run(self.prune)
+
+    async def migrate_layout(self, reencode: bool = False) -> int:
+        # Move things stored in another layout, such as an unsharded
+        # directory, to where this backend expects them. Returns the number
+        # of things moved or rewritten.
+        return await self.run(self._migrate_layout, reencode)
+
+    def _migrate_layout(self, reencode: bool) -> int:
+        count = 0
+        self._shards.clear()
+        for entry in list(self.iter_files()):
+            moved = pathlib.Path(entry.path) != self.path(entry.name)
+            if reencode:
+                with open(entry.path, "rb") as fd:
+                    data = self.codec.decode(fd.read())
+                self.write(entry.name, self.codec.encode(data))
+                if moved:
+                    os.unlink(entry.path)
+            elif moved:
+                self.path(entry.name).parent.mkdir(parents=True, exist_ok=True)
+                os.replace(entry.path, self.path(entry.name))
+            else:
+                continue
+            count += 1
+        self.prune()
+        return count
+
+    async def iterate(
+        self,
+        thing_types: t.Optional[t.Collection[str]] = None,
+        batch_size: int = 1000,
+        after: t.Optional[str] = None,
+    ) -> t.AsyncIterator[t.Tuple[str, dict]]:
+        # Files are not stored in id order, so after is ignored and the
+        # directory is always scanned from the start. The scan advances one
+        # batch per executor job, without listing the whole directory first.
+        files = self.iter_files()
+        try:
+            while True:
+                rows = await self.run(self.read_batch, files, batch_size)
+                if rows is None:
+                    break
+                for thing_id, data in rows:
+                    if thing_types is None or data.get(pt.TYPE_KEY) in thing_types:
+                        yield thing_id, data
+        finally:
+            files.close()
+
+    def read_batch(
+        self, files: t.Iterator[os.DirEntry], batch_size: int
+    ) -> t.Optional[t.List[t.Tuple[str, dict]]]:
+        entries = list(itertools.islice(files, batch_size))
+        if not entries:
+            return None
+        rows = []
+        for entry in entries:
+            try:
+                with open(entry.path, "rb") as fd:
+                    rows.append((entry.name, self.codec.decode(fd.read())))
+            except FileNotFoundError:
+                pass
+        return rows
+
+    def prune(self):
+        # Remove shard directories left empty
+        self._shards.clear()
+        for root, _, _ in os.walk(self.directory, topdown=False):
+            if root != str(self.directory) and not os.listdir(root):
+                os.rmdir(root)
 
     async def close(self):
         pass
+
+
+class MemoryBackend(ThingsBackend):
+    # Keeps things in a dict, encoded by the codec, or as plain copies when
+    # not encoded. With a snapshot_path, things are read from it when
+    # connecting and written to it every snapshot_interval seconds and when
+    # closing.
+    def __init__(
+        self,
+        codec: t.Optional[pt.Codec] = None,
+        encoded: bool = True,
+        snapshot_path: t.Union[str, pathlib.Path, None] = None,
+        snapshot_interval: t.Optional[float] = None,
+        executor: t.Optional[concurrent.futures.Executor] = None,
+    ):
+        super().__init__(codec)
+        self.encoded = encoded
+        if isinstance(snapshot_path, str):
+            snapshot_path = pathlib.Path(snapshot_path)
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.executor = executor
+        self.things = {}
+        self.next_id = 1
+
+    @classmethod
+    async def connect(
+        cls,
+        codec: t.Optional[pt.Codec] = None,
+        encoded: bool = True,
+        snapshot_path: t.Union[str, pathlib.Path, None] = None,
+        snapshot_interval: t.Optional[float] = None,
+        executor: t.Optional[concurrent.futures.Executor] = None,
+    ) -> ThingsBackend:
+        backend = cls(
+            codec=codec,
+            encoded=encoded,
+            snapshot_path=snapshot_path,
+            snapshot_interval=snapshot_interval,
+            executor=executor,
+        )
+        if snapshot_path is not None:
+            await backend.restore()
+        backend.start()
+        return backend
+
+    def store(self, data: dict) -> t.Any:
+        if self.encoded:
+            return self.codec.encode(data)
+        # Flattening copies, so later changes to the thing are not stored
+        return pt.codecs.flatten(data, set())
+
+    def fetch(self, stored: t.Any) -> dict:
+        if self.encoded:
+            return self.codec.decode(stored)
+        return pt.codecs.flatten(stored, set())
+
+    async def create(self, data: dict) -> int:
+        thing_id = self.next_id
+        self.next_id += 1
+        self.things[thing_id] = self.store(data)
+        return thing_id
+
+    async def update(self, thing_id: int, data: dict):
+        self.things[thing_id] = self.store(data)
+        if isinstance(thing_id, int):
+            self.next_id = max(self.next_id, thing_id + 1)
+
+    async def delete(self, thing_id: int):
+        self.things.pop(thing_id, None)
+
+    async def clear(self):
+        self.things.clear()
+        self.next_id = 1
+
+    async def load(self, thing_id: int) -> t.Optional[dict]:
+        stored = self.things.get(thing_id)
+        return None if stored is None else self.fetch(stored)
+
+    async def load_many(self, thing_ids: t.Sequence[int]) -> t.Dict[int, dict]:
+        return {
+            thing_id: self.fetch(self.things[thing_id])
+            for thing_id in thing_ids
+            if thing_id in self.things
+        }
+
+    async def iterate(
+        self,
+        thing_types: t.Optional[t.Collection[str]] = None,
+        batch_size: int = 1000,
+        after: t.Optional[int] = None,
+    ) -> t.AsyncIterator[t.Tuple[int, dict]]:
+        thing_ids = sorted(self.things)
+        start = 0 if after is None else bisect.bisect_right(thing_ids, after)
+        for n, thing_id in enumerate(itertools.islice(thing_ids, start, None), 1):
+            stored = self.things.get(thing_id)
+            if stored is not None:
+                data = self.fetch(stored)
+                if thing_types is None or data.get(pt.TYPE_KEY) in thing_types:
+                    yield thing_id, data
+            if n % batch_size == 0:
+                # Let other tasks run between batches
+                await asyncio.sleep(0)
+
+    async def snapshot(self):
+        # Stored values are never changed in place, so a shallow copy is a
+        # consistent snapshot to write in the executor
+        await self.run(self.write_snapshot, dict(self.things))
+
+    def write_snapshot(self, things: dict):
+        replace_file(
+            self.snapshot_path,
+            marshal.dumps(
+                {"encoded": self.encoded, "things": things},
+                pt.codecs.MARSHAL_VERSION,
+            ),
+        )
+
+    async def restore(self):
+        snapshot = await self.run(self.read_snapshot)
+        if snapshot is None:
+            return
+        things = snapshot["things"]
+        if snapshot["encoded"] != self.encoded:
+            # Written by a backend that stored things the other way
+            if snapshot["encoded"]:
+                things = {i: self.codec.decode(raw) for i, raw in things.items()}
+            else:
+                things = {i: self.codec.encode(data) for i, data in things.items()}
+        self.things = things
+        # Ids given by another tier, such as a FileBackend's, are not ours
+        int_ids = (thing_id for thing_id in things if isinstance(thing_id, int))
+        self.next_id = max(int_ids, default=0) + 1
+
+    def read_snapshot(self) -> t.Optional[dict]:
+        try:
+            with open(self.snapshot_path, "rb") as f:
+                return marshal.load(f)
+        except FileNotFoundError:
+            return None
+
+    def periodic(self) -> t.Optional[t.Tuple[float, t.Callable[[], t.Awaitable]]]:
+        if self.snapshot_path and self.snapshot_interval:
+            return self.snapshot_interval, self.snapshot
+        return None
+
+    async def close(self):
+        await self.stop()
+        if self.snapshot_path is not None:
+            await self.snapshot()
+
+
+class LogBackend(ThingsBackend):
+    # Things are appended to segment files as records: a header of the thing
+    # id, the size of its data and a checksum, followed by the encoded data.
+    # A record without data marks a deleted thing. The latest record of each
+    # thing is indexed in memory and read through mmap, and compaction drops
+    # the records that later ones have replaced.
+    RECORD = struct.Struct("<QII")
+    DELETED = 0xFFFFFFFF
+    HINT_NAME = "index.hint"
+    HINT_MAGIC = b"persisthing-hint-1\n"
+    HINT_ENTRY = struct.Struct("<QIQI")
+
+    def __init__(
+        self,
+        directory: t.Union[str, pathlib.Path],
+        executor: t.Optional[concurrent.futures.Executor] = None,
+        codec: t.Optional[pt.Codec] = None,
+        segment_size: int = 64 << 20,
+        sync: bool = False,
+        compact_interval: t.Optional[float] = None,
+        compact_ratio: float = 0.5,
+    ):
+        super().__init__(codec)
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(exist_ok=True)
+        self.executor = executor
+        # A new segment is started once the one appended to is this large
+        self.segment_size = segment_size
+        # Whether appends are fsynced before they count as written
+        self.sync = sync
+        # Compact every compact_interval seconds when at least compact_ratio
+        # of the stored bytes are records since replaced
+        self.compact_interval = compact_interval
+        self.compact_ratio = compact_ratio
+        # Thing id -> (segment, offset, size) of its data. Segments are keyed
+        # by tuples of ints, which order them oldest first.
+        self.index = {}
+        # Bytes per segment, and bytes of records since replaced
+        self.sizes = {}
+        self.garbage = collections.Counter()
+        self.next_id = 1
+        self._active = (1,)
+        self._file = None
+        self._maps = {}
+        self._lock = asyncio.Lock()
+        self._compacting = asyncio.Lock()
+
+    @classmethod
+    async def connect(
+        cls,
+        directory: t.Union[str, pathlib.Path],
+        executor: t.Optional[concurrent.futures.Executor] = None,
+        codec: t.Optional[pt.Codec] = None,
+        segment_size: int = 64 << 20,
+        sync: bool = False,
+        compact_interval: t.Optional[float] = None,
+        compact_ratio: float = 0.5,
+    ) -> ThingsBackend:
+        backend = cls(
+            directory,
+            executor=executor,
+            codec=codec,
+            segment_size=segment_size,
+            sync=sync,
+            compact_interval=compact_interval,
+            compact_ratio=compact_ratio,
+        )
+        await backend.run(backend.open)
+        backend.start()
+        return backend
+
+    def segment_path(self, key: t.Tuple[int, ...]) -> pathlib.Path:
+        return self.directory / (".".join(f"{n:08d}" for n in key) + ".log")
+
+    def segments(self) -> t.List[t.Tuple[int, ...]]:
+        keys = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".log") and not entry.name.startswith("."):
+                keys.append(tuple(int(n) for n in entry.name[:-4].split(".")))
+        return sorted(keys)
+
+    def open(self):
+        # Rebuild the index from the hint file and the records appended since
+        # it was written, or from all segments if it is missing or stale
+        segments = self.segments()
+        scanned = self.read_hint(segments)
+        if scanned is None:
+            scanned = {}
+            self.index = {}
+            self.sizes = {}
+            self.garbage = collections.Counter()
+        for key in segments:
+            self.scan(key, scanned.get(key, 0))
+        self.next_id = max(self.index, default=0) + 1
+        # Segments are never appended to after they were last opened
+        self._active = (segments[-1][0] + 1,) if segments else (1,)
+
+    def scan(self, key: t.Tuple[int, ...], offset: int):
+        path = self.segment_path(key)
+        total = path.stat().st_size
+        if offset < total:
+            with open(path, "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    while offset + self.RECORD.size <= total:
+                        thing_id, size, crc = self.RECORD.unpack_from(mm, offset)
+                        start = offset + self.RECORD.size
+                        stop = start + (0 if size == self.DELETED else size)
+                        if stop > total or crc != record_crc(
+                            thing_id, size, mm[start:stop]
+                        ):
+                            break
+                        self.apply(thing_id, key, start, size)
+                        offset = stop
+        if offset < total:
+            # Drop a record cut short by a crash
+            os.truncate(path, offset)
+        self.sizes[key] = offset
+
+    def apply(self, thing_id: int, key: t.Tuple[int, ...], offset: int, size: int):
+        old = self.index.pop(thing_id, None)
+        if old is not None:
+            self.garbage[old[0]] += self.RECORD.size + old[2]
+        if size == self.DELETED:
+            self.garbage[key] += self.RECORD.size
+        else:
+            self.index[thing_id] = (key, offset, size)
+
+    def read_hint(self, segments: t.List[t.Tuple[int, ...]]) -> t.Optional[dict]:
+        # The hint is usable if the segments it covers are all still there and
+        # at least as large, and any others are newer
+        try:
+            raw = (self.directory / self.HINT_NAME).read_bytes()
+        except FileNotFoundError:
+            return None
+        if not raw.startswith(self.HINT_MAGIC):
+            return None
+        newline = raw.index(b"\n", len(self.HINT_MAGIC))
+        start = len(self.HINT_MAGIC)
+        header = json.loads(raw[start:newline])
+        hinted = [(tuple(key), size) for key, size in header["segments"]]
+        keys = [key for key, _ in hinted]
+        if not set(keys) <= set(segments):
+            return None
+        if keys and any(key not in keys and key < keys[-1] for key in segments):
+            return None
+        for key, size in hinted:
+            if self.segment_path(key).stat().st_size < size:
+                return None
+        start = newline + 1
+        entries = memoryview(raw)[start:]
+        self.index = {
+            thing_id: (keys[n], offset, size)
+            for thing_id, n, offset, size in self.HINT_ENTRY.iter_unpack(entries)
+        }
+        self.sizes = dict(hinted)
+        self.garbage = collections.Counter(
+            {tuple(key): size for key, size in header["garbage"]}
+        )
+        return self.sizes.copy()
+
+    def write_hint(self, index: dict, sizes: dict, garbage: dict):
+        keys = sorted(sizes)
+        positions = {key: n for n, key in enumerate(keys)}
+        header = {
+            "segments": [[list(key), sizes[key]] for key in keys],
+            "garbage": [[list(key), size] for key, size in garbage.items()],
+        }
+        entries = b"".join(
+            self.HINT_ENTRY.pack(thing_id, positions[key], offset, size)
+            for thing_id, (key, offset, size) in index.items()
+        )
+        replace_file(
+            self.directory / self.HINT_NAME,
+            self.HINT_MAGIC + json.dumps(header).encode() + b"\n" + entries,
+        )
+
+    async def append(self, records: t.List[t.Tuple[int, t.Optional[bytes]]]):
+        async with self._lock:
+            key, offsets, end = await self.run(self.write, records)
+            # Sizes and the index only change here on the loop, and together,
+            # so a hint never covers records the index is missing
+            self.sizes[key] = end
+            for (thing_id, encoded), offset in zip(records, offsets):
+                size = self.DELETED if encoded is None else len(encoded)
+                self.apply(thing_id, key, offset, size)
+
+    def write(
+        self, records: t.List[t.Tuple[int, t.Optional[bytes]]]
+    ) -> t.Tuple[t.Tuple[int, ...], t.List[int], int]:
+        # Append records to the active segment, returning it, the offsets of
+        # their data and its new size
+        if self._file is None or self.sizes.get(self._active, 0) >= self.segment_size:
+            self.roll()
+        key = self._active
+        offset = self.sizes.get(key, 0)
+        chunks = []
+        offsets = []
+        for thing_id, encoded in records:
+            size = self.DELETED if encoded is None else len(encoded)
+            encoded = encoded or b""
+            chunks.append(
+                self.RECORD.pack(thing_id, size, record_crc(thing_id, size, encoded))
+            )
+            chunks.append(encoded)
+            offsets.append(offset + self.RECORD.size)
+            offset += self.RECORD.size + len(encoded)
+        self._file.write(b"".join(chunks))
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+        return key, offsets, offset
+
+    def roll(self):
+        if self._file is not None:
+            self._file.close()
+            self._active = (self._active[0] + 1,)
+        self._file = open(self.segment_path(self._active), "ab")
+
+    def seal(self):
+        # Close the segment appended to, so that compaction can take it
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._active = (self._active[0] + 1,)
+
+    def read(self, location: t.Tuple[t.Tuple[int, ...], int, int]) -> dict:
+        key, offset, size = location
+        stop = offset + size
+        mm = self._maps.get(key)
+        if mm is None or len(mm) < stop:
+            # Map the segment again if it has grown since it was mapped
+            if mm is not None:
+                mm.close()
+            with open(self.segment_path(key), "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[key] = mm
+        return self.codec.decode(mm[offset:stop])
+
+    def encode(self, data: dict) -> bytes:
+        encoded = self.codec.encode(data)
+        return encoded.encode() if isinstance(encoded, str) else encoded
+
+    async def create(self, data: dict) -> int:
+        return (await self.save_many([(None, data)]))[0]
+
+    async def update(self, thing_id: int, data: dict):
+        await self.save_many([(thing_id, data)])
+
+    async def save_many(self, items: t.Iterable[t.Tuple[int, dict]]) -> t.List[int]:
+        records = []
+        for thing_id, data in items:
+            if thing_id is None:
+                thing_id = self.next_id
+            self.next_id = max(self.next_id, thing_id + 1)
+            records.append((thing_id, self.encode(data)))
+        if records:
+            await self.append(records)
+        return [thing_id for thing_id, _ in records]
+
+    async def delete(self, thing_id: int):
+        if thing_id in self.index:
+            await self.append([(thing_id, None)])
+
+    # Reads copy from mapped segments, which is cheap enough to do on the loop
+
+    async def load(self, thing_id: int) -> t.Optional[dict]:
+        location = self.index.get(thing_id)
+        return None if location is None else self.read(location)
+
+    async def load_many(self, thing_ids: t.Sequence[int]) -> t.Dict[int, dict]:
+        result = {}
+        for thing_id in thing_ids:
+            location = self.index.get(thing_id)
+            if location is not None:
+                result[thing_id] = self.read(location)
+        return result
+
+    async def iterate(
+        self,
+        thing_types: t.Optional[t.Collection[str]] = None,
+        batch_size: int = 1000,
+        after: t.Optional[int] = None,
+    ) -> t.AsyncIterator[t.Tuple[int, dict]]:
+        thing_ids = sorted(self.index)
+        start = 0 if after is None else bisect.bisect_right(thing_ids, after)
+        for n, thing_id in enumerate(itertools.islice(thing_ids, start, None), 1):
+            location = self.index.get(thing_id)
+            if location is not None:
+                data = self.read(location)
+                if thing_types is None or data.get(pt.TYPE_KEY) in thing_types:
+                    yield thing_id, data
+            if n % batch_size == 0:
+                # Let other tasks run between batches
+                await asyncio.sleep(0)
+
+    async def compact(self) -> int:
+        # Rewrite the records still indexed from all but the segment being
+        # appended to into new segments, and remove the old ones. Writes only
+        # wait while the current segment is sealed. Returns the number of
+        # bytes reclaimed.
+        async with self._compacting:
+            async with self._lock:
+                await self.run(self.seal)
+            sealed = sorted(key for key in self.sizes if key < self._active)
+            if not sealed:
+                return 0
+            # Sorts after every sealed segment and before the next active one
+            major = self._active[0] - 1
+            live = sorted(
+                (location, thing_id)
+                for thing_id, location in self.index.items()
+                if location[0] <= sealed[-1]
+            )
+            moved, sizes = await self.run(self.rewrite, major, live)
+            for (old, thing_id), new in zip(live, moved):
+                if self.index.get(thing_id) == old:
+                    self.index[thing_id] = new
+                else:
+                    # Replaced or deleted while we were copying it
+                    self.garbage[new[0]] += self.RECORD.size + new[2]
+            reclaimed = 0
+            for key in sealed:
+                reclaimed += self.sizes.pop(key)
+                self.garbage.pop(key, None)
+                mm = self._maps.pop(key, None)
+                if mm is not None:
+                    mm.close()
+            self.sizes.update(sizes)
+            reclaimed -= sum(sizes.values())
+            await self.run(
+                self.write_hint,
+                dict(self.index),
+                dict(self.sizes),
+                dict(self.garbage),
+            )
+            await self.run(unlink, [self.segment_path(key) for key in sealed])
+            return reclaimed
+
+    def rewrite(
+        self, major: int, live: t.List[tuple]
+    ) -> t.Tuple[t.List[tuple], t.Dict[t.Tuple[int, ...], int]]:
+        moved = []
+        sizes = {}
+        maps = {}
+        out = None
+        out_key = None
+        try:
+            for (key, offset, size), thing_id in live:
+                if key not in maps:
+                    with open(self.segment_path(key), "rb") as f:
+                        maps[key] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                if out is None or sizes[out_key] >= self.segment_size:
+                    if out is not None:
+                        out.flush()
+                        os.fsync(out.fileno())
+                        out.close()
+                    out_key = (major, len(sizes))
+                    out = open(self.segment_path(out_key), "wb")
+                    sizes[out_key] = 0
+                stop = offset + size
+                encoded = maps[key][offset:stop]
+                crc = record_crc(thing_id, size, encoded)
+                out.write(self.RECORD.pack(thing_id, size, crc))
+                out.write(encoded)
+                moved.append((out_key, sizes[out_key] + self.RECORD.size, size))
+                sizes[out_key] += self.RECORD.size + size
+            if out is not None:
+                # Compacted records must be on disk before the old ones go
+                out.flush()
+                os.fsync(out.fileno())
+        finally:
+            if out is not None:
+                out.close()
+            for mm in maps.values():
+                mm.close()
+        return moved, sizes
+
+    def garbage_ratio(self) -> float:
+        total = sum(self.sizes.values())
+        return sum(self.garbage.values()) / total if total else 0.0
+
+    def periodic(self) -> t.Optional[t.Tuple[float, t.Callable[[], t.Awaitable]]]:
+        if self.compact_interval:
+            return self.compact_interval, self.autocompact
+        return None
+
+    async def autocompact(self):
+        if self.garbage_ratio() >= self.compact_ratio:
+            await self.compact()
+
+    async def clear(self):
+        async with self._compacting, self._lock:
+            await self.run(self.seal)
+            for mm in self._maps.values():
+                mm.close()
+            self._maps.clear()
+            paths = [self.segment_path(key) for key in self.segments()]
+            await self.run(unlink, paths + [self.directory / self.HINT_NAME])
+            self.index = {}
+            self.sizes = {}
+            self.garbage = collections.Counter()
+            self.next_id = 1
+
+    async def close(self):
+        await self.stop()
+        async with self._compacting, self._lock:
+            await self.run(self.seal)
+            await self.run(
+                self.write_hint,
+                dict(self.index),
+                dict(self.sizes),
+                dict(self.garbage),
+            )
+            for mm in self._maps.values():
+                mm.close()
+            self._maps.clear()
+
+
+class TieredBackend(ThingsBackend):
+    # Serves reads from a fast backend, such as a MemoryBackend, in front of
+    # a durable one, and fills it from the durable one on misses. Things are
+    # created in the durable tier, which hands out the ids. Updates are
+    # written through to both tiers or, with write_back, to the fast tier
+    # until flushed: every flush_interval seconds, once max_dirty things are
+    # waiting, before iterating or querying, and when closing.
+    def __init__(
+        self,
+        fast: ThingsBackend,
+        durable: ThingsBackend,
+        write_back: bool = False,
+        flush_interval: t.Optional[float] = None,
+        max_dirty: t.Optional[int] = None,
+    ):
+        super().__init__(durable.codec)
+        self.fast = fast
+        self.durable = durable
+        self.write_back = write_back
+        self.flush_interval = flush_interval
+        self.max_dirty = max_dirty
+        # Ids of things updated in the fast tier only
+        self.dirty = set()
+        self.hits = 0
+        self.misses = 0
+        self._flushing = asyncio.Lock()
+
+    @classmethod
+    async def connect(
+        cls,
+        fast: ThingsBackend,
+        durable: ThingsBackend,
+        write_back: bool = False,
+        flush_interval: t.Optional[float] = None,
+        max_dirty: t.Optional[int] = None,
+    ) -> ThingsBackend:
+        backend = cls(
+            fast,
+            durable,
+            write_back=write_back,
+            flush_interval=flush_interval,
+            max_dirty=max_dirty,
+        )
+        backend.start()
+        return backend
+
+    @property
+    def id_type(self) -> type:
+        return self.durable.id_type
+
+    async def create(self, data: dict) -> t.Any:
+        return (await self.save_many([(None, data)]))[0]
+
+    async def update(self, thing_id: t.Any, data: dict):
+        await self.save_many([(thing_id, data)])
+
+    async def save_many(self, items: t.Iterable[t.Tuple[t.Any, dict]]) -> t.List:
+        items = list(items)
+        if self.write_back:
+            created = [(None, data) for thing_id, data in items if thing_id is None]
+            new_ids = iter(await self.durable.save_many(created) if created else ())
+            thing_ids = [next(new_ids) if i is None else i for i, _ in items]
+            self.dirty.update(i for i, _ in items if i is not None)
+        else:
+            thing_ids = await self.durable.save_many(items)
+        await self.fast.restore_many(
+            [(thing_id, data) for thing_id, (_, data) in zip(thing_ids, items)]
+        )
+        if self.max_dirty is not None and len(self.dirty) >= self.max_dirty:
+            await self.flush()
+        return thing_ids
+
+    async def restore_many(self, items: t.Iterable[t.Tuple[t.Any, dict]]):
+        items = list(items)
+        await self.durable.restore_many(items)
+        await self.fast.restore_many(items)
+        self.dirty.difference_update(thing_id for thing_id, _ in items)
+
+    async def delete(self, thing_id: t.Any):
+        self.dirty.discard(thing_id)
+        await self.durable.delete(thing_id)
+        await self.fast.delete(thing_id)
+
+    async def clear(self):
+        self.dirty.clear()
+        await self.durable.clear()
+        await self.fast.clear()
+
+    async def load(self, thing_id: t.Any) -> t.Optional[dict]:
+        return (await self.load_many([thing_id])).get(thing_id)
+
+    async def load_many(self, thing_ids: t.Sequence[t.Any]) -> t.Dict[t.Any, dict]:
+        result = await self.fast.load_many(thing_ids)
+        missing = [thing_id for thing_id in thing_ids if thing_id not in result]
+        self.hits += len(thing_ids) - len(missing)
+        if missing:
+            self.misses += len(missing)
+            loaded = await self.durable.load_many(missing)
+            if loaded:
+                await self.fast.restore_many(list(loaded.items()))
+                result.update(loaded)
+        return result
+
+    async def iterate(
+        self,
+        thing_types: t.Optional[t.Collection[str]] = None,
+        batch_size: int = 1000,
+        after: t.Any = None,
+    ) -> t.AsyncIterator[t.Tuple[t.Any, dict]]:
+        # Only the durable tier has every thing
+        await self.flush()
+        async for row in self.durable.iterate(thing_types, batch_size, after):
+            yield row
+
+    async def query(
+        self,
+        thing_types: t.Optional[t.Collection[str]],
+        conditions: t.Iterable[t.Tuple[str, str, t.Any]],
+        batch_size: int = 1000,
+    ) -> t.AsyncIterator[t.Tuple[t.Any, dict]]:
+        await self.flush()
+        async for row in self.durable.query(thing_types, conditions, batch_size):
+            yield row
+
+    @contextlib.asynccontextmanager
+    async def transaction(self) -> t.AsyncIterator[None]:
+        async with self.durable.transaction():
+            yield
+
+    async def flush(self):
+        async with self._flushing:
+            dirty = self.dirty
+            self.dirty = set()
+            try:
+                if dirty:
+                    loaded = await self.fast.load_many(list(dirty))
+                    async with self.durable.transaction():
+                        await self.durable.save_many(list(loaded.items()))
+                await self.durable.flush()
+            except BaseException:
+                # Keep them for the next flush, along with any updated since
+                self.dirty |= dirty
+                raise
+
+    def periodic(self) -> t.Optional[t.Tuple[float, t.Callable[[], t.Awaitable]]]:
+        if self.write_back and self.flush_interval:
+            return self.flush_interval, self.flush
+        return None
+
+    async def close(self):
+        await self.stop()
+        await self.flush()
+        await self.fast.close()
+        await self.durable.close()
+
+
+QUERY_OPERATORS = {
+    "eq": "=",
+    "lt": "<",
+    "lte": "<=",
+    "gt": ">",
+    "gte": ">=",
+}
+
+
+MATCH_OPERATORS = {
+    "eq": operator.eq,
+    "lt": operator.lt,
+    "lte": operator.le,
+    "gt": operator.gt,
+    "gte": operator.ge,
+    "in": lambda value, values: value in values,
+}
+
+
+def matches(value: t.Any, op: str, target: t.Any) -> bool:
+    # Whether any indexed value of a property satisfies a query condition,
+    # for backends that scan rather than use an index
+    compare = MATCH_OPERATORS[op]
+    for item in index_values(value):
+        try:
+            if compare(item, target):
+                return True
+        except TypeError:
+            pass
+    return False
+
+
+def query_match(column: str, op: str, value: t.Any) -> t.Tuple[str, t.List[t.Any]]:
+    # SQL and parameters for a query condition on an index value column
+    if op == "in":
+        value = list(value)
+        return f"{column} IN ({', '.join('?' * len(value))})", value
+    return f"{column} {QUERY_OPERATORS[op]} ?", [value]
+
+
+def query_ranges(
+    op: str, value: t.Any
+) -> t.List[t.Tuple[t.Optional[t.Tuple[str, t.Any]], t.Optional[t.Tuple[str, t.Any]]]]:
+    # The (low, high) bounds of the ranges of index values a query condition
+    # matches, each an SQL operator and a value, or None if open
+    if op == "in":
+        # In the order SQLite sorts values: numbers, then text, then blobs
+        items = sorted(
+            set(value), key=lambda v: (isinstance(v, bytes), isinstance(v, str), v)
+        )
+        return [((">=", item), ("<=", item)) for item in items]
+    if op == "eq":
+        return [((">=", value), ("<=", value))]
+    if op in ("gt", "gte"):
+        return [((QUERY_OPERATORS[op], value), None)]
+    return [(None, (QUERY_OPERATORS[op], value))]
+
+
+def index_values(value: t.Any) -> t.Iterator[t.Any]:
+    # Indexed values of a property. References index as the referenced id,
+    # lists as each of their items.
+    if isinstance(value, (pt.BaseThing, pt.Reference)):
+        if value._id is not None:
+            yield value._id
+    elif isinstance(value, dict):
+        if pt.ID_KEY in value:
+            yield value[pt.ID_KEY]
+    elif isinstance(value, list):
+        for item in value:
+            if not isinstance(item, list):
+                yield from index_values(item)
+    elif value is not None:
+        yield value
+
+
+def replace_file(
+    path: pathlib.Path,
+    data: bytes,
+    directory: t.Optional[pathlib.Path] = None,
+    sync: bool = False,
+):
+    # Write data to a temporary file in directory, by default that of path,
+    # and move it in place, so that a crash never leaves a partially written
+    # file behind. With sync, data is on disk before it replaces the old file.
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory or path.parent, prefix=".", suffix=".tmp"
+    )
+    try:
+        with open(fd, "wb") as f:
+            f.write(data)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def unlink(file_paths: t.Iterable[pathlib.Path]):
+    for file_path in file_paths:
+        try:
+            file_path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def repeat(interval: float, func: t.Callable[[], t.Awaitable]) -> asyncio.Task:
+    # Await func every interval seconds in a task, until it is cancelled
+    async def loop():
+        while True:
+            await asyncio.sleep(interval)
+            await func()
+
+    return asyncio.create_task(loop())
+
+
+async def cancel(task: t.Optional[asyncio.Task]):
+    # Cancel task, if any, and wait for it to end
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+def record_crc(thing_id: int, size: int, encoded: bytes) -> int:
+    return zlib.crc32(encoded, zlib.crc32(struct.pack("<QI", thing_id, size)))
+
+
+def chunk_bounds(length: int, size: int) -> t.Iterator[t.Tuple[int, int]]:
+    for start in range(0, length, size):
+        yield start, min(start + size, length)
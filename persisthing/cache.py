@@ -0,0 +1,124 @@
+from __future__ import annotations
+import collections
+import sys
+import time
+import typing as t
+
+
+def approximate_size(thing: t.Any) -> int:
+    data = getattr(thing, "_data", None)
+    if data is None:
+        return sys.getsizeof(thing)
+    size = sys.getsizeof(thing) + sys.getsizeof(data)
+    for value in data.values():
+        size += sys.getsizeof(value)
+        if isinstance(value, list):
+            size += sum(map(sys.getsizeof, value))
+    return size
+
+
+class LRUCache:
+    def __init__(
+        self,
+        max_entries: t.Optional[int] = None,
+        max_bytes: t.Optional[int] = None,
+        ttl: t.Optional[float] = None,
+        sizeof: t.Callable[[t.Any], int] = approximate_size,
+        on_evict: t.Optional[t.Callable[[t.Any, t.Any], None]] = None,
+        clock: t.Callable[[], float] = time.monotonic,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.on_evict = [on_evict] if on_evict else []
+        self.clock = clock
+        # key -> (value, size, expiry time)
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: t.Any) -> bool:
+        return key in self.entries
+
+    def get(self, key: t.Any) -> t.Any:
+        entry = self.entries.get(key)
+        if entry is not None and self.ttl is not None and entry[2] <= self.clock():
+            self.evict(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: t.Any, value: t.Any):
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        now = self.clock() if self.ttl is not None else None
+        expires = now + self.ttl if self.ttl is not None else None
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[1]
+        self.entries[key] = (value, size, expires)
+        self.bytes += size
+        self.shrink()
+        if now is not None:
+            self.expire_oldest(now)
+
+    def pop(self, key: t.Any) -> t.Any:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        self.bytes -= entry[1]
+        return entry[0]
+
+    def evict(self, key: t.Any):
+        value = self.pop(key)
+        self.evictions += 1
+        for hook in self.on_evict:
+            hook(key, value)
+
+    def shrink(self):
+        while self.entries and (
+            (self.max_entries is not None and len(self.entries) > self.max_entries)
+            or (self.max_bytes is not None and self.bytes > self.max_bytes)
+        ):
+            self.evict(next(iter(self.entries)))
+
+    def expire_oldest(self, now: float):
+        # Entries are in order of use, which is mostly the order they expire
+        # in, so dropping expired ones from the front keeps a cache with only
+        # a ttl from growing without bound, without scanning it all
+        while self.entries:
+            key, (_, _, expires) = next(iter(self.entries.items()))
+            if expires > now:
+                break
+            self.evict(key)
+
+    def expire(self):
+        if self.ttl is None:
+            return
+        now = self.clock()
+        expired = [key for key, entry in self.entries.items() if entry[2] <= now]
+        for key in expired:
+            self.evict(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    @property
+    def stats(self) -> t.Dict[str, int]:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
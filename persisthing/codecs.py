@@ -0,0 +1,139 @@
+from __future__ import annotations
+import collections.abc
+import json
+import marshal
+import typing as t
+import zlib
+
+import persisthing as pt
+
+# Leading byte of encoded data that is not plain JSON text
+MARSHAL = b"\x01"
+MARSHAL_ZLIB = b"\x02"
+JSON_ZLIB = b"\x03"
+
+# marshal format version, stable since Python 3.4
+MARSHAL_VERSION = 4
+
+
+class ThingJsonEncoder(json.JSONEncoder):
+    def default(self, thing):
+        if isinstance(thing, pt.BaseThing):
+            if thing._id:
+                return {pt.ID_KEY: thing._id}
+            thing._data[pt.TYPE_KEY] = thing._type
+            thing._data[pt.VERSION_KEY] = thing._version
+            return thing._data
+        if isinstance(thing, pt.Reference):
+            return {pt.ID_KEY: thing._id}
+        if isinstance(thing, collections.abc.Mapping):
+            # The _data of compact things
+            return dict(thing)
+        return thing
+
+
+def decode(raw: t.Union[str, bytes]) -> dict:
+    # Decodes data written by any codec
+    if isinstance(raw, str):
+        return json.loads(raw)
+    tag = raw[:1]
+    if tag == MARSHAL:
+        return marshal.loads(memoryview(raw)[1:])
+    if tag == MARSHAL_ZLIB:
+        return marshal.loads(zlib.decompress(memoryview(raw)[1:]))
+    if tag == JSON_ZLIB:
+        return json.loads(zlib.decompress(memoryview(raw)[1:]))
+    return json.loads(raw)
+
+
+class Codec:
+    def __init__(self, compress_threshold: t.Optional[int] = None, level: int = 6):
+        # Encoded data larger than compress_threshold bytes is zlib compressed
+        self.compress_threshold = compress_threshold
+        self.level = level
+
+    def encode(self, data: dict) -> t.Union[str, bytes]:
+        raise NotImplementedError
+
+    def decode(self, raw: t.Union[str, bytes]) -> dict:
+        return decode(raw)
+
+    def compress(self, tag: bytes, raw: bytes) -> t.Optional[bytes]:
+        if self.compress_threshold is not None and len(raw) > self.compress_threshold:
+            return tag + zlib.compress(raw, self.level)
+        return None
+
+
+class JsonCodec(Codec):
+    encoder_cls = ThingJsonEncoder
+
+    def __init__(
+        self,
+        compress_threshold: t.Optional[int] = None,
+        level: int = 6,
+        **encoder_kwargs,
+    ):
+        super().__init__(compress_threshold, level)
+        self.encoder = self.encoder_cls(**encoder_kwargs)
+
+    def encode(self, data: dict) -> t.Union[str, bytes]:
+        encoded = self.encoder.encode(data)
+        if self.compress_threshold is not None:
+            return self.compress(JSON_ZLIB, encoded.encode()) or encoded
+        return encoded
+
+
+class BinaryCodec(Codec):
+    # Things are flattened to plain dicts and lists and written with marshal.
+    # marshal stores repeated interned strings, such as the _tp, _vn and _id
+    # keys, as back references to their first occurrence.
+
+    def encode(self, data: dict) -> bytes:
+        raw = marshal.dumps(flatten(data, set()), MARSHAL_VERSION)
+        return self.compress(MARSHAL_ZLIB, raw) or MARSHAL + raw
+
+
+SCALARS = frozenset((str, int, float, bool, type(None)))
+
+
+def flatten(value: t.Any, active: t.Set[int]) -> t.Any:
+    if type(value) in SCALARS:
+        return value
+    if isinstance(value, pt.BaseThing):
+        if value._id:
+            return {pt.ID_KEY: value._id}
+        value._data[pt.TYPE_KEY] = value._type
+        value._data[pt.VERSION_KEY] = value._version
+        value = value._data
+    elif isinstance(value, pt.Reference):
+        return {pt.ID_KEY: value._id}
+    if id(value) in active:
+        raise ValueError("Circular reference detected")
+    active.add(id(value))
+    try:
+        if isinstance(value, (dict, collections.abc.Mapping)):
+            return {
+                key if type(key) is str else flatten_key(key): (
+                    item if type(item) in SCALARS else flatten(item, active)
+                )
+                for key, item in value.items()
+            }
+        # Tuples come back as lists, as they do from JSON
+        if isinstance(value, (list, tuple)):
+            return [
+                item if type(item) in SCALARS else flatten(item, active)
+                for item in value
+            ]
+    finally:
+        active.discard(id(value))
+    raise TypeError(f"Object of type {type(value).__name__} cannot be encoded")
+
+
+def flatten_key(key: t.Any) -> str:
+    # Keys are stored as JSON would store them, so that things come back the
+    # same whichever codec wrote them
+    if type(key) in SCALARS:
+        return json.dumps(key)
+    raise TypeError(
+        f"keys must be str, int, float, bool or None, not {type(key).__name__}"
+    )
@@ -1,57 +1,563 @@
 from __future__ import annotations
+import asyncio
+import gzip
+import json
 import typing as t
 import weakref
 
 import persisthing as pt
 
+# First line of archives written by ThingsDB.export
+ARCHIVE_HEADER = {"format": "persisthing", "version": 1}
+GZIP_MAGIC = b"\x1f\x8b"
+
 
 class ThingsDB:
-    def __init__(self, backend: pt.ThingsBackend):
+    def __init__(
+        self,
+        backend: pt.ThingsBackend,
+        load_concurrency: int = 32,
+        lazy: bool = False,
+        lru: t.Optional[pt.LRUCache] = None,
+    ):
         self.backend = backend
+        # Keeps recently used things alive after game code lets go of them
+        self.lru = lru
+        # Levels of references to load with a thing by default, None for all
+        self.depth = 0 if lazy else None
         self.cache = weakref.WeakValueDictionary()
+        # Backend loads in flight, and loaded things whose references are
+        # still being resolved, by thing id
+        self._loading = {}
+        self._resolving = {}
+        self._load_semaphore = asyncio.Semaphore(load_concurrency)
+        # Things loaded that were stored at another version than their class
+        self.migrations = 0
 
     def create(self, thing_cls, **kwargs):
         return thing_cls(self, **kwargs)
 
-    async def save(self, thing: pt.BaseThing) -> t.Any:
+    def session(self, autoflush: t.Optional[float] = None) -> pt.Session:
+        return pt.Session(self, autoflush=autoflush)
+
+    def prepare(self, thing: pt.BaseThing):
         thing.set_db(self)
         thing._data[pt.TYPE_KEY] = thing._type
         thing._data[pt.VERSION_KEY] = thing._version
+
+    async def save(self, thing: pt.BaseThing) -> t.Any:
+        self.prepare(thing)
         if thing._id:
+            if not thing.has_changes():
+                return thing._id
             await self.backend.update(thing._id, thing._data)
         else:
             thing._id = await self.backend.create(thing._data)
-            self.cache[thing._id] = thing
+            self.remember(thing)
+        thing.mark_clean()
         return thing._id
 
-    async def load(self, thing_id: int, visited: set = None) -> pt.BaseThing:
-        if thing_id in self.cache:
-            return self.cache[thing_id]
-        data = await self.backend.load(thing_id)
-        if data is None:
-            raise pt.ThingDoesNotExistException()
-        thing = await self.from_data(data, visited)
-        thing._id = thing_id
-        self.cache[thing_id] = thing
+    async def save_many(self, things: t.Iterable[pt.BaseThing]):
+        created = []
+        updated = []
+        for thing in things:
+            self.prepare(thing)
+            if not thing._id:
+                created.append(thing)
+            elif thing.has_changes():
+                updated.append(thing)
+        try:
+            async with self.backend.transaction():
+                # Things created in an earlier wave get their ids before
+                # later waves are encoded, so these store references to them
+                # rather than inline copies
+                for wave in creation_waves(created):
+                    thing_ids = await self.backend.save_many(
+                        (None, thing._data) for thing in wave
+                    )
+                    for thing, thing_id in zip(wave, thing_ids):
+                        thing._id = thing_id
+                if updated:
+                    await self.backend.save_many(
+                        (thing._id, thing._data) for thing in updated
+                    )
+        except BaseException:
+            for thing in created:
+                thing._id = None
+            raise
+        for thing in created:
+            self.remember(thing)
+        for thing in created + updated:
+            thing.mark_clean()
+
+    async def load(
+        self,
+        thing_id: t.Any,
+        depth: t.Optional[int] = None,
+        fields: t.Optional[t.Collection[str]] = None,
+    ) -> pt.BaseThing:
+        return (await self.load_many([thing_id], depth=depth, fields=fields))[0]
+
+    async def load_many(
+        self,
+        thing_ids: t.Sequence,
+        depth: t.Optional[int] = None,
+        fields: t.Optional[t.Collection[str]] = None,
+        loaded: t.Optional[t.Dict[t.Any, dict]] = None,
+    ) -> t.List[pt.BaseThing]:
+        # References beyond depth levels, or outside the given fields, are left
+        # as pt.Reference to load later with BaseThing.fetch or by awaiting.
+        # Data already read from the backend can be passed as loaded.
+        if depth is None:
+            depth = self.depth
+        results = await self.fetch_many(thing_ids, loaded)
+        refs = []
+        owned = []
+        waiting = []
+        unique = dict(zip(thing_ids, results))
+        for thing_id, (thing, thing_refs) in unique.items():
+            if thing_refs is not None:
+                owned.append(thing)
+                refs.extend(thing_refs)
+            elif thing_id in self._resolving:
+                waiting.append(self._resolving[thing_id])
+        if fields is not None:
+            refs = self.select(refs, owned, fields)
+        if owned:
+            await self.resolve(refs, owned, depth)
+        if waiting:
+            await asyncio.gather(*(asyncio.shield(w) for w in waiting))
+        return [thing for thing, _ in results]
+
+    async def fetch_many(
+        self, thing_ids: t.Sequence, loaded: t.Optional[t.Dict[t.Any, dict]] = None
+    ) -> t.List[t.Tuple[pt.BaseThing, t.Optional[t.List[tuple]]]]:
+        # Returns each thing and, if this call loaded it from the backend, the
+        # references it holds. Resolving those is then up to the caller.
+        results = {}
+        waiting = {}
+        missing = []
+        for thing_id in dict.fromkeys(thing_ids):
+            thing = self.lookup(thing_id)
+            if thing is not None:
+                results[thing_id] = (thing, None)
+            elif thing_id in self._loading:
+                waiting[thing_id] = self._loading[thing_id]
+            else:
+                missing.append(thing_id)
+        if missing:
+            results.update(await self.fetch_missing(missing, loaded))
+        if waiting:
+            # Loads we share are cancelled with the task that started them,
+            # rather than with us, so we wait without cancelling them and
+            # start over for those that were
+            await asyncio.wait(waiting.values())
+            retry = []
+            for thing_id, future in waiting.items():
+                if future.cancelled():
+                    retry.append(thing_id)
+                else:
+                    results[thing_id] = (future.result(), None)
+            if retry:
+                results.update(zip(retry, await self.fetch_many(retry, loaded)))
+        return [results[thing_id] for thing_id in thing_ids]
+
+    async def fetch_missing(
+        self, thing_ids: t.List, loaded: t.Optional[t.Dict[t.Any, dict]] = None
+    ) -> t.Dict[t.Any, tuple]:
+        loop = asyncio.get_running_loop()
+        futures = {thing_id: loop.create_future() for thing_id in thing_ids}
+        self._loading.update(futures)
+        results = {}
+        try:
+            if loaded is None:
+                async with self._load_semaphore:
+                    loaded = await self.backend.load_many(thing_ids)
+            for thing_id in thing_ids:
+                if loaded.get(thing_id) is None:
+                    raise pt.ThingDoesNotExistException()
+                refs = []
+                thing = self.construct(loaded[thing_id], refs)
+                thing._id = thing_id
+                results[thing_id] = (thing, refs)
+        except BaseException as e:
+            for future in futures.values():
+                fail(future, e)
+            raise
+        finally:
+            for thing_id in thing_ids:
+                del self._loading[thing_id]
+        for thing_id, (thing, _) in results.items():
+            self.remember(thing)
+            self._resolving[thing_id] = loop.create_future()
+            futures[thing_id].set_result(thing)
+        return results
+
+    def select(
+        self,
+        refs: t.List[tuple],
+        things: t.List[pt.BaseThing],
+        fields: t.Collection[str],
+    ) -> t.List[tuple]:
+        containers = set()
+        for thing in things:
+            containers.add(id(thing._data))
+            for name in fields:
+                if isinstance(thing._data.get(name), list):
+                    containers.add(id(thing._data[name]))
+        selected = []
+        skipped = []
+        for ref in refs:
+            container, key, _ = ref
+            if id(container) in containers and (
+                isinstance(container, list) or key in fields
+            ):
+                selected.append(ref)
+            else:
+                skipped.append(ref)
+        self.defer(skipped)
+        return selected
+
+    def defer(self, refs: t.List[tuple]):
+        for container, key, thing_id in refs:
+            pt.things.replace(container, key, pt.Reference(self, thing_id))
+
+    async def resolve(
+        self,
+        refs: t.List[tuple],
+        owned: t.List[pt.BaseThing] = None,
+        depth: t.Optional[int] = None,
+    ):
+        # Load references level by level, one backend load per level. Things
+        # loaded here are owned by us and are marked resolved when we are done.
+        # For things owned by concurrent loads we wait until they are resolved.
+        owned = owned if owned is not None else []
+        foreign = []
+        level = 0
+        try:
+            while refs:
+                if depth is not None and level >= depth:
+                    self.defer(refs)
+                    break
+                level += 1
+                ids = list(dict.fromkeys(ref_id for _, _, ref_id in refs))
+                results = await self.fetch_many(ids)
+                loaded = {}
+                next_refs = []
+                for thing_id, (thing, thing_refs) in zip(ids, results):
+                    loaded[thing_id] = thing
+                    if thing_refs is not None:
+                        owned.append(thing)
+                        next_refs.extend(thing_refs)
+                    elif thing_id in self._resolving:
+                        foreign.append(thing_id)
+                for container, key, thing_id in refs:
+                    pt.things.replace(container, key, loaded[thing_id])
+                refs = next_refs
+        except BaseException:
+            for thing in owned:
+                self.forget(thing._id)
+            raise
+        finally:
+            for thing in owned:
+                resolved = self._resolving.pop(thing._id, None)
+                if resolved is not None:
+                    resolved.set_result(None)
+        waiting = [self._resolving[i] for i in foreign if i in self._resolving]
+        if waiting:
+            await asyncio.gather(*(asyncio.shield(w) for w in waiting))
+
+    async def query(
+        self,
+        thing_cls: type,
+        batch_size: int = 100,
+        depth: t.Optional[int] = None,
+        **filters,
+    ) -> t.AsyncIterator[pt.BaseThing]:
+        # Stream things of thing_cls, or its subclasses, matching filters on
+        # indexed properties, such as damage__gt=50 or container=room.
+        # Operators are eq (the default), lt, lte, gt, gte and in.
+        indexed = set()
+        thing_types = pt.things.get_subtypes(thing_cls)
+        for thing_type in thing_types:
+            indexed.update(pt.things.indexed_props(thing_type))
+        conditions = []
+        for key, value in filters.items():
+            name, _, op = key.partition("__")
+            if name not in indexed:
+                raise ValueError(f"{name} is not an indexed property")
+            if op not in ("", "eq", "lt", "lte", "gt", "gte", "in"):
+                raise ValueError(f"unknown query operator: {op}")
+            if op == "in":
+                value = [query_value(v) for v in value]
+            else:
+                value = query_value(value)
+            conditions.append((name, op or "eq", value))
+        rows = self.backend.query(thing_types, conditions, batch_size)
+        async for thing in self.load_stream(rows, batch_size, depth):
+            yield thing
+
+    async def iter_things(
+        self,
+        thing_cls: t.Optional[type] = None,
+        batch_size: int = 100,
+        depth: t.Optional[int] = None,
+    ) -> t.AsyncIterator[pt.BaseThing]:
+        # Stream all things, or those of thing_cls and its subclasses, a
+        # batch at a time so that memory use stays flat however many there are
+        thing_types = None
+        if thing_cls is not None:
+            thing_types = pt.things.get_subtypes(thing_cls)
+        rows = self.backend.iterate(thing_types, batch_size=batch_size)
+        async for thing in self.load_stream(rows, batch_size, depth):
+            yield thing
+
+    async def load_stream(
+        self,
+        rows: t.AsyncIterator[t.Tuple[t.Any, dict]],
+        batch_size: int,
+        depth: t.Optional[int] = None,
+    ) -> t.AsyncIterator[pt.BaseThing]:
+        batch = {}
+        async for thing_id, data in rows:
+            batch[thing_id] = data
+            if len(batch) >= batch_size:
+                for thing in await self.load_many(list(batch), depth, loaded=batch):
+                    yield thing
+                batch = {}
+        if batch:
+            for thing in await self.load_many(list(batch), depth, loaded=batch):
+                yield thing
+
+    def lookup(self, thing_id: t.Any) -> t.Optional[pt.BaseThing]:
+        if self.lru is not None:
+            thing = self.lru.get(thing_id)
+            if thing is not None:
+                return thing
+        thing = self.cache.get(thing_id)
+        if thing is not None and self.lru is not None:
+            self.lru.put(thing_id, thing)
         return thing
 
-    async def from_data(self, data: dict, visited: set = None) -> pt.BaseThing:
+    def remember(self, thing: pt.BaseThing):
+        self.cache[thing._id] = thing
+        if self.lru is not None:
+            self.lru.put(thing._id, thing)
+
+    def forget(self, thing_id: t.Any):
+        self.cache.pop(thing_id, None)
+        if self.lru is not None:
+            self.lru.pop(thing_id)
+
+    async def from_data(
+        self, data: dict, depth: t.Optional[int] = None
+    ) -> pt.BaseThing:
+        refs = []
+        thing = self.construct(data, refs)
+        await self.resolve(refs, depth=self.depth if depth is None else depth)
+        return thing
+
+    def construct(self, data: dict, refs: t.List[tuple]) -> pt.BaseThing:
         thing_cls = pt.get_thing_type(data[pt.TYPE_KEY])
-        version = data[pt.VERSION_KEY]
-        if version != thing_cls._version:
+        migrated = data[pt.VERSION_KEY] != thing_cls._version
+        if migrated:
+            self.migrations += 1
             data = thing_cls.migrate(data)
         thing = thing_cls(self, _data=data)
-        await thing.load_props(visited)
+        self.unpack(thing, refs)
+        thing.mark_clean()
+        if migrated:
+            # Write back the migrated data on next save
+            thing.mark_changed(pt.VERSION_KEY)
         return thing
 
+    def unpack(self, thing: pt.BaseThing, refs: t.List[tuple]):
+        # Construct inline things and collect the references left to load
+        for container, key, value in thing.iter_packed():
+            if pt.ID_KEY in value:
+                refs.append((container, key, value[pt.ID_KEY]))
+            else:
+                container[key] = self.construct(value, refs)
+
     async def delete(self, thing: pt.BaseThing):
         if thing._id:
             await self.backend.delete(thing._id)
+            self.forget(thing._id)
             thing._id = None
 
+    async def export(
+        self, stream: t.BinaryIO, compress: bool = False, batch_size: int = 1000
+    ) -> int:
+        # Write all stored things to stream as a header line followed by an
+        # [id, data] JSON line per thing, gzipped if compress. Returns the
+        # number of things written.
+        out = gzip.GzipFile(fileobj=stream, mode="wb") if compress else stream
+        count = 0
+        try:
+            out.write(archive_line(ARCHIVE_HEADER))
+            lines = []
+            async for row in self.backend.iterate(batch_size=batch_size):
+                lines.append(archive_line(row))
+                if len(lines) >= batch_size:
+                    out.write(b"".join(lines))
+                    count += len(lines)
+                    lines = []
+            out.write(b"".join(lines))
+            count += len(lines)
+        finally:
+            if compress:
+                out.close()
+        return count
+
+    async def import_(
+        self, stream: t.BinaryIO, remap_ids: bool = False, batch_size: int = 1000
+    ) -> t.Optional[t.Dict[t.Any, t.Any]]:
+        # Store the things in an archive written by export, a batch per
+        # transaction. Things keep their ids, replacing any stored under the
+        # same ids, unless remap_ids. Then they are created with new ids,
+        # such as when the archive comes from another kind of backend, and
+        # references between them are rewritten once they are all stored.
+        # Returns the mapping of old to new ids when remapping.
+        if peek(stream, len(GZIP_MAGIC)) == GZIP_MAGIC:
+            stream = gzip.GzipFile(fileobj=stream, mode="rb")
+        if json.loads(stream.readline() or "null") != ARCHIVE_HEADER:
+            raise ValueError("not a persisthing archive")
+        id_map = {} if remap_ids else None
+        # New ids of things with references to rewrite
+        linked = []
+        batch = []
+        for line in stream:
+            batch.append(json.loads(line))
+            if len(batch) >= batch_size:
+                await self.import_batch(batch, id_map, linked)
+                batch = []
+        if batch:
+            await self.import_batch(batch, id_map, linked)
+        for start, stop in pt.backends.chunk_bounds(len(linked), batch_size):
+            loaded = await self.backend.load_many(linked[start:stop])
+            async with self.backend.transaction():
+                await self.backend.save_many(
+                    [
+                        (thing_id, remap_refs(data, id_map))
+                        for thing_id, data in loaded.items()
+                    ]
+                )
+        return id_map
+
+    async def import_batch(
+        self,
+        batch: t.List[t.List[t.Any]],
+        id_map: t.Optional[t.Dict[t.Any, t.Any]],
+        linked: t.List[t.Any],
+    ):
+        if id_map is None:
+            id_type = self.backend.id_type
+            for thing_id, _ in batch:
+                if not isinstance(thing_id, id_type):
+                    raise ValueError(
+                        f"archive id {thing_id!r} is not a {id_type.__name__} "
+                        f"as {type(self.backend).__name__} ids are, import "
+                        "with remap_ids=True"
+                    )
+        async with self.backend.transaction():
+            if id_map is None:
+                await self.backend.restore_many(batch)
+                for thing_id, _ in batch:
+                    self.forget(thing_id)
+                return
+            thing_ids = await self.backend.save_many(
+                [(None, data) for _, data in batch]
+            )
+        for (old_id, data), thing_id in zip(batch, thing_ids):
+            id_map[old_id] = thing_id
+            if has_refs(data):
+                linked.append(thing_id)
+
     async def clear(self):
+        if self.lru is not None:
+            self.lru.clear()
         await self.backend.clear()
 
+    async def flush(self):
+        # Write anything the backend holds back through to durable storage
+        await self.backend.flush()
+
     async def close(self):
+        await self.flush()
         self.cache.clear()
+        if self.lru is not None:
+            self.lru.clear()
         return await self.backend.close()
+
+
+def query_value(value: t.Any) -> t.Any:
+    if isinstance(value, (pt.BaseThing, pt.Reference)):
+        if value._id is None:
+            raise ValueError("cannot query by unsaved thing")
+        return value._id
+    return value
+
+
+def fail(future: asyncio.Future, error: BaseException):
+    if isinstance(error, asyncio.CancelledError):
+        future.cancel()
+    else:
+        future.set_exception(error)
+        # Only concurrent loads of the same id care about the outcome
+        future.exception()
+
+
+def creation_waves(things: t.List[pt.BaseThing]) -> t.List[t.List[pt.BaseThing]]:
+    # Group new things so that things referenced by others are created in an
+    # earlier wave than the things referencing them
+    pending = {id(thing) for thing in things}
+    waves = {}
+    visiting = set()
+
+    def wave(thing) -> int:
+        key = id(thing)
+        if key in waves:
+            return waves[key]
+        if key in visiting or (thing._id and key not in pending):
+            return -1
+        visiting.add(key)
+        n = max((wave(ref) for ref in thing.iter_refs()), default=-1)
+        visiting.discard(key)
+        waves[key] = n + 1 if key in pending else n
+        return waves[key]
+
+    grouped = {}
+    for thing in things:
+        grouped.setdefault(wave(thing), []).append(thing)
+    return [grouped[n] for n in sorted(grouped)]
+
+
+def archive_line(value: t.Any) -> bytes:
+    return json.dumps(value, separators=(",", ":")).encode() + b"\n"
+
+
+def peek(stream: t.BinaryIO, size: int) -> bytes:
+    if hasattr(stream, "peek"):
+        return stream.peek(size)[:size]
+    position = stream.tell()
+    head = stream.read(size)
+    stream.seek(position)
+    return head
+
+
+def has_refs(value: t.Any) -> bool:
+    if isinstance(value, dict):
+        return pt.ID_KEY in value or any(map(has_refs, value.values()))
+    if isinstance(value, list):
+        return any(map(has_refs, value))
+    return False
+
+
+def remap_refs(value: t.Any, id_map: t.Dict[t.Any, t.Any]) -> t.Any:
+    if isinstance(value, dict):
+        if pt.ID_KEY in value:
+            return {pt.ID_KEY: id_map.get(value[pt.ID_KEY], value[pt.ID_KEY])}
+        return {key: remap_refs(item, id_map) for key, item in value.items()}
+    if isinstance(value, list):
+        return [remap_refs(item, id_map) for item in value]
+    return value
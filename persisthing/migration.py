@@ -0,0 +1,120 @@
+from __future__ import annotations
+import asyncio
+import collections
+import concurrent.futures
+import importlib
+import json
+import os
+import pathlib
+import typing as t
+
+import persisthing as pt
+
+
+async def migrate_all(
+    backend: pt.backends.ThingsBackend,
+    thing_cls: t.Optional[type] = None,
+    batch_size: int = 1000,
+    executor: t.Optional[concurrent.futures.Executor] = None,
+    max_pending: int = 4,
+    state_path: t.Optional[t.Union[str, pathlib.Path]] = None,
+    progress: t.Optional[t.Callable[[dict], t.Any]] = None,
+) -> dict:
+    # Migrate stored things of thing_cls and its subclasses, or of all known
+    # types, to their current version and write them back, so that loading
+    # them no longer has to. Batches are migrated in executor, a process
+    # pool by default, and written in one transaction each. With state_path,
+    # progress is saved after every batch and an interrupted run resumes
+    # where it left off. Returns, and passes progress after every batch, a
+    # dict of things scanned and migrated.
+    thing_types = None
+    if thing_cls is not None:
+        thing_types = pt.things.get_subtypes(thing_cls)
+    modules = sorted(
+        {
+            cls.__module__
+            for name, cls in pt.things.known_things.items()
+            if thing_types is None or name in thing_types
+        }
+    )
+    state = {"after": None, "scanned": 0, "migrated": 0}
+    if state_path is not None:
+        state_path = pathlib.Path(state_path)
+        if state_path.exists():
+            state.update(json.loads(state_path.read_text()))
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ProcessPoolExecutor()
+    loop = asyncio.get_running_loop()
+    # Batches being migrated, written back in the order they were read
+    pending = collections.deque()
+
+    async def write_back():
+        future, last_id, scanned = pending.popleft()
+        migrated = await future
+        if migrated:
+            async with backend.transaction():
+                await backend.save_many(migrated)
+        state["after"] = last_id
+        state["scanned"] += scanned
+        state["migrated"] += len(migrated)
+        if state_path is not None:
+            save_state(state_path, state)
+        if progress is not None:
+            progress(dict(state))
+
+    try:
+        batch = []
+        scanned = 0
+        last_id = None
+        rows = backend.iterate(thing_types, batch_size=batch_size, after=state["after"])
+        async for thing_id, data in rows:
+            scanned += 1
+            last_id = thing_id
+            if needs_migration(data):
+                batch.append((thing_id, data))
+            if scanned >= batch_size:
+                future = loop.run_in_executor(executor, migrate_batch, modules, batch)
+                pending.append((future, last_id, scanned))
+                batch = []
+                scanned = 0
+                if len(pending) >= max_pending:
+                    await write_back()
+        if scanned:
+            future = loop.run_in_executor(executor, migrate_batch, modules, batch)
+            pending.append((future, last_id, scanned))
+        while pending:
+            await write_back()
+    finally:
+        for future, _, _ in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(cancel_futures=True)
+    if state_path is not None:
+        # Done, so a later run starts over rather than resuming
+        state_path.unlink(missing_ok=True)
+    return state
+
+
+def needs_migration(data: dict) -> bool:
+    thing_cls = pt.things.known_things.get(data.get(pt.TYPE_KEY))
+    return thing_cls is not None and data.get(pt.VERSION_KEY) != thing_cls._version
+
+
+def migrate_batch(
+    modules: t.Iterable[str], batch: t.List[t.Tuple[t.Any, dict]]
+) -> t.List[t.Tuple[t.Any, dict]]:
+    # Runs in worker processes, which need the modules that define the thing
+    # classes imported to know them
+    for module in modules:
+        importlib.import_module(module)
+    return [
+        (thing_id, pt.things.known_things[data[pt.TYPE_KEY]].migrate(data))
+        for thing_id, data in batch
+    ]
+
+
+def save_state(state_path: pathlib.Path, state: dict):
+    tmp_path = state_path.with_name(f".{state_path.name}.tmp")
+    tmp_path.write_text(json.dumps(state))
+    os.replace(tmp_path, state_path)
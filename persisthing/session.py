@@ -0,0 +1,76 @@
+from __future__ import annotations
+import asyncio
+import typing as t
+
+import persisthing as pt
+
+
+class Session:
+    def __init__(self, db: pt.ThingsDB, autoflush: t.Optional[float] = None):
+        self.db = db
+        self.autoflush = autoflush
+        self.pending = {}
+        # Things being written by flush, which still count as pending
+        self.flushing = {}
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._error = None
+
+    def add(self, *things: pt.BaseThing):
+        for thing in things:
+            thing.set_db(self.db)
+            self.pending[id(thing)] = thing
+
+    def __contains__(self, thing: pt.BaseThing) -> bool:
+        return id(thing) in self.pending or id(thing) in self.flushing
+
+    def __len__(self) -> int:
+        return len(self.pending) + sum(
+            1 for i in self.flushing if i not in self.pending
+        )
+
+    async def flush(self):
+        async with self._lock:
+            if self._error is not None:
+                error, self._error = self._error, None
+                raise error
+            if not self.pending:
+                return
+            self.flushing = self.pending
+            self.pending = {}
+            things = list(self.flushing.values())
+            try:
+                await self.db.save_many(things)
+            except BaseException:
+                # Put back what we failed to write, unless re-added meanwhile
+                for thing in things:
+                    self.pending.setdefault(id(thing), thing)
+                raise
+            finally:
+                self.flushing = {}
+
+    async def _autoflush(self):
+        # Errors are raised by the next flush instead, and autoflushing waits
+        # until then
+        if self._error is None:
+            try:
+                await self.flush()
+            except Exception as e:
+                self._error = e
+
+    def start(self):
+        if self.autoflush and self._task is None:
+            self._task = pt.backends.repeat(self.autoflush, self._autoflush)
+
+    async def stop(self):
+        await pt.backends.cancel(self._task)
+        self._task = None
+
+    async def __aenter__(self) -> Session:
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+        if exc_type is None:
+            await self.flush()
@@ -1,6 +1,9 @@
 from __future__ import annotations
+import array
+import collections.abc
 import operator
 import typing as t
+import weakref
 
 import persisthing as pt
 
@@ -8,26 +11,137 @@ import persisthing as pt
 DEFAULT_NONE = object()
 
 known_things = {}
+indexed_cache = {}
+migration_cache = {}
+# Whether property setters check the types of values
+typechecks_enabled = True
+# Properties with accessors generated for them, and those still waiting for
+# the thing type they name to be registered
+compiled_props = weakref.WeakSet()
+unresolved_props = weakref.WeakSet()
 
 
-def thing(thing_type: str) -> t.Callable:
+def thing(thing_type: str, compact: bool = False) -> t.Callable:
     def decorator(thing_cls: type) -> type:
         if thing_type in known_things:
             raise RuntimeError(f"ambiguous thing type: {thing_type}")
+        if compact:
+            thing_cls = compact_class(thing_cls)
         known_things[thing_type] = thing_cls
         thing_cls._type = thing_type
+        for prop in list(unresolved_props):
+            prop.compile()
         return thing_cls
 
     return decorator
 
 
+def compact_class(thing_cls: type) -> type:
+    # Rebuild thing_cls with empty __slots__, so that its instances have no
+    # __dict__. Classes whose properties are all ints also keep their data
+    # in an array rather than a dict.
+    for base in thing_cls.__mro__[1:]:
+        if "__slots__" not in vars(base) and base is not object:
+            raise TypeError(f"{base.__name__} is not compact")
+    props = {}
+    for cls in reversed(thing_cls.__mro__):
+        for name, attr in vars(cls).items():
+            if isinstance(attr, Property):
+                props[name] = attr
+    namespace = dict(vars(thing_cls))
+    namespace.pop("__dict__", None)
+    namespace.pop("__weakref__", None)
+    namespace["__slots__"] = ()
+    if props and all(
+        prop.proptype_ is int and not prop.volatile for prop in props.values()
+    ):
+        namespace["_mapping"] = IntData.layout(tuple(props) + (pt.VERSION_KEY,))
+    compact_cls = type(thing_cls)(thing_cls.__name__, thing_cls.__bases__, namespace)
+    # Methods that use super() without arguments find their class through a
+    # __class__ cell, which still holds the class we replaced
+    for attr in namespace.values():
+        if isinstance(attr, (classmethod, staticmethod)):
+            attr = attr.__func__
+        funcs = [attr]
+        if isinstance(attr, property):
+            funcs = [attr.fget, attr.fset, attr.fdel]
+        for func in funcs:
+            for cell in getattr(func, "__closure__", None) or ():
+                try:
+                    if cell.cell_contents is thing_cls:
+                        cell.cell_contents = compact_cls
+                except ValueError:
+                    # Empty cell
+                    pass
+    return compact_cls
+
+
+def set_typechecks(enabled: bool):
+    # Typechecks catch bugs, but cost an isinstance call on every set
+    global typechecks_enabled
+    typechecks_enabled = enabled
+    for prop in list(compiled_props):
+        prop.compile()
+
+
 def get_thing_type(name):
     return known_things.get(name)
 
 
+def get_subtypes(thing_cls: type) -> t.List[str]:
+    return [name for name, cls in known_things.items() if issubclass(cls, thing_cls)]
+
+
+def indexed_props(thing_type: t.Optional[str]) -> t.Tuple[str, ...]:
+    thing_cls = known_things.get(thing_type)
+    if thing_cls is None:
+        return ()
+    if thing_cls not in indexed_cache:
+        names = {}
+        for cls in reversed(thing_cls.__mro__):
+            for name, attr in vars(cls).items():
+                if isinstance(attr, Property):
+                    names[name] = attr.indexed and not attr.volatile
+        indexed_cache[thing_cls] = tuple(n for n, indexed in names.items() if indexed)
+    return indexed_cache[thing_cls]
+
+
+def migration_chain(
+    thing_cls: type, from_version: int, to_version: int
+) -> t.Tuple[t.Tuple[t.Callable, int], ...]:
+    # The (hook, version) steps that migrate data of thing_cls between two
+    # versions, leaving out hooks the class does not override
+    key = (thing_cls, from_version, to_version)
+    if key not in migration_cache:
+        steps = []
+        upgrade = thing_cls.upgrade_to.__func__ is not BaseThing.upgrade_to.__func__
+        downgrade = (
+            thing_cls.downgrade_from.__func__ is not BaseThing.downgrade_from.__func__
+        )
+        if from_version < to_version and upgrade:
+            for version in range(from_version + 1, to_version + 1):
+                steps.append((thing_cls.upgrade_to, version))
+        elif from_version > to_version and downgrade:
+            for version in range(from_version, to_version, -1):
+                steps.append((thing_cls.downgrade_from, version))
+        migration_cache[key] = tuple(steps)
+    return migration_cache[key]
+
+
 class BaseThing:
+    __slots__ = (
+        "_db",
+        "_id",
+        "_data",
+        "_volatile",
+        "_changed",
+        "_inline",
+        "__weakref__",
+    )
     _type = None
     _version = 1
+    # Mapping type for _data, for compact things that do not use a dict
+    _mapping = None
 
     def __init__(
         self,
@@ -38,8 +152,15 @@ class BaseThing:
     ):
         self._db = _db
         self._id = _id
-        self._data = _data or {}
-        self._volatile = {}
+        if self._mapping is None:
+            self._data = _data or {}
+        else:
+            self._data = self._mapping(_data or ())
+        # Allocated when first needed, as most things have no volatile
+        # properties set and stay clean
+        self._volatile = None
+        self._changed = ()
+        self._inline = ()
         for k, v in kwargs.items():
             setattr(self, k, v)
 
@@ -64,42 +185,91 @@ class BaseThing:
     async def clear(self):
         await self._data.clear()
 
-    async def load_props(self, visited=None):
+    @property
+    def is_dirty(self) -> bool:
+        return self._id is None or self.has_changes()
+
+    def has_changes(self, visited: t.Optional[set] = None) -> bool:
+        if self._changed:
+            return True
+        # An inline thing that has since been saved on its own is now stored
+        # as a reference, which changes how we are encoded
+        for ref in self._inline:
+            if ref._id is not None:
+                return True
         if visited is None:
             visited = set()
-        elif self in visited:
-            return
-        visited.add(self)
+        visited.add(id(self))
+        for ref in self.iter_refs():
+            if ref._id is None and id(ref) not in visited:
+                if ref.has_changes(visited):
+                    return True
+        return False
+
+    def mark_changed(self, name: str):
+        if self._changed:
+            self._changed.add(name)
+        else:
+            self._changed = {name}
+
+    def mark_clean(self):
+        self._changed = ()
+        self._inline = tuple(ref for ref in self.iter_refs() if ref._id is None)
+        for ref in self._inline:
+            if ref is not self:
+                ref.mark_clean()
+
+    def iter_refs(self) -> t.Iterator[BaseThing]:
+        for value in self._data.values():
+            if isinstance(value, BaseThing):
+                yield value
+            elif isinstance(value, list):
+                for item in value:
+                    if isinstance(item, BaseThing):
+                        yield item
+
+    def iter_packed(self) -> t.Iterator[t.Tuple[t.Any, t.Any, dict]]:
+        # Yield (container, key, value) for every reference or inline thing
+        # in _data that has not been loaded yet
         for key, value in self._data.items():
             if isinstance(value, dict):
-                if pt.ID_KEY in value:
-                    self._data[key] = await self._db.load(
-                        value[pt.ID_KEY], visited=visited
-                    )
-                else:
-                    self._data[key] = await self._db.from_data(value, visited=visited)
+                if pt.ID_KEY in value or pt.TYPE_KEY in value:
+                    yield self._data, key, value
+            elif isinstance(value, list):
+                for i, item in enumerate(value):
+                    if isinstance(item, dict):
+                        if pt.ID_KEY in item or pt.TYPE_KEY in item:
+                            yield value, i, item
+
+    async def load_props(self, depth: t.Optional[int] = None):
+        refs = []
+        self._db.unpack(self, refs)
+        await self._db.resolve(refs, depth=self._db.depth if depth is None else depth)
+
+    async def fetch(self, *names: str) -> t.Any:
+        # Load the things behind any references left unloaded in the named
+        # properties (all properties if none are named)
+        refs = []
+        for name in names or list(self._data):
+            value = self._data.get(name)
+            if isinstance(value, Reference):
+                refs.append((self._data, name, value._id))
             elif isinstance(value, list):
-                for i in range(len(value)):
-                    if isinstance(value[i], dict):
-                        if pt.ID_KEY in value[i]:
-                            value[i] = await self._db.load(
-                                value[i][pt.ID_KEY], visited=visited
-                            )
-                        elif pt.TYPE_KEY in value[i]:
-                            value[i] = await self._db.from_data(
-                                value[i], visited=visited
-                            )
+                for i, item in enumerate(value):
+                    if isinstance(item, Reference):
+                        refs.append((value, i, item._id))
+        if refs:
+            things = await self._db.load_many([ref_id for _, _, ref_id in refs])
+            for (container, key, _), thing in zip(refs, things):
+                replace(container, key, thing)
+        if len(names) == 1:
+            return getattr(self, names[0])
+        return [getattr(self, name) for name in names] if names else self
 
     @classmethod
     def migrate(cls, data):
-        version = data[pt.VERSION_KEY]
-        while version != cls._version:
-            if version < cls._version:
-                version += 1
-                data = cls.upgrade_to(data, version)
-            else:
-                data = cls.downgrade_from(data, version)
-                version -= 1
+        for hook, version in migration_chain(cls, data[pt.VERSION_KEY], cls._version):
+            data = hook(data, version)
         data[pt.VERSION_KEY] = cls._version
         return data
 
@@ -112,19 +282,71 @@ class BaseThing:
         return data
 
 
+class Reference:
+    # Stands in for a thing that has not been loaded. Await it to load it.
+    __slots__ = ("_db", "_id")
+
+    def __init__(self, _db: pt.ThingsDB, _id: t.Any):
+        self._db = _db
+        self._id = _id
+
+    def __await__(self) -> t.Generator[t.Any, None, BaseThing]:
+        return self._db.load(self._id).__await__()
+
+    def __eq__(self, other: t.Any) -> bool:
+        if isinstance(other, Reference):
+            return self._db is other._db and self._id == other._id
+        return NotImplemented
+
+    def __hash__(self) -> int:
+        return hash(self._id)
+
+    def __repr__(self) -> str:
+        return f"<Reference {self._id!r}>"
+
+
+def replace(container: t.Union[dict, list], key: t.Any, value: t.Any):
+    # Swap in a loaded thing without marking the owner as changed
+    if isinstance(container, list):
+        list.__setitem__(container, key, value)
+    else:
+        container[key] = value
+
+
 class Property:
     def __init__(
         self,
         proptype: t.Union[str, type, None] = None,
         default: t.Any = DEFAULT_NONE,
         volatile: bool = False,
+        indexed: bool = False,
     ):
         self.proptype_ = proptype
         self.default = default
-        self.get_data = operator.attrgetter("_volatile" if volatile else "_data")
+        self.volatile = volatile
+        self.indexed = indexed
+        self.get_data = volatile_data if volatile else operator.attrgetter("_data")
 
     def __set_name__(self, owner: type, name: str):
         self.name = name
+        self.compile()
+
+    def compile(self):
+        # Swap in a class with accessors generated for this property, once
+        # its type is known
+        base = getattr(type(self), "base_class", type(self))
+        if base.__get__ is not Property.__get__ or base.__set__ is not Property.__set__:
+            return
+        if isinstance(self.proptype_, str) and self.proptype_ not in known_things:
+            unresolved_props.add(self)
+            return
+        unresolved_props.discard(self)
+        self.__class__ = type(
+            base.__name__,
+            (base,),
+            dict(generate_accessors(self), base_class=base),
+        )
+        compiled_props.add(self)
 
     def __get__(self, instance: BaseThing, owner: type = None) -> t.Any:
         if instance is None:
@@ -135,29 +357,263 @@ class Property:
                 self.get_data(instance)[self.name] = self.default
             else:
                 self.get_data(instance)[self.name] = self.proptype()
-        return self.get_data(instance)[self.name]
+        value = self.get_data(instance)[self.name]
+        if type(value) is list and not self.volatile:
+            # Track in-place changes to lists
+            value = TrackedList(instance, self.name, value)
+            self.get_data(instance)[self.name] = value
+        return value
 
     def __set__(self, instance: BaseThing, value: t.Any):
-        self.get_data(instance)[self.name] = self.typecheck(value)
+        value = self.typecheck(value)
+        if isinstance(value, TrackedList) and not self.volatile:
+            # Copy lists tracked for another thing or property, or changing
+            # them would mark that one changed instead
+            if value._owner() is not instance or value._name != self.name:
+                value = TrackedList(instance, self.name, value)
+        self.get_data(instance)[self.name] = value
+        if not self.volatile:
+            instance.mark_changed(self.name)
 
     def __delete__(self, instance: BaseThing):
         try:
             del self.get_data(instance)[self.name]
         except KeyError:
             pass
+        else:
+            if not self.volatile:
+                instance.mark_changed(self.name)
 
     @property
     def proptype(self) -> t.Optional[type]:
         if isinstance(self.proptype_, str):
-            self.proptype_ = get_thing_type(self.proptype_)
+            # Keep the name until a thing type by that name is registered
+            return get_thing_type(self.proptype_)
         return self.proptype_
 
     def typecheck(self, value: t.Any) -> t.Any:
         t = self.proptype
-        if t is None:
+        if t is None or not typechecks_enabled:
             return value
         if value is None and self.default is None:
             return value
-        if isinstance(value, t):
+        if isinstance(value, (t, Reference)):
             return value
         raise ValueError(f"{self.name} must be of type {t}")
+
+
+def generate_accessors(prop: Property) -> t.Dict[str, t.Callable]:
+    # Generate __get__ and __set__ for prop, with its name, type and default
+    # as constants, and without the branches that do not apply to it
+    proptype = prop.proptype
+    namespace = {
+        "name": prop.name,
+        "default": prop.default,
+        "factory": proptype,
+        "types": (proptype, Reference),
+        "TrackedList": TrackedList,
+    }
+    if prop.volatile:
+        data = [
+            "data = instance._volatile",
+            "if data is None:",
+            "    data = instance._volatile = {}",
+        ]
+    else:
+        data = ["data = instance._data"]
+    get = [
+        "def __get__(self, instance, owner=None):",
+        "    if instance is None:",
+        "        return self",
+        *(f"    {line}" for line in data),
+        "    try:",
+        "        value = data[name]",
+        "    except KeyError:",
+    ]
+    if prop.default is not DEFAULT_NONE:
+        get.append("        value = data[name] = default")
+    else:
+        get.append("        value = data[name] = factory()")
+    # Typechecked properties of other types than list never hold one
+    tracked = not prop.volatile and (
+        proptype is None
+        or issubclass(proptype, list)
+        or isinstance(prop.default, list)
+        or not typechecks_enabled
+    )
+    if tracked:
+        get.extend(
+            [
+                "    if type(value) is list:",
+                "        value = data[name] = TrackedList(instance, name, value)",
+            ]
+        )
+    get.append("    return value")
+    set_ = ["def __set__(self, instance, value):"]
+    if proptype is not None and typechecks_enabled:
+        check = "isinstance(value, types)"
+        if prop.default is None:
+            check = f"value is None or {check}"
+        set_.extend(
+            [
+                f"    if not ({check}):",
+                '        raise ValueError(f"{name} must be of type {factory}")',
+            ]
+        )
+    if tracked:
+        set_.extend(
+            [
+                "    if type(value) is TrackedList and (",
+                "        value._owner() is not instance or value._name != name",
+                "    ):",
+                "        value = TrackedList(instance, name, value)",
+            ]
+        )
+    set_.extend(f"    {line}" for line in data)
+    set_.append("    data[name] = value")
+    if not prop.volatile:
+        set_.append("    instance.mark_changed(name)")
+    exec("\n".join(get + set_), namespace)
+    return {"__get__": namespace["__get__"], "__set__": namespace["__set__"]}
+
+
+def volatile_data(instance: BaseThing) -> dict:
+    if instance._volatile is None:
+        instance._volatile = {}
+    return instance._volatile
+
+
+class TrackedList(list):
+    def __init__(self, owner: BaseThing, name: str, items: t.Iterable = ()):
+        super().__init__(items)
+        self._owner = weakref.ref(owner)
+        self._name = name
+
+    def _changed(self):
+        owner = self._owner()
+        if owner is not None:
+            owner.mark_changed(self._name)
+
+
+class IntData(collections.abc.MutableMapping):
+    # _data of compact things whose properties are all ints. Property values
+    # are kept in the ints array, with a bit set in present for each value that is
+    # set. Other keys, and values that do not fit, go in a dict.
+    __slots__ = ("ints", "present", "thing_type", "extra")
+    names = ()
+    positions = {}
+
+    @classmethod
+    def layout(cls, names: t.Tuple[str, ...]) -> type:
+        return type(
+            cls.__name__,
+            (cls,),
+            {
+                "__slots__": (),
+                "names": names,
+                "positions": {name: i for i, name in enumerate(names)},
+            },
+        )
+
+    def __init__(self, data: t.Any = ()):
+        self.ints = array.array("q", bytes(8 * len(self.names)))
+        self.present = 0
+        self.thing_type = None
+        self.extra = None
+        self.update(data)
+
+    def __contains__(self, key: t.Any) -> bool:
+        i = self.positions.get(key)
+        if i is not None and self.present >> i & 1:
+            return True
+        if key == pt.TYPE_KEY and self.thing_type is not None:
+            return True
+        return self.extra is not None and key in self.extra
+
+    def __getitem__(self, key: t.Any) -> t.Any:
+        i = self.positions.get(key)
+        if i is not None and self.present >> i & 1:
+            return self.ints[i]
+        if key == pt.TYPE_KEY and self.thing_type is not None:
+            return self.thing_type
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key: t.Any, value: t.Any):
+        self.discard(key)
+        i = self.positions.get(key)
+        if i is not None and type(value) is int:
+            try:
+                self.ints[i] = value
+            except OverflowError:
+                pass
+            else:
+                self.present |= 1 << i
+                return
+        if key == pt.TYPE_KEY and type(value) is str:
+            self.thing_type = value
+            return
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def __delitem__(self, key: t.Any):
+        if not self.discard(key):
+            raise KeyError(key)
+
+    def discard(self, key: t.Any) -> bool:
+        i = self.positions.get(key)
+        if i is not None and self.present >> i & 1:
+            self.present &= ~(1 << i)
+            return True
+        if key == pt.TYPE_KEY and self.thing_type is not None:
+            self.thing_type = None
+            return True
+        if self.extra is not None and key in self.extra:
+            del self.extra[key]
+            return True
+        return False
+
+    def __iter__(self) -> t.Iterator[t.Any]:
+        for i, name in enumerate(self.names):
+            if self.present >> i & 1:
+                yield name
+        if self.thing_type is not None:
+            yield pt.TYPE_KEY
+        if self.extra is not None:
+            yield from self.extra
+
+    def __len__(self) -> int:
+        size = bin(self.present).count("1") + (self.thing_type is not None)
+        return size + len(self.extra or ())
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+
+def _tracked(method: t.Callable) -> t.Callable:
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self._changed()
+        return result
+
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+
+for _name in (
+    "__setitem__",
+    "__delitem__",
+    "__iadd__",
+    "__imul__",
+    "append",
+    "extend",
+    "insert",
+    "pop",
+    "remove",
+    "clear",
+    "sort",
+    "reverse",
+):
+    setattr(TrackedList, _name, _tracked(getattr(list, _name)))
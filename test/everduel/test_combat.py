@@ -0,0 +1,71 @@
+import random
+
+import numpy as np
+
+import everduel.combat as c
+import everduel.models as m
+
+
+def make(size, **stats):
+    return c.stats_array([m.Stats(**stats)] * size)
+
+
+def test_stats_array():
+    stats = [m.Stats(might=1, skill=2, armor=3), m.Stats(health=4)]
+    array = c.stats_array(stats)
+    assert array.shape == (2, len(c.COLUMNS))
+    assert array[0, c.MIGHT] == 1
+    assert array[0, c.SKILL] == 2
+    assert array[0, c.ARMOR] == 3
+    assert array[1, c.HEALTH] == 4
+    assert array[0, c.CRIT_CHANCE] == 0.02
+    assert array[0, c.ARMOR_DIVISOR] == 1.03
+    assert c.stats_array([]).shape == (0, len(c.COLUMNS))
+    effective = m.EffectiveStats.from_totals([5, 0, 0, 0, 0, 0])
+    assert c.stats_array([effective])[0, c.DAMAGE_MULTIPLIER] == 1.1
+
+
+def test_resolve_attacks():
+    rng = np.random.default_rng(0)
+    size = 10000
+    plain = make(size)
+    damage, crit = c.resolve_attacks(plain, plain, c.MODERATE, rng)
+    assert not crit.any()
+    assert damage.min() >= 80 and damage.max() <= 130
+    damage, _ = c.resolve_attacks(plain, plain, c.MODERATE, rng, split=True)
+    assert damage.min() >= 65 and damage.max() <= 105
+    # Might doubles damage at 50, Armor halves it at 100
+    damage, _ = c.resolve_attacks(make(size, might=50), plain, c.MINOR, rng)
+    assert damage.min() >= 60 and damage.max() <= 100
+    damage, _ = c.resolve_attacks(plain, make(size, armor=100), c.MINOR, rng)
+    assert damage.min() >= 15 and damage.max() <= 25
+    # Skill 100 always crits for 150% + 100%, unless Armor resists it
+    skilled = make(size, skill=100)
+    damage, crit = c.resolve_attacks(skilled, plain, c.MEASLY, rng)
+    assert crit.all()
+    assert damage.min() >= 25 and damage.max() <= 50
+    damage, crit = c.resolve_attacks(skilled, plain, c.MEASLY, rng, crit_bonus=1.0)
+    assert damage.min() >= 35 and damage.max() <= 70
+    _, crit = c.resolve_attacks(skilled, make(size, armor=200), c.MEASLY, rng)
+    assert not crit.any()
+    _, crit = c.resolve_attacks(make(size, skill=30), plain, c.MEASLY, rng)
+    assert 0.27 < crit.mean() < 0.33
+
+
+def test_apply_damage():
+    health = np.array([100, 50, 10])
+    assert c.apply_damage(health, np.array([30, 50, 20])).tolist() == [70, 0, 0]
+
+
+def test_resolve_attack():
+    rng = random.Random(0)
+    plain = m.EffectiveStats.from_totals([0] * len(c.STATS))
+    skilled = m.EffectiveStats.from_totals([0, 100, 0, 0, 0, 0])
+    armored = m.EffectiveStats.from_totals([0, 0, 0, 0, 200, 0])
+    for _ in range(100):
+        damage, crit = c.resolve_attack(plain, plain, c.MINOR, rng)
+        assert 30 <= damage <= 50 and not crit
+        damage, crit = c.resolve_attack(skilled, plain, c.MEASLY, rng)
+        assert 25 <= damage <= 50 and crit
+        damage, crit = c.resolve_attack(skilled, armored, c.MINOR, rng)
+        assert 10 <= damage <= 17 and not crit
@@ -0,0 +1,91 @@
+import everduel.effects as e
+import everduel.models as m
+
+
+def play_round(schedule, *actors):
+    for actor in actors:
+        schedule.begin_turn(actor)
+        schedule.end_turn(actor)
+    return schedule.end_round()
+
+
+def test_durations():
+    schedule = e.Schedule()
+    a1 = m.Actor()
+    a2 = m.Actor()
+    # Gained on a1's own turn, lasting through its next one
+    schedule.begin_turn(a1)
+    schedule.add(a1, "channeled")
+    # Inflicted on a2 before its turn, lasting through this one
+    schedule.add(a2, "stunned")
+    schedule.add(a2, "stealth")
+    schedule.end_turn(a1)
+    assert set(a1.effects) == {"channeled"}
+    assert set(a2.effects) == {"stunned", "stealth"}
+    schedule.begin_turn(a2)
+    schedule.end_turn(a2)
+    assert [active.name for active in schedule.end_round()] == ["stunned"]
+    assert set(a2.effects) == {"stealth"}
+    assert play_round(schedule, a1, a2)[0].holder is a1
+    assert a1.effects == {}
+    assert schedule.remove(a2, "stealth").name == "stealth"
+    assert schedule.remove(a2, "stealth") is None
+    assert a2.effects == {}
+
+
+def test_stacking():
+    schedule = e.Schedule()
+    actor = m.Actor()
+    schedule.begin_turn(actor)
+    schedule.add(actor, "initiated", 1)
+    schedule.add(actor, "initiated", 3)
+    assert actor.effects["initiated"].expires == 4
+    # Others refresh, and never shorten
+    schedule.add(actor, "protection", 3)
+    schedule.add(actor, "protection", 1)
+    assert actor.effects["protection"].expires == 3
+    for _ in range(4):
+        play_round(schedule, actor)
+    assert set(actor.effects) == {"initiated"}
+    play_round(schedule, actor)
+    assert actor.effects == {}
+
+
+def test_ticks():
+    schedule = e.Schedule()
+    a1 = m.Actor()
+    a2 = m.Actor()
+    schedule.add(a1, "bleeding", strength=1.5)
+    schedule.add(a1, "stunned")
+    schedule.add(a2, "water")
+    ticks = schedule.end_turn(a1)
+    assert [(active.name, active.strength) for active in ticks] == [("bleeding", 1.5)]
+    assert [active.name for active in schedule.end_turn(a2)] == ["water"]
+    schedule.remove(a2, "water")
+    assert schedule.end_turn(a2) == []
+
+
+def test_wheel():
+    schedule = e.Schedule(wheel_size=4)
+    actor = m.Actor()
+    schedule.add(actor, "stealth", 10)
+    schedule.add(actor, "bloodlust", 3)
+    expired = {}
+    for i in range(12):
+        for active in play_round(schedule, actor):
+            expired[active.name] = i
+    assert expired == {"bloodlust": 2, "stealth": 9}
+    assert schedule.overflow == {} and not any(schedule.wheel)
+
+
+def test_trigger():
+    schedule = e.Schedule()
+    actor = m.Actor()
+    assert [schedule.trigger(actor, "true grit") for _ in range(4)] == [
+        True,
+        True,
+        True,
+        False,
+    ]
+    assert schedule.trigger(actor, "unlimited")
+    assert e.Schedule().trigger(actor, "true grit")
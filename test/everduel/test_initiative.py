@@ -0,0 +1,58 @@
+import fractions
+import itertools
+import random
+
+import everduel.initiative as i
+
+
+def brute_force(dice, channeled=False, brilliance=False):
+    # Enumerate every die rolled, including every re-roll
+    counts = [fractions.Fraction(0)] * i.SIDES
+
+    def roll():
+        for face in i.FACES:
+            if channeled and face == 1:
+                for again in i.FACES:
+                    yield fractions.Fraction(1, 36), again
+            else:
+                yield fractions.Fraction(1, 6), face
+
+    for outcome in itertools.product(roll(), repeat=dice):
+        weight = 1
+        for p, _ in outcome:
+            weight *= p
+        faces = [face for _, face in outcome]
+        if not brilliance:
+            counts[min(faces) - 1] += weight
+            continue
+        highest = max(faces)
+        rerolled = sum(1 for face in faces if face != highest)
+        for again in itertools.product(i.FACES, repeat=rerolled):
+            p = fractions.Fraction(1, 6**rerolled)
+            counts[min((highest,) + again) - 1] += weight * p
+    return tuple(counts)
+
+
+def test_table():
+    plain = i.table()
+    assert plain.probability(1) == 1 - fractions.Fraction(5, 6) ** 3
+    assert plain.probability(6) == fractions.Fraction(1, 216)
+    assert i.table(1, channeled=True).probability(1) == fractions.Fraction(1, 36)
+    assert i.table(0).probabilities == i.table(1).probabilities
+    assert i.table() is plain
+    for dice in (1, 2, 3):
+        for channeled in (False, True):
+            for brilliance in (False, True):
+                table = i.table(dice, channeled, brilliance)
+                assert sum(table.probabilities) == 1
+                assert table.probabilities == brute_force(dice, channeled, brilliance)
+
+
+def test_sample():
+    rng = random.Random(0)
+    table = i.table(2, channeled=True, brilliance=True)
+    size = 100000
+    rolls = [table.sample(rng) for _ in range(size)]
+    assert set(rolls) <= set(i.FACES)
+    for face in i.FACES:
+        assert abs(rolls.count(face) / size - table.probability(face)) < 0.01
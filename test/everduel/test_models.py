@@ -1,3 +1,8 @@
+import pytest
+
+import persisthing as pt
+
+import everduel.effects as e
 import everduel.models as m
 
 
@@ -38,3 +43,73 @@ def test_cyclical_move():
     assert not a1.move(a3)
     assert a1.container is None
     assert a3.things == []
+
+
+def test_effective_stats():
+    actor = m.Actor(
+        race=m.Race(stats=m.Stats(might=10, armor=5)),
+        stats=m.Stats(might=20, skill=30),
+    )
+    stats = actor.effective_stats
+    assert (stats.might, stats.skill, stats.armor, stats.health) == (30, 30, 5, 0)
+    assert stats.crit_chance == 0.3
+    assert stats.crit_reduction == 0.025
+    assert stats.crit_multiplier == 1.8
+    assert stats.damage_multiplier == 1.6
+    assert stats.armor_divisor == 1.05
+    assert actor.effective_stats is stats
+    # Equipment
+    ring = m.Ring(stats=m.Stats(armor=95))
+    actor.slots.ring1 = ring
+    assert actor.effective_stats.armor == 100
+    assert actor.effective_stats.armor_divisor == 2.0
+    actor.slots.hand1 = m.Held()
+    assert actor.effective_stats.armor == 100
+    actor.slots = m.Slots(head=m.Headwear(stats=m.Stats(health=5)))
+    assert actor.effective_stats.armor == 5
+    assert actor.effective_stats.health == 5
+    actor.slots.head.stats = m.Stats(health=10)
+    assert actor.effective_stats.health == 10
+    # Race
+    actor.race = m.Race(stats=m.Stats())
+    assert actor.effective_stats.might == 20
+    actor.race.stats = m.Stats(might=50)
+    assert actor.effective_stats.might == 70
+    actor.race.stats = m.Stats()
+    # Effects
+    schedule = e.Schedule()
+    stats = actor.effective_stats
+    schedule.add(actor, "bleeding")
+    assert actor.effective_stats is stats
+    schedule.add(actor, "channeled")
+    assert actor.effective_stats.might == 30
+    schedule.end_round()
+    assert actor.effective_stats.might == 20
+    # In place changes need invalidating
+    actor.stats.might = 0
+    assert actor.effective_stats.might == 20
+    actor.invalidate_stats()
+    assert actor.effective_stats.might == 0
+
+
+@pytest.mark.asyncio
+async def test_effective_stats_lazy():
+    db = pt.ThingsDB(await pt.MemoryBackend.connect(), lazy=True)
+    actor = m.Actor(
+        race=m.Race(stats=m.Stats(might=10)),
+        slots=m.Slots(ring1=m.Ring(stats=m.Stats(armor=20))),
+    )
+    await db.save_many([actor.race, actor.slots.ring1, actor.slots, actor])
+    actor_id = actor._id
+    del actor
+    db.cache.clear()
+    actor = await db.load(actor_id)
+    with pytest.raises(ValueError, match="fetch"):
+        actor.effective_stats
+    await actor.fetch("race", "stats", "slots")
+    with pytest.raises(ValueError, match="slots.fetch"):
+        actor.effective_stats
+    await actor.slots.fetch()
+    assert actor.effective_stats.might == 10
+    assert actor.effective_stats.armor == 20
+    await db.close()
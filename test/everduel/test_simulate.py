@@ -0,0 +1,80 @@
+import concurrent.futures
+import random
+
+import pytest
+
+import everduel.combat as c
+import everduel.models as m
+import everduel.simulate as s
+
+
+def build(role=None, **loadout):
+    actor = m.Actor(
+        race=m.Race(stats=m.Stats(health=10)),
+        stats=m.Stats(might=10),
+        weapon=m.Weapon(damage=20),
+    )
+    moves = {int(slot[1:]): skill for slot, skill in loadout.items()}
+    return s.profile(actor, moves, role)
+
+
+def test_profile():
+    profile = build("bruiser", s1="chop non-stop", s5="haste")
+    assert profile.stats[c.MIGHT] == 110
+    assert profile.stats[c.ARMOR] == 100
+    assert profile.stats[c.HEALTH] == 60
+    assert profile.weapon == 20
+    assert profile.moves == ("chop non-stop", None, None, None, "haste", None)
+    with pytest.raises(ValueError):
+        build(s2="chop non-stop")
+    with pytest.raises(ValueError):
+        build(s1="no such skill")
+    with pytest.raises(ValueError):
+        build("bruser")
+
+
+def test_duel():
+    one = build("bruiser", s1="chop non-stop", s3="body slam", s5="true grit")
+    two = build(s1="shadowstep", s2="leeching bite", s4="vampiric lineage")
+    rng = random.Random(0)
+    winners = [s.Duel(one, two, rng).play() for _ in range(200)]
+    assert set(winners) <= {-1, 0, 1}
+    # A role's worth of stats should win most duels against none
+    assert winners.count(0) > winners.count(1)
+
+
+def test_initiative():
+    profile = build()
+    duel = s.Duel(profile, profile, random.Random(0))
+    fighter = duel.fighters[0]
+    rolls = [duel.initiative(fighter) for _ in range(1000)]
+    assert min(rolls) == 1 and max(rolls) <= 6
+    fighter.effects["channeled"] = 1
+    assert sum(duel.initiative(fighter) for _ in range(1000)) > sum(rolls)
+
+
+def test_initiative_order(monkeypatch):
+    # Higher initiative acts first
+    profile = build()
+    duel = s.Duel(profile, profile, random.Random(0))
+    turns = []
+    monkeypatch.setattr(s, "MAX_ROUNDS", 2)
+    duel.initiative = lambda fighter: 6 if fighter is duel.fighters[1] else 1
+    duel.turn = lambda fighter, target, initiative: turns.append(fighter)
+    assert duel.play() == -1
+    assert turns == [duel.fighters[1], duel.fighters[0]] * 2
+
+
+def test_simulate():
+    one = build("hitter", s1="slice'n'dice", s3="hungerstrike")
+    two = build("poisoner", s1="zap", s2="silver orb", s4="arcane blast")
+    with concurrent.futures.ProcessPoolExecutor(2) as executor:
+        partial = list(s.iter_simulate(one, two, 250, 1, 100, executor))
+        result = s.simulate(one, two, 250, 1, 100, executor)
+    assert len(partial) == 3
+    assert partial[0].duels in (50, 100) and partial[-1].duels == 250
+    assert result.duels == 250
+    assert result.wins == partial[-1].wins and result.draws == partial[-1].draws
+    low, high = result.confidence_interval()
+    assert low <= result.win_rate() <= high
+    assert s.Result().confidence_interval() == (0.0, 1.0)
@@ -1,5 +1,12 @@
+import asyncio
+import concurrent.futures
+import gc
+import io
+import json
+import os
 import pathlib
 import pytest
+from unittest import mock
 import pytest_asyncio
 
 import persisthing as pt
@@ -7,6 +14,7 @@ import persisthing as pt
 TEST_DB = pathlib.Path(__file__).parent / "test.db"
 TEST_DB_TABLE = "things"
 TEST_TMP_DIR = pathlib.Path(__file__).parent / "tmp-file-backend-data"
+TEST_LOG_DIR = pathlib.Path(__file__).parent / "tmp-log-backend-data"
 
 # Handle all test coroutines as marked with asyncio
 pytestmark = pytest.mark.asyncio
@@ -45,13 +53,61 @@ class MyUpgradedThing(pt.BaseThing):
         return data
 
 
+@pt.thing("test-w")
+class MyWeapon(MyThing):
+    damage = pt.prop(int, indexed=True)
+    owner = pt.prop(MyPlayer, default=None, indexed=True)
+    tags = pt.prop(list, indexed=True)
+
+
+@pt.thing("test-cs", compact=True)
+class MyCompactStats(pt.BaseThing):
+    might = pt.prop(int)
+    skill = pt.prop(int)
+
+
+@pt.thing("test-cm", compact=True)
+class MyCompactMethods(MyCompactStats):
+    def mark_changed(self, name):
+        super().mark_changed(name.upper())
+
+    @classmethod
+    def upgrade_to(cls, data, version):
+        data = super().upgrade_to(data, version)
+        data["skill"] = version
+        return data
+
+    @property
+    def plain_repr(self):
+        return super().__repr__()
+
+
+@pt.thing("test-ct", compact=True)
+class MyCompactThing(pt.BaseThing):
+    name = pt.prop(str)
+    stats = pt.prop(MyCompactStats)
+
+
 @pytest_asyncio.fixture(
     scope="function",
     params=[
         (pt.SqliteBackend, TEST_DB, TEST_DB_TABLE),
+        (pt.SqliteBackend, TEST_DB, TEST_DB_TABLE, pt.BinaryCodec(64)),
         (pt.FileBackend, TEST_TMP_DIR),
+        (pt.FileBackend, TEST_TMP_DIR, None, 2, 2, True),
+        (pt.LogBackend, TEST_LOG_DIR),
+        (pt.MemoryBackend,),
+        (pt.MemoryBackend, None, False),
+    ],
+    ids=[
+        "sqlite",
+        "sqlite-binary",
+        "file",
+        "file-sharded",
+        "log",
+        "memory",
+        "memory-plain",
     ],
-    ids=["sqlite", "file"],
 )
 async def thingsdb(request):
     backend_cls, *backend_args = request.param
@@ -323,6 +379,7 @@ async def test_migration(thingsdb):
     }
     assert thing.price == 42
     del thing
+    assert thingsdb.migrations == 0
     # Downgrade
     MyUpgradedThing._version = 1
     price_prop = MyUpgradedThing.price
@@ -334,6 +391,7 @@ async def test_migration(thingsdb):
         "name": "Kaka",
     }
     assert hasattr(thing, "price") is False
+    assert thingsdb.migrations == 1
     thing_id = await thing.save(thingsdb)
     del thing
     # Upgrade
@@ -346,3 +404,1054 @@ async def test_migration(thingsdb):
         "name": "Kaka",
         "price": len("Kaka"),
     }
+    assert thingsdb.migrations == 2
+
+
+async def test_migration_chain():
+    chain = pt.things.migration_chain(MyUpgradedThing, 1, 3)
+    assert chain == (
+        (MyUpgradedThing.upgrade_to, 2),
+        (MyUpgradedThing.upgrade_to, 3),
+    )
+    assert pt.things.migration_chain(MyUpgradedThing, 1, 3) is chain
+    assert pt.things.migration_chain(MyUpgradedThing, 3, 1) == (
+        (MyUpgradedThing.downgrade_from, 3),
+        (MyUpgradedThing.downgrade_from, 2),
+    )
+    # Hooks that are not overridden are left out
+    assert pt.things.migration_chain(MyThing, 1, 3) == ()
+    data = {pt.TYPE_KEY: "test", pt.VERSION_KEY: 3, "name": "Rock"}
+    assert MyThing.migrate(data)[pt.VERSION_KEY] == 1
+
+
+async def test_session(thingsdb):
+    player = MyPlayer(name="Alice")
+    thing = MyThing(name="Kaka")
+    player.thing = thing
+    async with thingsdb.session() as session:
+        session.add(player, thing)
+        assert len(session) == 2
+        assert player._id is None
+    assert len(session) == 0
+    assert player._id is not None
+    assert thing._id is not None
+    r_data = await thingsdb.backend.load(player._id)
+    assert r_data == {
+        pt.TYPE_KEY: "test-p",
+        pt.VERSION_KEY: 1,
+        "name": "Alice",
+        "thing": {pt.ID_KEY: thing._id},
+    }
+    async with thingsdb.session() as session:
+        player.name = "Bob"
+        thing.name = "Bulle"
+        session.add(player, thing)
+    r_data = await thingsdb.backend.load(player._id)
+    assert r_data["name"] == "Bob"
+    r_data = await thingsdb.backend.load(thing._id)
+    assert r_data["name"] == "Bulle"
+
+
+async def test_session_autoflush(thingsdb):
+    async with thingsdb.session(autoflush=0.01) as session:
+        thing = MyThing(name="Kaka")
+        session.add(thing)
+        while len(session):
+            await asyncio.sleep(0.01)
+        assert thing._id is not None
+        r_data = await thingsdb.backend.load(thing._id)
+        assert r_data["name"] == "Kaka"
+
+
+async def test_session_autoflush_error(thingsdb):
+    # A failed autoflush is raised by the next flush, after which
+    # autoflushing goes on
+    async with thingsdb.session(autoflush=0.01) as session:
+        thing = MyThing(name="Kaka")
+        session.add(thing)
+        with mock.patch.object(thingsdb, "save_many", side_effect=OSError):
+            while session._error is None:
+                await asyncio.sleep(0.01)
+        with pytest.raises(OSError):
+            await session.flush()
+        while len(session):
+            await asyncio.sleep(0.01)
+        assert thing._id is not None
+
+
+async def test_session_flushing(thingsdb):
+    session = thingsdb.session()
+    thing = MyThing(name="Kaka")
+    session.add(thing)
+    saving = asyncio.Event()
+    save_many = thingsdb.save_many
+
+    async def slow_save_many(things):
+        await saving.wait()
+        return await save_many(things)
+
+    with mock.patch.object(thingsdb, "save_many", slow_save_many):
+        flush = asyncio.create_task(session.flush())
+        await asyncio.sleep(0)
+        # Not written yet, so still pending
+        assert len(session) == 1 and thing in session
+        session.add(thing)
+        assert len(session) == 1
+        saving.set()
+        await flush
+    assert len(session) == 1
+    await session.flush()
+    assert len(session) == 0 and thing not in session
+    assert thing._id is not None
+
+
+async def test_session_rollback():
+    backend = await pt.SqliteBackend.connect(TEST_DB, TEST_DB_TABLE)
+    thingsdb = pt.ThingsDB(backend)
+    try:
+        await thingsdb.clear()
+        player = MyPlayer(name="Alice")
+        player.buddy = player
+        thing = MyThing(name="Kaka")
+        session = thingsdb.session()
+        session.add(thing, player)
+        with pytest.raises(ValueError):
+            await session.flush()
+        assert thing._id is None
+        assert player._id is None
+        assert len(session) == 2
+        assert await backend.fetchone(f"SELECT id FROM {TEST_DB_TABLE}") is None
+    finally:
+        await thingsdb.close()
+
+
+async def test_dirty_tracking(thingsdb):
+    player = MyPlayer(name="Alice")
+    assert player.is_dirty
+    await player.save(thingsdb)
+    assert not player.is_dirty
+    player.negligible = MyThing()
+    assert not player.is_dirty
+    player.name = "Bob"
+    assert player.is_dirty
+    await player.save()
+    assert not player.is_dirty
+    player.inventory.append(MyThing(name="Saft"))
+    assert player.is_dirty
+    await player.save()
+    player.inventory[0].name = "Bärs"
+    assert player.is_dirty
+    await player.save()
+    player = await thingsdb.load(player._id)
+    assert not player.is_dirty
+    assert player.inventory[0].name == "Bärs"
+    player.inventory.pop()
+    assert player.is_dirty
+
+
+async def test_dirty_tracking_shared_list(thingsdb):
+    bob = MyPlayer(name="Bob", inventory=[MyThing(name="Saft")])
+    alice = MyPlayer(name="Alice")
+    await thingsdb.save_many([alice, bob])
+    alice.inventory = bob.inventory
+    await alice.save()
+    alice.inventory.pop()
+    assert alice.is_dirty
+    assert not bob.is_dirty
+    await alice.save()
+    assert (await thingsdb.backend.load(alice._id))["inventory"] == []
+    assert len(bob.inventory) == 1
+    # The same for properties not compiled to specialized accessors
+    pt.prop.__set__(vars(MyPlayer)["inventory"], alice, bob.inventory)
+    await alice.save()
+    alice.inventory.pop()
+    assert alice.is_dirty
+    assert not bob.is_dirty
+
+
+async def test_skip_clean(thingsdb):
+    thing = MyThing(name="Kaka")
+    await thing.save(thingsdb)
+    await thingsdb.backend.update(thing._id, {"name": "Bulle"})
+    await thing.save()
+    r_data = await thingsdb.backend.load(thing._id)
+    assert r_data == {"name": "Bulle"}
+    thing.price = 10
+    await thing.save()
+    r_data = await thingsdb.backend.load(thing._id)
+    assert r_data["name"] == "Kaka"
+
+
+def count_loads(thingsdb, calls=None):
+    loads = []
+    load_many = thingsdb.backend.load_many
+
+    async def counting_load_many(thing_ids):
+        loads.extend(thing_ids)
+        if calls is not None:
+            calls.append(thing_ids)
+        return await load_many(thing_ids)
+
+    thingsdb.backend.load_many = counting_load_many
+    return loads
+
+
+async def test_concurrent_load(thingsdb):
+    thing_id = await test_save_thing(thingsdb)
+    loads = count_loads(thingsdb)
+    thing1, thing2 = await asyncio.gather(
+        thingsdb.load(thing_id), thingsdb.load(thing_id)
+    )
+    assert thing1 is thing2
+    assert loads == [thing_id]
+
+
+async def test_concurrent_load_cancel(thingsdb):
+    # Cancelling the load that started a backend load leaves other loads of
+    # the same thing to finish it
+    thing_id = await test_save_thing(thingsdb)
+    gc.collect()
+    loads = count_loads(thingsdb)
+    load_many = thingsdb.backend.load_many
+    started = asyncio.Event()
+    release = asyncio.Event()
+
+    async def slow_load_many(thing_ids):
+        started.set()
+        await release.wait()
+        return await load_many(thing_ids)
+
+    thingsdb.backend.load_many = slow_load_many
+    first = asyncio.create_task(thingsdb.load(thing_id))
+    await started.wait()
+    second = asyncio.create_task(thingsdb.load(thing_id))
+    await asyncio.sleep(0)
+    first.cancel()
+    release.set()
+    with pytest.raises(asyncio.CancelledError):
+        await first
+    thing = await asyncio.wait_for(second, 5)
+    assert thing._id == thing_id
+    assert loads == [thing_id]
+
+
+async def test_load_cyclical(thingsdb):
+    player1 = MyPlayer(name="Alice")
+    player2 = MyPlayer(name="Bob")
+    await thingsdb.save_many([player1, player2])
+    player1.buddy = player2
+    player2.buddy = player1
+    player1.inventory.extend([player2, player1])
+    await thingsdb.save_many([player1, player2])
+    player1_id, player2_id = player1._id, player2._id
+    del player1, player2
+    gc.collect()
+    loads = count_loads(thingsdb)
+    player1, player2 = await asyncio.gather(
+        thingsdb.load(player1_id), thingsdb.load(player2_id)
+    )
+    assert sorted(loads) == sorted([player1_id, player2_id])
+    assert player1.buddy is player2
+    assert player2.buddy is player1
+    assert player1.inventory == [player2, player1]
+    assert not player1.is_dirty
+
+
+async def test_bulk_load(thingsdb):
+    player = MyPlayer(name="Alice")
+    for i in range(50):
+        player.inventory.append(MyThing(name=f"Thing {i}"))
+    await thingsdb.save_many([player] + player.inventory)
+    thing_ids = [thing._id for thing in player.inventory]
+    r_data = await thingsdb.backend.load(player._id)
+    assert r_data["inventory"] == [{pt.ID_KEY: thing_id} for thing_id in thing_ids]
+    r_data = await thingsdb.backend.load_many(thing_ids[:3] + ["nope"])
+    assert [data["name"] for data in r_data.values()] == [
+        "Thing 0",
+        "Thing 1",
+        "Thing 2",
+    ]
+    player_id = player._id
+    del player
+    calls = []
+    count_loads(thingsdb, calls)
+    player = await thingsdb.load(player_id)
+    assert [thing.name for thing in player.inventory] == [
+        f"Thing {i}" for i in range(50)
+    ]
+    assert calls == [[player_id], thing_ids]
+    with pytest.raises(pt.ThingDoesNotExistException):
+        await thingsdb.load_many([thing_ids[0], "nope"])
+
+
+async def test_save_many_backend(thingsdb):
+    thing_ids = await thingsdb.backend.save_many(
+        [(None, {"name": "Kaka"}), (None, {"name": "Bulle"})]
+    )
+    assert len(set(thing_ids)) == 2
+    assert await thingsdb.backend.save_many(
+        [(thing_ids[0], {"name": "Saft"}), (None, {"name": "Bärs"})]
+    ) == [thing_ids[0], mock.ANY]
+    r_data = await thingsdb.backend.load_many(thing_ids)
+    assert r_data == {thing_ids[0]: {"name": "Saft"}, thing_ids[1]: {"name": "Bulle"}}
+
+
+async def save_players(thingsdb):
+    player1 = MyPlayer(name="Alice")
+    player2 = MyPlayer(name="Bob")
+    player3 = MyPlayer(name="Carol")
+    player1.buddy = player2
+    player2.buddy = player3
+    player1.inventory.append(MyThing(name="Kaka"))
+    player1.thing = MyThing(name="Bulle")
+    await thingsdb.save_many([player1, player2, player3] + player1.inventory)
+    return player1._id
+
+
+async def test_load_depth(thingsdb):
+    player_id = await save_players(thingsdb)
+    gc.collect()
+    player = await thingsdb.load(player_id, depth=1)
+    assert player.buddy.name == "Bob"
+    assert isinstance(player.buddy.buddy, pt.Reference)
+    assert player.inventory[0].name == "Kaka"
+    buddy = await player.buddy.buddy
+    assert buddy.name == "Carol"
+    assert isinstance(player.buddy.buddy, pt.Reference)
+    assert await player.buddy.fetch("buddy") is buddy
+    assert player.buddy.buddy is buddy
+    assert not player.is_dirty
+    assert not player.buddy.is_dirty
+
+
+async def test_load_fields(thingsdb):
+    player_id = await save_players(thingsdb)
+    gc.collect()
+    player = await thingsdb.load(player_id, fields=["inventory"])
+    assert isinstance(player.buddy, pt.Reference)
+    assert player.inventory[0].name == "Kaka"
+    assert player.thing.name == "Bulle"
+    buddy, inventory = await player.fetch("buddy", "inventory")
+    assert buddy.name == "Bob"
+    assert buddy.buddy.name == "Carol"
+    assert inventory == player.inventory
+
+
+async def test_lazy(thingsdb):
+    player_id = await save_players(thingsdb)
+    gc.collect()
+    lazydb = pt.ThingsDB(thingsdb.backend, lazy=True)
+    player = await lazydb.load(player_id)
+    assert isinstance(player.buddy, pt.Reference)
+    assert isinstance(player.inventory[0], pt.Reference)
+    assert player.thing.name == "Bulle"
+    player.name = "Alicia"
+    await player.save()
+    r_data = await thingsdb.backend.load(player_id)
+    assert r_data["buddy"] == {pt.ID_KEY: player.buddy._id}
+    assert r_data["inventory"] == [{pt.ID_KEY: player.inventory[0]._id}]
+    assert await player.fetch() is player
+    assert player.buddy.name == "Bob"
+    assert isinstance(player.buddy.buddy, pt.Reference)
+
+
+async def test_lru_cache():
+    now = [0.0]
+    evicted = []
+    lru = pt.LRUCache(
+        max_entries=2,
+        ttl=10,
+        on_evict=lambda key, value: evicted.append(key),
+        clock=lambda: now[0],
+    )
+    lru.put(1, "a")
+    lru.put(2, "b")
+    assert lru.get(1) == "a"
+    lru.put(3, "c")
+    assert evicted == [2]
+    assert lru.get(2) is None
+    now[0] = 10
+    assert lru.get(1) is None
+    assert evicted == [2, 1]
+    assert lru.stats == {
+        "entries": 1,
+        "bytes": 0,
+        "hits": 1,
+        "misses": 2,
+        "evictions": 2,
+    }
+    # Expired entries are dropped on put, even if never read again
+    now[0] = 0
+    lru = pt.LRUCache(ttl=10, clock=lambda: now[0])
+    for key in range(5):
+        lru.put(key, "a")
+    now[0] = 5
+    lru.put(5, "b")
+    now[0] = 12
+    lru.put(6, "c")
+    assert list(lru.entries) == [5, 6]
+    lru = pt.LRUCache(max_bytes=10, sizeof=len)
+    lru.put(1, "aaaa")
+    lru.put(2, "bbbb")
+    lru.put(3, "cccc")
+    assert list(lru.entries) == [2, 3]
+    assert lru.bytes == 8
+
+
+async def test_lru_thingsdb(thingsdb):
+    thingsdb.lru = pt.LRUCache(max_entries=1)
+    thing_id = await test_save_thing(thingsdb)
+    loads = count_loads(thingsdb)
+    thing = await thingsdb.load(thing_id)
+    assert loads == []
+    assert thingsdb.lru.hits == 1
+    other = MyThing(name="Bulle")
+    await other.save(thingsdb)
+    assert thingsdb.lru.evictions == 1
+    del thing
+    thing = await thingsdb.load(thing_id)
+    assert loads == [thing_id]
+    assert thing.name == "Kaka"
+    del thing, other
+    assert len(thingsdb.cache) == 1
+
+
+async def test_file_backend_atomic_write():
+    backend = await pt.FileBackend.connect(TEST_TMP_DIR)
+    try:
+        await backend.clear()
+        thing_id = await backend.create({"name": "Kaka"})
+        data = {"name": "Bulle"}
+        data["self"] = data
+        with pytest.raises(ValueError):
+            await backend.update(thing_id, data)
+        assert await backend.load(thing_id) == {"name": "Kaka"}
+        with mock.patch("os.replace", side_effect=OSError):
+            with pytest.raises(OSError):
+                await backend.update(thing_id, {"name": "Bulle"})
+        assert await backend.load(thing_id) == {"name": "Kaka"}
+        assert [p.name for p in TEST_TMP_DIR.iterdir()] == [thing_id]
+        # Written data is on disk before it replaces the old file
+        with mock.patch("os.fsync", side_effect=OSError):
+            with pytest.raises(OSError):
+                await backend.update(thing_id, {"name": "Bulle"})
+        assert await backend.load(thing_id) == {"name": "Kaka"}
+        backend.sync = False
+        with mock.patch("os.fsync", side_effect=OSError):
+            await backend.update(thing_id, {"name": "Bulle"})
+        assert await backend.load(thing_id) == {"name": "Bulle"}
+        await backend.clear()
+        assert await backend.load(thing_id) is None
+        assert list(TEST_TMP_DIR.iterdir()) == []
+    finally:
+        await backend.close()
+
+
+async def test_file_backend_migrate_layout():
+    backend = await pt.FileBackend.connect(TEST_TMP_DIR)
+    try:
+        await backend.clear()
+        thing_ids = await backend.save_many([(None, {"name": "Kaka"})] * 10)
+        sharded = await pt.FileBackend.connect(
+            TEST_TMP_DIR, shard_depth=2, compact=True
+        )
+        assert await sharded.load_many(thing_ids) == {}
+        assert await sharded.migrate_layout() == 10
+        assert await sharded.migrate_layout() == 0
+        loaded = await sharded.load_many(thing_ids)
+        assert loaded == {thing_id: {"name": "Kaka"} for thing_id in thing_ids}
+        file_path = sharded.path(thing_ids[0])
+        assert file_path.parent.parent.parent == TEST_TMP_DIR
+        assert file_path.parent.name == thing_ids[0][2:4]
+        assert file_path.read_text() == '{\n    "name": "Kaka"\n}'
+        assert await sharded.migrate_layout(reencode=True) == 10
+        assert file_path.read_text() == '{"name":"Kaka"}'
+        assert await backend.migrate_layout() == 10
+        assert sorted(p.name for p in TEST_TMP_DIR.iterdir()) == sorted(thing_ids)
+    finally:
+        await backend.clear()
+        await backend.close()
+
+
+@pytest.mark.parametrize(
+    "codec",
+    [
+        pt.JsonCodec(),
+        pt.JsonCodec(compress_threshold=64),
+        pt.BinaryCodec(),
+        pt.BinaryCodec(compress_threshold=64),
+    ],
+    ids=["json", "json-zlib", "binary", "binary-zlib"],
+)
+async def test_codec(codec):
+    player = MyPlayer(name="Alice", buddy=MyPlayer(name="Bob"))
+    player.buddy._id = 42
+    player.thing = MyThing(name="Kaka")
+    player.inventory.extend([MyThing(name="Bulle") for _ in range(10)])
+    data = {"name": "Alice", "buddy": player.buddy, "inventory": player.inventory}
+    data["thing"] = player.thing
+    # Stored as JSON stores them, whichever the codec
+    data["pair"] = (1, (2, 3))
+    data["counts"] = {1: "a", 2.5: "b", None: "c", "d": 4}
+    encoded = codec.encode(data)
+    decoded = {
+        "name": "Alice",
+        "buddy": {pt.ID_KEY: 42},
+        "thing": {pt.TYPE_KEY: "test-t", pt.VERSION_KEY: 1, "name": "Kaka"},
+        "inventory": [{pt.TYPE_KEY: "test-t", pt.VERSION_KEY: 1, "name": "Bulle"}] * 10,
+        "pair": [1, [2, 3]],
+        "counts": {"1": "a", "2.5": "b", "null": "c", "d": 4},
+    }
+    assert codec.decode(encoded) == decoded
+    for other in (pt.JsonCodec(), pt.BinaryCodec()):
+        assert other.decode(encoded) == decoded
+    if codec.compress_threshold:
+        assert len(encoded) < len(pt.JsonCodec().encode(data))
+    with pytest.raises(TypeError):
+        codec.encode({"counts": {(1, 2): "a"}})
+    data["self"] = data
+    with pytest.raises(ValueError):
+        codec.encode(data)
+
+
+async def test_codec_switch():
+    backend = await pt.SqliteBackend.connect(TEST_DB, TEST_DB_TABLE)
+    try:
+        await backend.clear()
+        thing_id = await backend.create({"name": "Kaka"})
+        backend.codec = pt.BinaryCodec()
+        assert await backend.load(thing_id) == {"name": "Kaka"}
+        await backend.update(thing_id, {"name": "Bulle"})
+        row = await backend.fetchone(
+            f"SELECT data FROM {TEST_DB_TABLE} WHERE id = :id", id=thing_id
+        )
+        assert row[0][:1] == b"\x01"
+        backend.codec = pt.JsonCodec()
+        assert await backend.load(thing_id) == {"name": "Bulle"}
+    finally:
+        await backend.close()
+
+
+async def test_sqlite_readers():
+    backend = await pt.SqliteBackend.connect(
+        TEST_DB, TEST_DB_TABLE, pragmas=pt.SqliteBackend.PERFORMANCE, readers=2
+    )
+    thingsdb = pt.ThingsDB(backend)
+    try:
+        assert (await backend.fetchone("PRAGMA journal_mode"))[0] == "wal"
+        await thingsdb.clear()
+        thing_ids = await backend.save_many([(None, {"name": "Kaka"})] * 3)
+        loaded = await asyncio.gather(
+            *(backend.load(thing_id) for thing_id in thing_ids),
+            backend.load_many(thing_ids),
+        )
+        assert loaded[:3] == [{"name": "Kaka"}] * 3
+        assert loaded[3] == {thing_id: {"name": "Kaka"} for thing_id in thing_ids}
+        assert backend._readers.qsize() == 2
+        async with backend.transaction():
+            await backend.update(thing_ids[0], {"name": "Bulle"})
+            assert await backend.load(thing_ids[0]) == {"name": "Bulle"}
+            assert backend._readers.qsize() == 2
+        assert await backend.load(thing_ids[0]) == {"name": "Bulle"}
+    finally:
+        await thingsdb.close()
+
+
+async def test_sqlite_readers_query():
+    backend = await pt.SqliteBackend.connect(
+        TEST_DB, TEST_DB_TABLE, pragmas=pt.SqliteBackend.PERFORMANCE, readers=1
+    )
+    thingsdb = pt.ThingsDB(backend)
+    try:
+        await thingsdb.clear()
+        alice = MyPlayer(name="Alice")
+        await alice.save(thingsdb)
+        await thingsdb.save_many(
+            [MyWeapon(name=str(n), damage=n * 20, owner=alice) for n in range(5)]
+        )
+        # Load into a fresh database, so that owners have to be loaded too
+        fresh = pt.ThingsDB(backend)
+        weapons = await asyncio.wait_for(
+            _collect(fresh.query(MyWeapon, batch_size=1, damage__gt=50)), 5
+        )
+        assert [weapon.name for weapon in weapons] == ["3", "4"]
+        assert [weapon.owner.name for weapon in weapons] == ["Alice", "Alice"]
+        assert backend._readers.qsize() == 1
+    finally:
+        await thingsdb.close()
+
+
+async def _collect(things):
+    return [thing async for thing in things]
+
+
+@pytest_asyncio.fixture(
+    params=[pt.JsonCodec(), pt.BinaryCodec()], ids=["json", "binary"]
+)
+async def sqlitedb(request):
+    backend = await pt.SqliteBackend.connect(TEST_DB, TEST_DB_TABLE, request.param)
+    db = pt.ThingsDB(backend)
+    try:
+        await db.clear()
+        yield db
+    finally:
+        await db.close()
+
+
+async def test_query(sqlitedb):
+    alice = MyPlayer(name="Alice")
+    bob = MyPlayer(name="Bob")
+    await sqlitedb.save_many([alice, bob])
+    weapons = [
+        MyWeapon(name="Axe", damage=60, owner=alice, tags=["sharp", "heavy"]),
+        MyWeapon(name="Sword", damage=40, owner=alice, tags=["sharp"]),
+        MyWeapon(name="Club", damage=80, owner=bob, tags=["heavy"]),
+    ]
+    await sqlitedb.save_many(weapons + [MyThing(name="Rock")])
+
+    async def names(**filters):
+        return [thing.name async for thing in sqlitedb.query(MyThing, **filters)]
+
+    assert await names() == ["Alice", "Bob", "Axe", "Sword", "Club", "Rock"]
+    assert await names(damage__gt=50) == ["Axe", "Club"]
+    assert await names(damage__gte=60, damage__lt=80) == ["Axe"]
+    assert await names(owner=alice) == ["Axe", "Sword"]
+    assert await names(owner__in=[bob, alice._id]) == ["Axe", "Sword", "Club"]
+    assert await names(tags="heavy") == ["Axe", "Club"]
+    assert [thing.name async for thing in sqlitedb.query(MyPlayer, batch_size=1)] == [
+        "Alice",
+        "Bob",
+    ]
+    things = [thing async for thing in sqlitedb.query(MyWeapon, owner=bob)]
+    assert things == [weapons[2]]
+    weapons[2].owner = alice
+    await weapons[2].save()
+    assert await names(owner=alice) == ["Axe", "Sword", "Club"]
+    await weapons[0].delete()
+    assert await names(owner=alice) == ["Sword", "Club"]
+    with pytest.raises(ValueError):
+        await names(name="Axe")
+    with pytest.raises(ValueError):
+        await names(damage__like=50)
+
+
+async def test_query_pages(sqlitedb):
+    # Each page seeks to where the last one ended, so that a query visits
+    # about as many rows for its last page as for its first
+    backend = sqlitedb.backend
+    steps = 0
+
+    def count():
+        nonlocal steps
+        steps += 1
+
+    async def visited(count, **filters):
+        nonlocal steps
+        await sqlitedb.clear()
+        await sqlitedb.save_many(
+            [MyWeapon(name=str(n), damage=n, tags=["a", "b"]) for n in range(count)]
+        )
+        steps = 0
+        found = [
+            thing._id
+            async for thing in sqlitedb.query(MyWeapon, batch_size=10, **filters)
+        ]
+        assert len(found) == len(set(found)) == count
+        return steps
+
+    await backend._conn.set_progress_handler(count, 100)
+    for filters in ({"damage__gte": 0}, {"tags__in": ["a", "b"], "damage__lt": 1000}):
+        few = await visited(100, **filters)
+        many = await visited(400, **filters)
+        assert many < few * 6
+
+
+async def test_reindex(sqlitedb):
+    backend = sqlitedb.backend
+    await backend.save_many([(None, {pt.TYPE_KEY: "test-w", pt.VERSION_KEY: 1})])
+    thing_id = await backend.create(
+        {pt.TYPE_KEY: "test-w", pt.VERSION_KEY: 1, "damage": 50}
+    )
+    await backend.executemany(f"DELETE FROM {TEST_DB_TABLE}_index", [{}])
+    await backend.commit()
+    assert [thing async for thing in sqlitedb.query(MyWeapon, damage=50)] == []
+    await backend.reindex(batch_size=1)
+    things = [thing async for thing in sqlitedb.query(MyWeapon, damage=50)]
+    assert [thing._id for thing in things] == [thing_id]
+
+
+async def test_compact_super():
+    thing = MyCompactMethods(might=1)
+    assert thing._changed == {"MIGHT"}
+    assert MyCompactMethods.upgrade_to({}, 2) == {"skill": 2}
+    assert thing.plain_repr.startswith("<")
+
+
+async def test_legacy_table():
+    # Tables from before the type column get it filled in on connect
+    tablename = "legacy"
+    backend = await pt.SqliteBackend.connect(TEST_DB, TEST_DB_TABLE)
+    try:
+        for table in (tablename, f"{tablename}_index"):
+            cursor = await backend.execute(f"DROP TABLE IF EXISTS {table}")
+            await cursor.close()
+        cursor = await backend.execute(
+            f"CREATE TABLE {tablename} (id INTEGER PRIMARY KEY, data BLOB NOT NULL)"
+        )
+        await cursor.close()
+        data = {pt.TYPE_KEY: "test-upgraded", pt.VERSION_KEY: 1, "name": "xyz"}
+        cursor = await backend.execute(
+            f"INSERT INTO {tablename} (data) VALUES (:data)",
+            data=backend.codec.encode(data),
+        )
+        await cursor.close()
+        await backend.commit()
+    finally:
+        await backend.close()
+    backend = await pt.SqliteBackend.connect(TEST_DB, tablename)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            result = await pt.migrate_all(backend, MyUpgradedThing, executor=executor)
+        assert result["scanned"] == 1 and result["migrated"] == 1
+        things = pt.ThingsDB(backend).iter_things(MyUpgradedThing)
+        assert [thing.price async for thing in things] == [3]
+    finally:
+        await backend.close()
+
+
+async def test_iter_things(thingsdb):
+    await thingsdb.save_many([MyPlayer(name=f"Player {n}") for n in range(5)])
+    await thingsdb.save_many([MyThing(name="Rock"), MyWeapon(name="Axe", damage=60)])
+    names = [thing.name async for thing in thingsdb.iter_things(batch_size=2)]
+    assert len(names) == 7
+    assert set(names) == {"Rock", "Axe"} | {f"Player {n}" for n in range(5)}
+    players = [thing async for thing in thingsdb.iter_things(MyPlayer, batch_size=2)]
+    assert sorted(player.name for player in players) == [
+        f"Player {n}" for n in range(5)
+    ]
+    assert all(thingsdb.lookup(player._id) is player for player in players)
+    weapons = [thing async for thing in thingsdb.iter_things(MyWeapon)]
+    assert [weapon.name for weapon in weapons] == ["Axe"]
+    # Backends without indexes answer queries by scanning
+    found = [thing async for thing in thingsdb.query(MyWeapon, damage__gt=50)]
+    assert found == weapons
+    assert [thing async for thing in thingsdb.query(MyWeapon, damage__lt=50)] == []
+
+
+async def test_iterate_after(sqlitedb):
+    things = [MyThing(name=str(n)) for n in range(5)]
+    await sqlitedb.save_many(things)
+    rows = [row async for row in sqlitedb.backend.iterate(batch_size=2)]
+    assert [thing_id for thing_id, _ in rows] == [thing._id for thing in things]
+    rows = [
+        row async for row in sqlitedb.backend.iterate(batch_size=2, after=things[2]._id)
+    ]
+    assert [data["name"] for _, data in rows] == ["3", "4"]
+
+
+async def test_migrate_all(thingsdb, tmp_path):
+    backend = thingsdb.backend
+    old = [
+        {pt.TYPE_KEY: "test-upgraded", pt.VERSION_KEY: 1, "name": "x" * n}
+        for n in range(1, 6)
+    ]
+    current = {pt.TYPE_KEY: "test-upgraded", pt.VERSION_KEY: 3, "name": "y"}
+    other = {pt.TYPE_KEY: "test", pt.VERSION_KEY: 1, "name": "Rock"}
+    thing_ids = await backend.save_many([(None, data) for data in old])
+    await backend.save_many([(None, current), (None, other)])
+    state_path = tmp_path / "migration.json"
+    reports = []
+
+    def interrupt(report):
+        reports.append(report)
+        raise RuntimeError("interrupted")
+
+    with concurrent.futures.ProcessPoolExecutor(1) as executor:
+        with pytest.raises(RuntimeError):
+            await pt.migrate_all(
+                backend,
+                MyUpgradedThing,
+                batch_size=2,
+                executor=executor,
+                state_path=state_path,
+                progress=interrupt,
+            )
+        assert json.loads(state_path.read_text()) == reports[0]
+        result = await pt.migrate_all(
+            backend,
+            MyUpgradedThing,
+            batch_size=2,
+            executor=executor,
+            state_path=state_path,
+            progress=reports.append,
+        )
+    assert not state_path.exists()
+    assert result == reports[-1]
+    assert result["scanned"] >= 6
+    assert result["migrated"] == 5
+    loaded = await backend.load_many(thing_ids)
+    assert [loaded[thing_id]["price"] for thing_id in thing_ids] == [1, 2, 3, 4, 5]
+    assert all(data[pt.VERSION_KEY] == 3 for data in loaded.values())
+    things = [thing async for thing in thingsdb.iter_things(MyUpgradedThing)]
+    assert not any(thing.is_dirty for thing in things)
+
+
+async def test_compact(thingsdb):
+    thing = MyCompactThing(name="Rock", stats=MyCompactStats(might=3))
+    assert not hasattr(thing, "__dict__")
+    assert type(thing._data) is dict
+    assert isinstance(thing.stats._data, pt.things.IntData)
+    with pytest.raises(AttributeError):
+        thing.stats.weight = 1
+    assert thing.stats.skill == 0
+    thing.stats.skill = 2**70
+    thing_id = await thing.save(thingsdb)
+    assert thing.stats._data == {
+        "might": 3,
+        "skill": 2**70,
+        pt.TYPE_KEY: "test-cs",
+        pt.VERSION_KEY: 1,
+    }
+    del thing
+    gc.collect()
+    thing = await thingsdb.load(thing_id)
+    assert thing.stats.might == 3
+    assert thing.stats.skill == 2**70
+    assert not thing.is_dirty
+    thing.stats.might += 1
+    assert thing.is_dirty
+    await thing.save()
+    del thing.stats.skill
+    assert "skill" not in thing.stats._data
+    assert (await thingsdb.backend.load(thing_id))["stats"]["might"] == 4
+    with pytest.raises(TypeError):
+        pt.thing("test-cx", compact=True)(type("Loose", (MyThing,), {}))
+
+
+async def test_compiled_props():
+    prop = vars(MyWeapon)["damage"]
+    assert type(prop) is not pt.prop and isinstance(prop, pt.prop)
+    weapon = MyWeapon(name="Axe", damage=60)
+    with pytest.raises(ValueError):
+        weapon.damage = "sharp"
+    weapon.owner = None
+    weapon.owner = pt.Reference(None, 1)
+    pt.set_typechecks(False)
+    try:
+        weapon.damage = "sharp"
+        assert weapon.damage == "sharp"
+    finally:
+        pt.set_typechecks(True)
+    with pytest.raises(ValueError):
+        weapon.damage = "blunt"
+
+    @pt.thing("test-early")
+    class MyEarly(pt.BaseThing):
+        later = pt.prop("test-later")
+
+    prop = vars(MyEarly)["later"]
+    assert type(prop) is pt.prop
+    early = MyEarly()
+    early.later = MyThing()
+
+    @pt.thing("test-later")
+    class MyLater(pt.BaseThing):
+        pass
+
+    assert type(prop) is not pt.prop
+    with pytest.raises(ValueError):
+        early.later = MyThing()
+    early.later = MyLater()
+    assert isinstance(early.later, MyLater)
+
+
+@pytest.mark.parametrize("compress", [False, True])
+async def test_export_import(thingsdb, tmp_path, compress):
+    player_id = await save_players(thingsdb)
+    stream = io.BytesIO()
+    assert await thingsdb.export(stream, compress=compress, batch_size=2) == 4
+    # Into another kind of backend, with new ids
+    stream.seek(0)
+    other = pt.ThingsDB(await pt.FileBackend.connect(tmp_path))
+    id_map = await other.import_(stream, remap_ids=True, batch_size=2)
+    assert len(id_map) == 4
+    player = await other.load(id_map[player_id])
+    assert player.name == "Alice"
+    assert player.buddy.buddy.name == "Carol"
+    assert player.thing.name == "Bulle"
+    assert [thing.name for thing in player.inventory] == ["Kaka"]
+    assert player.inventory[0]._id in id_map.values()
+    if not isinstance(player_id, str):
+        stream.seek(0)
+        with pytest.raises(ValueError, match="remap_ids=True"):
+            await other.import_(stream)
+    await other.close()
+    # Back into a cleared database, with the same ids
+    await thingsdb.clear()
+    stream.seek(0)
+    assert await thingsdb.import_(stream) is None
+    player = await thingsdb.load(player_id)
+    assert player.name == "Alice"
+    assert player.buddy.buddy.name == "Carol"
+    with pytest.raises(ValueError):
+        await thingsdb.import_(io.BytesIO(b'{"format": "other"}\n'))
+
+
+async def test_log_backend(tmp_path):
+    backend = await pt.LogBackend.connect(tmp_path, segment_size=256)
+    thingsdb = pt.ThingsDB(backend)
+    things = [MyThing(name=f"Thing {n}") for n in range(10)]
+    await thingsdb.save_many(things)
+    for n in range(5):
+        things[0].name = f"Renamed {n}"
+        await things[0].save()
+    await things[1].delete()
+    assert len(backend.segments()) > 1
+    assert backend.garbage_ratio() > 0
+    await thingsdb.close()
+
+    async def reopen():
+        backend = await pt.LogBackend.connect(tmp_path, segment_size=256)
+        loaded = await backend.load_many([thing._id for thing in things])
+        return backend, {thing_id: data["name"] for thing_id, data in loaded.items()}
+
+    expected = {thing._id: thing.name for thing in things if thing._id}
+    expected[things[0]._id] = "Renamed 4"
+    # From the hint file, then by scanning all segments
+    backend, names = await reopen()
+    assert names == expected
+    await backend.close()
+    (tmp_path / backend.HINT_NAME).unlink()
+    backend, names = await reopen()
+    assert names == expected
+    assert backend.next_id == 11
+    # A record cut short by a crash is dropped
+    await backend.update(things[2]._id, {"name": "Torn"})
+    await backend.close()
+    last = backend.segment_path(backend.segments()[-1])
+    os.truncate(last, last.stat().st_size - 2)
+    backend, names = await reopen()
+    assert names == expected
+    # Compaction keeps the latest records only
+    reclaimed = await backend.compact()
+    assert reclaimed > 0
+    assert backend.garbage_ratio() == 0
+    assert len(backend.segments()) >= 1
+    assert {
+        thing_id: data["name"]
+        for thing_id, data in [row async for row in backend.iterate()]
+    } == expected
+    await backend.close()
+    backend, names = await reopen()
+    assert names == expected
+    await backend.clear()
+    assert backend.segments() == []
+    await backend.close()
+    # In the background
+    backend = await pt.LogBackend.connect(
+        tmp_path, compact_interval=0.01, compact_ratio=0.5
+    )
+    thing_id = await backend.create({"name": "Kaka"})
+    for n in range(5):
+        await backend.update(thing_id, {"name": f"Kaka {n}"})
+    assert backend.garbage_ratio() > 0.5
+    await asyncio.sleep(0.05)
+    assert backend.garbage_ratio() == 0
+    assert (await backend.load(thing_id))["name"] == "Kaka 4"
+    await backend.close()
+
+
+async def test_log_backend_hint_race(tmp_path):
+    backend = await pt.LogBackend.connect(tmp_path)
+    thing_id = await backend.create({"name": "Kaka"})
+    # A hint written while an append is still being written, and then a
+    # crash, must not lose the append
+    record = [(thing_id, backend.encode({"name": "Bulle"}))]
+    write = asyncio.get_running_loop().run_in_executor(None, backend.write, record)
+    await write
+    backend.write_hint(dict(backend.index), dict(backend.sizes), backend.garbage)
+    recovered = await pt.LogBackend.connect(tmp_path)
+    assert (await recovered.load(thing_id))["name"] == "Bulle"
+    await recovered.close()
+    backend.seal()
+
+
+async def test_memory_backend(tmp_path):
+    path = tmp_path / "snapshot"
+    backend = await pt.MemoryBackend.connect(encoded=False, snapshot_path=path)
+    data = {pt.TYPE_KEY: "test-t", "name": "Kaka", "tags": ["a"]}
+    thing_id = await backend.create(data)
+    data["tags"].append("b")
+    loaded = await backend.load(thing_id)
+    loaded["tags"].append("c")
+    assert (await backend.load(thing_id))["tags"] == ["a"]
+    await backend.close()
+    # Snapshots load into backends that store things either way
+    backend = await pt.MemoryBackend.connect(snapshot_path=path)
+    assert await backend.load(thing_id) == {
+        pt.TYPE_KEY: "test-t",
+        "name": "Kaka",
+        "tags": ["a"],
+    }
+    assert await backend.create({"name": "Bulle"}) == thing_id + 1
+    await backend.close()
+    path.unlink()
+    backend = await pt.MemoryBackend.connect(snapshot_path=path, snapshot_interval=0.01)
+    await backend.create({"name": "Kaka"})
+    await asyncio.sleep(0.05)
+    assert path.exists()
+    await backend.stop()
+    # Snapshots of things with ids from other backends reopen too
+    await backend.update("e4c1a7c2-uuid", {"name": "Bulle"})
+    await backend.close()
+    backend = await pt.MemoryBackend.connect(snapshot_path=path)
+    assert (await backend.load("e4c1a7c2-uuid"))["name"] == "Bulle"
+    assert await backend.create({"name": "Kaka"}) == 2
+    await backend.close()
+
+
+@pytest.mark.parametrize("write_back", [False, True])
+async def test_tiered_backend(write_back):
+    durable = await pt.SqliteBackend.connect(TEST_DB, TEST_DB_TABLE)
+    await durable.clear()
+    backend = await pt.TieredBackend.connect(
+        pt.MemoryBackend(), durable, write_back=write_back, max_dirty=3
+    )
+    thingsdb = pt.ThingsDB(backend)
+    weapon = MyWeapon(name="Axe", damage=60)
+    await weapon.save(thingsdb)
+    # Created in both tiers
+    assert (await durable.load(weapon._id))["damage"] == 60
+    assert (await backend.fast.load(weapon._id))["damage"] == 60
+    weapon.damage = 40
+    await weapon.save()
+    assert (await backend.load(weapon._id))["damage"] == 40
+    assert (await durable.load(weapon._id))["damage"] == (60 if write_back else 40)
+    # Queries see held back updates
+    found = [thing async for thing in thingsdb.query(MyWeapon, damage__lt=50)]
+    assert found == [weapon]
+    assert not backend.dirty
+    # Things missing from the fast tier are read through
+    thing_id = await durable.create({pt.TYPE_KEY: "test-t", pt.VERSION_KEY: 1})
+    assert await backend.load(thing_id) is not None
+    assert (backend.hits, backend.misses) == (1, 1)
+    assert await backend.load(thing_id) is not None
+    assert (backend.hits, backend.misses) == (2, 1)
+    things = [MyThing(name=str(n)) for n in range(3)]
+    await thingsdb.save_many(things)
+    for thing in things[:2]:
+        thing.name = "Renamed"
+        await thing.save()
+    assert len(backend.dirty) == (2 if write_back else 0)
+    things[2].name = "Renamed"
+    await things[2].save()
+    # Flushed at max_dirty
+    assert not backend.dirty
+    loaded = await durable.load_many([thing._id for thing in things])
+    assert [data["name"] for data in loaded.values()] == ["Renamed"] * 3
+    weapon.damage = 20
+    await weapon.save()
+    await thingsdb.close()
+    durable = await pt.SqliteBackend.connect(TEST_DB, TEST_DB_TABLE)
+    assert (await durable.load(weapon._id))["damage"] == 20
+    await durable.close()